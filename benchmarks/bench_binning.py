@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the count-adaptive binning against the box smoothing.
+
+A synthetic low-count pair (see run_benchmarks: ramp, film step and islands)
+is processed into the normalized thickness map with the box smoothing for
+several kernel sizes and with the adaptive bins (tbb1_binning) for several
+target counts. For each map: time of the smoothing / binning, and error to
+the true thickness (RMS, nm) in the flat areas (noise) and near the film
+edges (blur), the edges being where the true thickness changes by more than
+--edge nm per pixel. A method is better when it gives a lower edge error for
+the same flat noise, in less time.
+
+    python benchmarks/bench_binning.py [--size 2048] [--total-counts 300]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import tbb1_binning                                                             # noqa: E402
+import tbb1_engine                                                              # noqa: E402
+from run_benchmarks import COEFFICIENTS, FACTORS, synthetic_pair, thickness_topography  # noqa: E402
+
+
+DEFAULT_KERNELS = [3, 5, 9, 15, 25]
+DEFAULT_TARGETS = [25, 50, 100, 200, 400]
+
+
+def errors(thickness, truth, edges):
+    """RMS error (nm) in the flat areas and near the edges (finite values)."""
+    difference = thickness - truth
+    finite = np.isfinite(difference)
+    flat = np.sqrt(np.mean(difference[finite & ~edges]**2))
+    edge = np.sqrt(np.mean(difference[finite & edges]**2))
+    return flat, edge
+
+
+def normalized_thickness(si, total):
+    return tbb1_engine.transform(si, total, pixels_raster_factor=1.0, normalization=True, **FACTORS, **COEFFICIENTS)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=2048)
+    parser.add_argument("--total-counts", type=int, default=300, help="mean counts of the total image per pixel")
+    parser.add_argument("--kernels", type=int, nargs="+", default=DEFAULT_KERNELS)
+    parser.add_argument("--targets", type=float, nargs="+", default=DEFAULT_TARGETS, help="Si counts per bin")
+    parser.add_argument("--edge", type=float, default=0.02, help="nm per pixel marking the edges (default: 0.02)")
+    args = parser.parse_args(argv)
+
+    si, total = synthetic_pair(args.size, args.total_counts)
+    truth = thickness_topography(args.size)
+    gradient = np.hypot(*np.gradient(truth))
+    edges = np.zeros_like(gradient, dtype=bool)
+    edges[gradient > args.edge] = True
+    print("%d x %d pixels, mean Si counts per pixel %.1f, %.1f %% of edge pixels" % (
+        args.size, args.size, si.mean(), 100*edges.mean()))
+    print("%-22s %10s %12s %12s" % ("method", "time (s)", "flat (nm)", "edge (nm)"))
+
+    flat, edge = errors(normalized_thickness(si, total), truth, edges)
+    print("%-22s %10s %12.3f %12.3f" % ("none", "-", flat, edge))
+    for kernel_size in args.kernels:
+        start = time.perf_counter()
+        smoothed = tbb1_engine.smooth_image(si, kernel_size)
+        total_smoothed = tbb1_engine.smooth_image(total, kernel_size)
+        elapsed = time.perf_counter() - start
+        flat, edge = errors(normalized_thickness(smoothed, total_smoothed), truth, edges)
+        print("%-22s %10.4f %12.3f %12.3f" % ("box %dx%d" % (kernel_size, kernel_size), elapsed, flat, edge))
+    for target in args.targets:
+        start = time.perf_counter()
+        si_binned, total_binned = tbb1_binning.bin_images(si, total, target)
+        elapsed = time.perf_counter() - start
+        flat, edge = errors(normalized_thickness(si_binned, total_binned), truth, edges)
+        print("%-22s %10.4f %12.3f %12.3f" % ("bins %g counts" % target, elapsed, flat, edge))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Several substrate channels (tbb1_channels) against one run per channel.
+
+A synthetic topography (see run_benchmarks) is measured on --channels
+substrate ions with different calibrations (Poisson counts, normalized by a
+common total ion image). The thickness maps of all the channels and their
+combination are computed:
+    - with one ThicknessPipeline run per channel (smoothing, conversion of
+      the total image, normalization and calibration repeated for each ion),
+      then the weights of the counting statistics computed again from the
+      smoothed images and the weighted mean of the maps,
+    - with ChannelPipeline: one smoothing call on the stack and one pass of
+      channel_transform, weights from the counting statistics,
+and the times and the mean error of each map against the true topography are
+printed.
+
+    python benchmarks/bench_channels.py [--size 2048] [--channels 3] [--repeat 3]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import tbb1_channels                                                            # noqa: E402
+import tbb1_engine                                                              # noqa: E402
+from run_benchmarks import COEFFICIENTS, thickness_topography                   # noqa: E402
+
+
+# Normalized calibration (a_norm, b_norm) of the synthetic channels: the first one is the one of run_benchmarks
+CHANNELS = [("Si+", COEFFICIENTS["a_norm"], COEFFICIENTS["b_norm"]), ("SiOH+", 0.03, -0.5),
+            ("Si2+", 0.01, -1.1), ("Au+", 0.05, -0.9)]
+TOTAL_COUNTS = 300
+KERNEL_SIZE = 5
+
+
+def best_time(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=2048)
+    parser.add_argument("--channels", type=int, default=3, choices=range(1, len(CHANNELS) + 1))
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    truth = thickness_topography(args.size)
+    total = rng.poisson(TOTAL_COUNTS, truth.shape).astype(np.uint16)
+    channels = CHANNELS[:args.channels]
+    stack = np.stack([rng.poisson(total*a_norm*np.exp(b_norm*truth)).astype(np.uint16)
+                      for _, a_norm, b_norm in channels])
+    coefficients = {ion: (None, None, a_norm, b_norm) for ion, a_norm, b_norm in channels}
+    print("%d x %d pixels, %d channels (%s)" % (args.size, args.size, len(channels),
+                                               ", ".join(ion for ion, _, _ in channels)))
+
+    def separate():
+        maps = [tbb1_engine.ThicknessPipeline(a_norm=a_norm, b_norm=b_norm, kernel_size=KERNEL_SIZE)
+                .process_arrays(image, total)["thickness"] for image, (_, a_norm, b_norm) in zip(stack, channels)]
+        with np.errstate(divide="ignore"):
+            weights = [b_norm**2/(1/(KERNEL_SIZE**2*tbb1_engine.smooth_image(image, KERNEL_SIZE)) + 1/total)
+                       for image, (_, _, b_norm) in zip(stack, channels)]
+        return np.stack(maps), np.average(maps, axis=0, weights=weights)
+
+    pipeline = tbb1_channels.ChannelPipeline([ion for ion, _, _ in channels], coefficients, kernel_size=KERNEL_SIZE)
+    slow, (maps, mean) = best_time(separate, args.repeat)
+    fast, result = best_time(lambda: pipeline.process_arrays(stack, total), args.repeat)
+    print("%-34s %10.3f s" % ("one run per channel, then weights", slow))
+    print("%-34s %10.3f s  (x%.1f)" % ("one pass over the stack", fast, slow/fast))
+    print("largest difference of the channel maps: %.2e nm" % np.nanmax(np.abs(maps - result["channels"])))
+
+    print("%-34s %10s" % ("mean error against the topography", "nm"))
+    for (ion, _, _), channel in zip(channels, result["channels"]):
+        print("%-34s %10.4f" % (ion, np.nanmean(np.abs(channel - truth))))
+    print("%-34s %10.4f" % ("combined, equal weights", np.nanmean(np.abs(maps.mean(axis=0) - truth))))
+    print("%-34s %10.4f" % ("combined, runs then weights", np.nanmean(np.abs(mean - truth))))
+    print("%-34s %10.4f" % ("combined, counting weights", np.nanmean(np.abs(result["thickness"] - truth))))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
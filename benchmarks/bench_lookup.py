@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the lookup-table calibration of 8-bit image pairs.
+
+Compares the analytic transform of tbb1_engine with the lookup tables of
+tbb1_calibration, for the Si image alone (1D table) and for the normalized map
+(2D table): time of the first calibration, time of a re-calibration with new
+coefficients (table index already known) and largest difference of the maps.
+Signed (int16, int32) images, and int16 images with negative values, are
+checked against the analytic transform too; the exit status is 1 if their maps
+differ.
+
+    python benchmarks/bench_lookup.py [--sizes 512 2048 4096]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import tbb1_calibration                                                         # noqa: E402
+import tbb1_engine                                                              # noqa: E402
+
+
+FACTORS = dict(counts_pixel_factor1=0.13, counts_pixel_factor2=31.4, pixels_raster_factor=16834.0)
+COEFFICIENTS = dict(a=2000000.0, b=-0.998, a_norm=0.1373, b_norm=-0.999)
+
+
+def best_time(function, *args, repeat=3, **kwargs):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 2048, 4096])
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    print("%6s %-11s %-16s %10s %12s" % ("size", "map", "method", "time (s)", "max |diff|"))
+    for size in args.sizes:
+        si_image = np.transpose(rng.poisson(30, (size, size)).astype(np.uint8))
+        total_image = np.transpose(rng.poisson(200, (size, size)).clip(0, 255).astype(np.uint8))
+        for normalization in (False, True):
+            name = "normalized" if normalization else "Si"
+            total = total_image if normalization else None
+            elapsed, reference = best_time(tbb1_engine.transform, si_image, total_image, normalization=normalization,
+                                           **FACTORS, **COEFFICIENTS)
+            print("%6d %-11s %-16s %10.4f %12s" % (size, name, "analytic", elapsed, "-"))
+            elapsed, thickness = best_time(tbb1_calibration.transform, si_image, total_image,
+                                           normalization=normalization, **FACTORS, **COEFFICIENTS)
+            difference = np.nanmax(np.abs(thickness - reference))
+            print("%6d %-11s %-16s %10.4f %12.2e" % (size, name, "lookup", elapsed, difference))
+            index = tbb1_calibration.lookup_index(si_image, total)
+            elapsed, _ = best_time(tbb1_calibration.transform, si_image, total_image, normalization=normalization,
+                                   index=index, **FACTORS, **COEFFICIENTS)
+            print("%6d %-11s %-16s %10.4f %12s" % (size, name, "lookup (recal.)", elapsed, "-"))
+
+    print("%-8s %-11s %12s" % ("dtype", "map", "max |diff|"))
+    failed = False
+    for dtype, offset in ((np.int16, 0), (np.int32, 0), (np.int16, -20)):
+        si_image = np.transpose((rng.poisson(30, (512, 512)) + offset).astype(dtype))
+        total_image = np.transpose((rng.poisson(200, (512, 512)) + offset).astype(dtype))
+        name = np.dtype(dtype).name + ("<0" if offset < 0 else "")
+        for normalization in (False, True):
+            total = total_image if normalization else None
+            if tbb1_calibration.lookup_index(si_image, total) is None:
+                print("%-8s %-11s %12s" % (name, "normalized" if normalization else "Si", "no table"))
+                failed = True
+                continue
+            reference = tbb1_engine.transform(si_image, total_image, normalization=normalization,
+                                              **FACTORS, **COEFFICIENTS)
+            thickness = tbb1_calibration.transform(si_image, total_image, normalization=normalization,
+                                                   **FACTORS, **COEFFICIENTS)
+            difference = np.nanmax(np.abs(thickness - reference))
+            failed |= not difference <= 1e-9*np.nanmax(np.abs(reference))
+            print("%-8s %-11s %12.2e" % (name, "normalized" if normalization else "Si", difference))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
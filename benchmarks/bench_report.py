@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput of the contact sheets (tbb1_report) of thickness maps.
+
+--maps synthetic --size x --size maps (see run_benchmarks) are saved as .npy
+files, then the pages of the report are rendered to PNG files:
+    - in one process, with a new page (figure, axes, colorbars) for every
+      page, as a script drawing each page from scratch does,
+    - in one process, with the page template reused (tbb1_report.SheetTemplate),
+    - with --jobs worker processes (tbb1_report.render_report),
+and the maps rendered per second are printed.
+
+    python benchmarks/bench_report.py [--size 1024] [--maps 16] [--jobs 2]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import tbb1_report                                                              # noqa: E402
+from run_benchmarks import thickness_topography                                 # noqa: E402
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--maps", type=int, default=16)
+    parser.add_argument("--jobs", type=int, default=2)
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as directory:
+        entries = []
+        for number in range(args.maps):
+            path = os.path.join(directory, "map%03d_thickness.npy" % number)
+            np.save(path, thickness_topography(args.size) + rng.normal(0, 0.2, (args.size, args.size)))
+            entries.append(tbb1_report.map_entry(path))
+        pages = [entries[start:start + tbb1_report.ROWS_PER_PAGE]
+                 for start in range(0, len(entries), tbb1_report.ROWS_PER_PAGE)]
+        print("%d maps of %d x %d pixels, %d pages" % (args.maps, args.size, args.size, len(pages)))
+
+        start = time.perf_counter()
+        for number, page in enumerate(pages):
+            tbb1_report.SheetTemplate().render(page, os.path.join(directory, "new_%03d.png" % number))
+        elapsed = time.perf_counter() - start
+        print("%-28s %6.2f s  %5.1f maps/s" % ("new page for every page", elapsed, args.maps/elapsed))
+
+        start = time.perf_counter()
+        template = tbb1_report.SheetTemplate()
+        for number, page in enumerate(pages):
+            template.render(page, os.path.join(directory, "reused_%03d.png" % number))
+        elapsed = time.perf_counter() - start
+        print("%-28s %6.2f s  %5.1f maps/s" % ("page template reused", elapsed, args.maps/elapsed))
+
+        start = time.perf_counter()
+        tbb1_report.render_report(entries, os.path.join(directory, "report.png"), jobs=args.jobs)
+        elapsed = time.perf_counter() - start
+        print("%-28s %6.2f s  %5.1f maps/s" % ("%d worker processes" % args.jobs, elapsed, args.maps/elapsed))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
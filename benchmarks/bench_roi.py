@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the ROI statistics (tbb1_roi) on a thickness map.
+
+The summed-area tables of a --size x --size map are built once, then the
+statistics of well plates of 96, 384, 1536 and 6144 rectangles (and of one
+polygon) are computed with and without Ra, and compared with the direct
+computation over the pixels of each rectangle (numpy, one ROI at a time).
+The maximum difference between both gives the precision of the tables.
+
+    python benchmarks/bench_roi.py [--size 4096] [--repeat 5]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import tbb1_engine                                                              # noqa: E402
+import tbb1_roi                                                                 # noqa: E402
+
+
+PLATES = [(8, 12), (16, 24), (32, 48), (64, 96)]                                # rows x columns of wells
+MAP_SIZE_MM = 100.0
+
+
+def best_time(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def direct(z, tables, rois):
+    """Mean and Rq of each rectangle from its pixels (reference)."""
+    means, rqs = [], []
+    for r0, c0, r1, c1 in zip(*tables.rectangle_boxes([roi.geometry for roi in rois])):
+        values = z[r0:r1, c0:c1]
+        values = values[np.isfinite(values)]
+        means.append(values.mean())
+        rqs.append(values.std())
+    return np.array(means), np.array(rqs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=4096)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    z = 40 + rng.normal(0, 2, (args.size, args.size))                           # nm, with a few NaN
+    z[rng.random(z.shape) < 1e-3] = np.nan
+    x, y = tbb1_engine.axes_mm(z.shape, MAP_SIZE_MM, MAP_SIZE_MM)
+    elapsed, tables = best_time(lambda: tbb1_roi.RoiTables(z, x, y), 1)
+    print("%d x %d map: tables built in %.3f s (%d MB)" % (args.size, args.size, elapsed, tables.nbytes >> 20))
+    print("%-22s %12s %12s %12s %12s" % ("ROIs", "tables (ms)", "+ Ra (ms)", "direct (ms)", "max error"))
+
+    for rows, columns in PLATES:
+        pitch = MAP_SIZE_MM/max(rows, columns)
+        rois = tbb1_roi.well_grid((pitch/2, pitch/2), pitch, 0.6*pitch, rows, columns)
+        fast, result = best_time(lambda: tables.statistics(rois, ra=False), args.repeat)
+        with_ra, _ = best_time(lambda: tables.statistics(rois), args.repeat)
+        slow, (means, rqs) = best_time(lambda: direct(z, tables, rois), 1)
+        error = max(np.abs(np.array([row["mean"] for row in result]) - means).max(),
+                    np.abs(np.array([row["rq"] for row in result]) - rqs).max())
+        print("%-22s %12.2f %12.2f %12.2f %12.2e" % ("%d wells" % len(rois), 1e3*fast, 1e3*with_ra, 1e3*slow, error))
+
+    angles = np.linspace(0, 2*np.pi, 64, endpoint=False)
+    polygon = tbb1_roi.Roi("disc", "polygon", tuple(zip(50 + 40*np.cos(angles), 50 + 40*np.sin(angles))))
+    fast, _ = best_time(lambda: tables.statistics([polygon], ra=False), args.repeat)
+    with_ra, _ = best_time(lambda: tables.statistics([polygon]), args.repeat)
+    print("%-22s %12.2f %12.2f" % ("polygon (64 vertices)", 1e3*fast, 1e3*with_ra))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
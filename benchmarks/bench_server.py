@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Latency of the thickness service (tbb1_server) against a cold start.
+
+A synthetic 16-bit pair (see run_benchmarks) is written to TIFF files, the
+service is started on a free port of 127.0.0.1 with --jobs workers, and:
+    - --requests requests are sent one after the other,
+    - the same requests are sent by --clients concurrent clients,
+    - a few maps are computed by a new Python process each (cold start: the
+      interpreter and the imports are paid by every map),
+and the latencies (50th, 90th percentiles, maximum) and the throughput are
+printed, with the metrics reported by the service (GET /metrics).
+
+    python benchmarks/bench_server.py [--size 512] [--requests 50] [--clients 4] [--jobs 2]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import numpy as np
+import PIL.Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import tbb1_server                                                              # noqa: E402
+from run_benchmarks import COEFFICIENTS, synthetic_pair                        # noqa: E402
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+COLD_RUNS = 3
+
+# Run in a new process for each map (cold start)
+COLD = r"""
+import sys, tbb1_engine
+tbb1_engine.ThicknessPipeline(**%r).run(sys.argv[1], sys.argv[2])
+"""
+
+
+def summary(latencies):
+    latencies = np.array(latencies)
+    return "p50 %7.1f ms  p90 %7.1f ms  max %7.1f ms" % tuple(
+        1e3*value for value in (np.percentile(latencies, 50), np.percentile(latencies, 90), latencies.max()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--jobs", type=int, default=2)
+    args = parser.parse_args(argv)
+
+    si, total = synthetic_pair(args.size, 300)
+    parameters = dict(COEFFICIENTS, xsize=0.5, ysize=0.5, smooth=5)
+    with tempfile.TemporaryDirectory() as directory:
+        si_path, total_path = os.path.join(directory, "si.tif"), os.path.join(directory, "total.tif")
+        PIL.Image.fromarray(si.astype(np.uint16)).save(si_path)
+        PIL.Image.fromarray(total.astype(np.uint16)).save(total_path)
+
+        start = time.perf_counter()
+        server = tbb1_server.ThicknessServer(("127.0.0.1", 0), args.jobs, max_queue=args.clients)
+        print("%d x %d pair, service with %d workers started in %.2f s" % (
+            args.size, args.size, args.jobs, time.perf_counter() - start))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        def request():
+            start = time.perf_counter()
+            tbb1_server.request_thickness(server.url, si_path, total_path, **parameters)
+            return time.perf_counter() - start
+
+        try:
+            latencies = [request() for _ in range(args.requests)]
+            print("%-26s %s" % ("sequential requests", summary(latencies)))
+
+            latencies, lock = [], threading.Lock()
+
+            def client(count):
+                for _ in range(count):
+                    latency = request()
+                    with lock:
+                        latencies.append(latency)
+
+            start = time.perf_counter()
+            clients = [threading.Thread(target=client, args=(args.requests//args.clients,)) for _ in range(args.clients)]
+            for thread in clients:
+                thread.start()
+            for thread in clients:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            print("%-26s %s  (%.1f maps/s)" % ("%d concurrent clients" % args.clients, summary(latencies),
+                                               len(latencies)/elapsed))
+            with urllib.request.urlopen(server.url + "/metrics") as response:
+                metrics = json.loads(response.read())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        pipeline = dict(COEFFICIENTS, xsize=0.5, ysize=0.5, kernel_size=5)
+        latencies = []
+        for _ in range(COLD_RUNS):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", COLD % pipeline, si_path, total_path], cwd=ROOT, check=True)
+            latencies.append(time.perf_counter() - start)
+        print("%-26s %s" % ("new process per map", summary(latencies)))
+
+    print("service metrics: %d requests, %d errors, compute p50 %.1f ms, waiting p50 %.1f ms" % (
+        metrics["requests"], metrics["errors"], 1e3*metrics["latency"]["compute"]["p50"],
+        1e3*metrics["latency"]["wait"]["p50"]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
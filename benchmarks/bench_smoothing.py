@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the smoothing: running-sum box filter (tbb1_smoothing) against the
+former dense kernel convolution (scipy.signal.convolve2d, mode='same').
+
+For each image size and kernel size, prints the time of both methods and the
+largest absolute difference of the results (8-bit random image, 0-255 scale).
+The former kernel was stored in float32, so the results agree to float32
+precision (about 1e-5 on the 0-255 scale).
+
+    python benchmarks/bench_smoothing.py [--sizes 512 1024] [--kernels 3 15 51 100]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import scipy.signal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from tbb1_smoothing import box_filter                                           # noqa: E402
+
+
+def convolve_reference(data, kernel_size):
+    """The smoothing of pyTBB1 before the running-sum filter."""
+    kernel = np.ones((kernel_size, kernel_size), np.float32)/(kernel_size**2)
+    return scipy.signal.convolve2d(data/255, kernel, mode='same')*255
+
+
+def best_time(function, *args, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512])
+    parser.add_argument("--kernels", type=int, nargs="+", default=[3, 15, 51, 100])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-reference", action="store_true", help="only time the box filter (large images)")
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    print("%8s %7s %14s %14s %10s %12s" % ("size", "kernel", "convolve2d (s)", "box (s)", "speed-up", "max |diff|"))
+    for size in args.sizes:
+        image = rng.integers(0, 256, (size, size)).astype(np.uint8)
+        for kernel_size in args.kernels:
+            box_time, smoothed = best_time(box_filter, image, kernel_size, repeat=args.repeat)
+            if args.skip_reference:
+                print("%8d %7d %14s %14.4f %10s %12s" % (size, kernel_size, "-", box_time, "-", "-"))
+                continue
+            reference_time, reference = best_time(convolve_reference, image, kernel_size, repeat=args.repeat)
+            difference = np.max(np.abs(smoothed - reference))
+            print("%8d %7d %14.4f %14.4f %9.1fx %12.2e" % (size, kernel_size, reference_time, box_time,
+                                                            reference_time/box_time, difference))
+            assert np.allclose(smoothed, reference, rtol=1e-6, atol=1e-4), "box filter differs from convolve2d"
+
+
+if __name__ == "__main__":
+    main()
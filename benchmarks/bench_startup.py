@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Start-up time of the GUI, with a target (regression check).
+
+Each run is a new Python process (cold start of the interpreter, warm disk
+cache) which imports pyTBB1 and, if a display is available, builds the
+window and draws it once (root.update()). The median of the runs is compared
+with the target, and the heavy modules that the start must not import
+(matplotlib, scipy, openpyxl: they are imported on first use) are checked.
+The exit status is 1 if the target is missed, a heavy module is imported or
+the start fails, so the script can be run as a regression test (CI). openpyxl
+is checked after the import only: the calibration library is then loaded by
+the worker in the background, on purpose.
+
+With a display, the first run also makes the cached illustration and icon
+(tbb1_assets), as the first start of the GUI does; it is reported separately.
+
+    python benchmarks/bench_startup.py [--runs 5] [--target 1.0]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+STARTUP_TARGET = 1.0                                                            # s, from the start of the interpreter to the window drawn
+HEAVY_MODULES = ("matplotlib", "scipy", "openpyxl")                             # not imported by "import pyTBB1"
+WINDOW_HEAVY_MODULES = ("matplotlib", "scipy")                                  # nor by drawing the window
+
+# Run in the child process; the times (epoch) are compared with the launch of the process
+CHILD = r"""
+import json, sys, time
+start = time.time()
+import pyTBB1
+imported = time.time()
+heavy = [name for name in %r if name in sys.modules]
+window = None
+try:
+    root = pyTBB1.Tk()
+except pyTBB1.tk.TclError:                                                      # no display
+    root = None
+if root is not None:
+    gui = pyTBB1.GUI_PyTBB1(root)
+    root.update()
+    window = time.time()
+    heavy += [name for name in %r if name in sys.modules and name not in heavy]
+    gui.Close()
+print(json.dumps({"script": start, "imported": imported, "window": window, "heavy": heavy}))
+""" % (HEAVY_MODULES, WINDOW_HEAVY_MODULES)
+
+
+def run_once(python=sys.executable):
+    """Start a new interpreter and return its start-up times (s): "import" of pyTBB1, "start" (window or import)."""
+    launch = time.time()
+    output = subprocess.run([python, "-c", CHILD], cwd=ROOT, capture_output=True, text=True)
+    if output.returncode != 0:
+        raise RuntimeError("the start failed:\n" + output.stderr.strip())
+    child = json.loads(output.stdout.strip().splitlines()[-1])
+    ready = child["window"] or child["imported"]
+    return {"import": child["imported"] - child["script"], "start": ready - launch,
+            "window": child["window"] is not None, "heavy": child["heavy"]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--target", type=float, default=STARTUP_TARGET, help="seconds (default: 1.0)")
+    args = parser.parse_args(argv)
+
+    try:
+        first = run_once()
+        runs = [run_once() for _ in range(args.runs)]
+    except RuntimeError as error:
+        print("FAIL: %s" % error)
+        return 1
+    median = statistics.median(run["start"] for run in runs)
+    heavy = sorted({name for run in [first] + runs for name in run["heavy"]})
+
+    print("first start: %.3f s" % first["start"])
+    print("median start over %d runs: %.3f s (%s, target %.3f s)" % (
+        args.runs, median, "window drawn" if first["window"] else "import only, no display", args.target))
+    print("import of pyTBB1: %.3f s" % statistics.median(run["import"] for run in runs))
+    print("heavy modules imported at start: %s" % (", ".join(heavy) or "none"))
+    failures = []
+    if median > args.target:
+        failures.append("median start %.3f s over the target %.3f s" % (median, args.target))
+    if heavy:
+        failures.append("heavy modules imported at start: %s" % ", ".join(heavy))
+    for failure in failures:
+        print("FAIL: %s" % failure)
+    print("FAIL" if failures else "OK")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
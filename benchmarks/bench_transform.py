@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the conversion, normalization and calibration of an image pair.
+
+Compares the former array expressions of PixelToCount and Plot (one full-size
+float64 temporary per operation) with the fused transform of tbb1_engine, in
+float64 and float32: wall time, peak memory allocated (tracemalloc) and largest
+difference of the thickness map.
+
+    python benchmarks/bench_transform.py [--sizes 512 2048 4096]
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import tbb1_engine                                                              # noqa: E402
+
+
+FACTORS = dict(counts_pixel_factor1=0.13, counts_pixel_factor2=31.4, pixels_raster_factor=16834.0)
+COEFFICIENTS = dict(a=2000000.0, b=-0.998, a_norm=0.1373, b_norm=-0.999)
+
+
+def former_transform(si_image, total_image, counts_pixel_factor1, counts_pixel_factor2,
+                     pixels_raster_factor, a_norm, b_norm, **_):
+    """Calibration and normalization as written in PixelToCount and Plot before the fused transform."""
+    I1_ar_con = si_image*counts_pixel_factor1*pixels_raster_factor
+    I2_ar_con = total_image*counts_pixel_factor2*pixels_raster_factor
+    I2_ar_con = np.where(I2_ar_con == 0, 1000, I2_ar_con)
+    I1_ar_con = np.where(I1_ar_con == 0, 1, I1_ar_con)
+    I1_ar_con_norm = I1_ar_con/I2_ar_con
+    return np.log(I1_ar_con_norm/a_norm)/b_norm
+
+
+def measure(function, *args, **kwargs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 2048, 4096])
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    print("%6s %-16s %10s %12s %12s" % ("size", "method", "time (s)", "peak (MB)", "max |diff|"))
+    for size in args.sizes:
+        si_image = np.transpose(rng.poisson(30, (size, size)).astype(np.uint8))
+        total_image = np.transpose(rng.poisson(200, (size, size)).clip(0, 255).astype(np.uint8))
+        elapsed, peak, reference = measure(former_transform, si_image, total_image, **FACTORS, **COEFFICIENTS)
+        print("%6d %-16s %10.4f %12.1f %12s" % (size, "former float64", elapsed, peak/1024**2, "-"))
+        for dtype in (np.float64, np.float32):
+            elapsed, peak, thickness = measure(tbb1_engine.transform, si_image, total_image,
+                                               dtype=dtype, **FACTORS, **COEFFICIENTS)
+            difference = np.nanmax(np.abs(thickness - reference))
+            print("%6d %-16s %10.4f %12.1f %12.2e" % (size, "fused " + np.dtype(dtype).name,
+                                                      elapsed, peak/1024**2, difference))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite of every stage of the pipeline, with a regression check.
+
+Synthetic Si / total ion image pairs are generated with a known thickness
+topography (ramp, step and islands, 0 to about 8 nm), written as 16-bit TIFF
+files (and as 8-bit PNG files) and processed as by the GUI:
+    load:tiff         both TIFF images, read into memory (tbb1_engine.load_image
+                      only memory-maps them: the pixels are copied, so reading
+                      them is timed)
+    load:png          both images as 8-bit PNG files, the format of the GUI
+    smooth[k]         the Si image, for several values of the smoothing slider
+    pixel_to_count    both images (PixelToCount)
+    plot:<stage>      the four branches of the Plot button (Si intensity,
+                      normalized Si intensity, thickness, normalized thickness)
+    render:heatmap    2D preview of the map, drawn with Agg
+    render:surface    level-of-detail 3D surface of the map, drawn with Agg
+For each stage the best wall time of --repeat runs and the peak memory
+allocated (tracemalloc, one extra run) are recorded.
+
+The results are written in a JSON file (--output) with the versions and the
+git revision, so that two revisions can be compared:
+    python benchmarks/run_benchmarks.py --output before.json
+    (change the code)
+    python benchmarks/run_benchmarks.py --output after.json --baseline before.json
+    python benchmarks/run_benchmarks.py --compare before.json after.json
+A stage is a regression when it is more than --threshold slower (or uses
+more than --threshold more memory) than the baseline, and the difference is
+larger than --min-time seconds; the exit status is then 1.
+
+    python benchmarks/run_benchmarks.py [--sizes 128 512 2048] [--kernels 3 25 100] [--all-sizes]
+"""
+
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")                                                           # headless rendering
+import matplotlib.pyplot as plt                                                 # noqa: E402
+from PIL import Image                                                           # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+import tbb1_engine                                                              # noqa: E402
+import tbb1_render                                                              # noqa: E402
+
+
+DEFAULT_SIZES = [128, 512, 2048]
+ALL_SIZES = [128, 512, 2048, 4096, 8192]
+DEFAULT_KERNELS = [3, 10, 25, 50, 100]                                          # values of the smoothing slider (3 to 100)
+DEFAULT_THRESHOLD = 0.2                                                         # 20 % slower (or larger) is a regression
+DEFAULT_MIN_TIME = 0.005                                                        # s, differences below are timer noise
+
+FACTORS = dict(counts_pixel_factor1=1.0, counts_pixel_factor2=1.0)              # 16-bit images: true counts
+COEFFICIENTS = dict(a=2000000.0, b=-0.998, a_norm=0.1054, b_norm=-0.7205)
+PLOT_BRANCHES = (                                                               # (stage, calibration, normalization)
+    ("si", False, False),
+    ("si_norm", False, True),
+    ("thickness", True, False),
+    ("thickness_norm", True, True),
+)
+
+
+# ===== Synthetic images =====
+# ============================
+
+def thickness_topography(size):
+    """Thickness map (nm) of size x size pixels: ramp, film step and a few round islands."""
+    y, x = np.mgrid[0:1:size*1j, 0:1:size*1j]
+    thickness = 2.0*x + np.where(y > 0.5, 2.0, 0.0)                             # ramp and step
+    for cx, cy, radius, height in ((0.25, 0.25, 0.08, 3.0), (0.7, 0.3, 0.05, 4.0), (0.4, 0.75, 0.12, 2.5)):
+        thickness += height*np.exp(-((x - cx)**2 + (y - cy)**2)/(2*radius**2))
+    return thickness
+
+
+def synthetic_pair(size, total_counts=2000, seed=0):
+    """Si and total ion images (uint16, Poisson counts) of the topography, calibrated with COEFFICIENTS."""
+    rng = np.random.default_rng(seed)
+    thickness = thickness_topography(size)
+    total = rng.poisson(total_counts, (size, size))
+    ratio = COEFFICIENTS["a_norm"]*np.exp(COEFFICIENTS["b_norm"]*thickness)
+    si = rng.poisson(total*ratio)
+    return si.clip(0, 65535).astype(np.uint16), total.clip(0, 65535).astype(np.uint16)
+
+
+def write_pair(directory, size, seed=0, extension=".tif"):
+    """Write a synthetic pair as 16-bit TIFF files (8-bit grey levels for other extensions). Returns their paths."""
+    si, total = synthetic_pair(size, seed=seed)
+    paths = []
+    for name, data in (("Si", si), ("total", total)):
+        path = os.path.join(directory, "synthetic_%d_%s%s" % (size, name, extension))
+        Image.fromarray(data if extension == ".tif" else data.clip(0, 255).astype(np.uint8)).save(path)
+        paths.append(path)
+    return paths
+
+
+# ===== Measures =====
+# ====================
+
+def measure(function, repeat):
+    """Best wall time of repeat runs and peak memory allocated by one more run."""
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def draw(figure):
+    figure.canvas.draw()
+    plt.close(figure)
+
+
+def benchmark_size(size, kernels, repeat, directory, log=print):
+    """Time every stage on a synthetic pair of size x size pixels. Returns a list of results."""
+    si_path, total_path = write_pair(directory, size)
+    png_paths = write_pair(directory, size, extension=".png")
+    results = []
+
+    def record(stage, function):
+        elapsed, peak = measure(function, repeat)
+        results.append({"size": size, "stage": stage, "time": elapsed, "peak_bytes": peak})
+        log("%6d %-22s %10.4f %12.1f" % (size, stage, elapsed, peak/1024**2))
+
+    record("load:tiff", lambda: (np.array(tbb1_engine.load_image(si_path)), np.array(tbb1_engine.load_image(total_path))))
+    record("load:png", lambda: [tbb1_engine.load_image(path) for path in png_paths])
+    si_image = np.array(tbb1_engine.load_image(si_path))                        # in memory: the other stages do not read the file
+    total_image = np.array(tbb1_engine.load_image(total_path))
+    for kernel_size in kernels:
+        record("smooth[%d]" % kernel_size, lambda: tbb1_engine.smooth_image(si_image, kernel_size))
+    pixels_raster_factor = tbb1_engine.DEFAULT_PIXELS_RASTER_FACTOR
+    record("pixel_to_count", lambda: (
+        tbb1_engine.pixel_to_count(si_image, FACTORS["counts_pixel_factor1"], pixels_raster_factor,
+                                   tbb1_engine.SI_ZERO_REPLACEMENT),
+        tbb1_engine.pixel_to_count(total_image, FACTORS["counts_pixel_factor2"], pixels_raster_factor,
+                                   tbb1_engine.TOTAL_ZERO_REPLACEMENT)))
+    si_counts = tbb1_engine.pixel_to_count(si_image, FACTORS["counts_pixel_factor1"], pixels_raster_factor,
+                                           tbb1_engine.SI_ZERO_REPLACEMENT)
+    total_counts = tbb1_engine.pixel_to_count(total_image, FACTORS["counts_pixel_factor2"], pixels_raster_factor,
+                                              tbb1_engine.TOTAL_ZERO_REPLACEMENT)
+    for stage, calibration, normalization in PLOT_BRANCHES:
+        record("plot:" + stage, lambda: tbb1_engine.calibrate(si_counts, total_counts, calibration=calibration,
+                                                              normalization=normalization, **COEFFICIENTS))
+
+    thickness = tbb1_engine.calibrate(si_counts, total_counts, **COEFFICIENTS)
+    x, y = tbb1_engine.axes_mm(thickness.shape, 1.0, 1.0)
+    labels = ("Thickness", "mm", "mm", "nm")
+    record("render:heatmap", lambda: draw(tbb1_render.heatmap_figure(x, y, thickness, "viridis", *labels)[0]))
+    record("render:surface", lambda: draw(tbb1_render.surface_figure(x, y, thickness, "viridis", *labels)[0]))
+    return results
+
+
+# ===== Results files =====
+# =========================
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    """Versions and machine of a run, saved with the results."""
+    return {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "matplotlib": matplotlib.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def load_results(file_path):
+    with open(file_path) as handle:
+        return json.load(handle)
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD, min_time=DEFAULT_MIN_TIME):
+    """
+    Compare two results files (dictionaries). Returns (rows, regressions).
+
+    Each row is (size, stage, baseline time, time, time ratio, baseline peak,
+    peak, peak ratio); only the stages present in both files are compared.
+    """
+    reference = {(r["size"], r["stage"]): r for r in baseline["results"]}
+    rows, regressions = [], []
+    for result in current["results"]:
+        old = reference.get((result["size"], result["stage"]))
+        if old is None:
+            continue
+        time_ratio = result["time"]/old["time"] if old["time"] else float("inf")
+        peak_ratio = result["peak_bytes"]/old["peak_bytes"] if old["peak_bytes"] else 1.0
+        row = (result["size"], result["stage"], old["time"], result["time"], time_ratio,
+               old["peak_bytes"], result["peak_bytes"], peak_ratio)
+        rows.append(row)
+        slower = time_ratio > 1 + threshold and result["time"] - old["time"] > min_time
+        larger = peak_ratio > 1 + threshold and result["peak_bytes"] - old["peak_bytes"] > 1024**2
+        if slower or larger:
+            regressions.append(row)
+    return rows, regressions
+
+
+def print_comparison(rows, regressions):
+    print("%6s %-22s %10s %10s %7s %10s %10s %7s" % ("size", "stage", "base (s)", "time (s)", "ratio",
+                                                      "base (MB)", "peak (MB)", "ratio"))
+    for row in rows:
+        size, stage, old_time, new_time, time_ratio, old_peak, new_peak, peak_ratio = row
+        print("%6d %-22s %10.4f %10.4f %6.2fx %10.1f %10.1f %6.2fx%s" % (
+            size, stage, old_time, new_time, time_ratio, old_peak/1024**2, new_peak/1024**2, peak_ratio,
+            "  REGRESSION" if row in regressions else ""))
+    print("%d regression(s)" % len(regressions))
+
+
+# ===== Command line =====
+# ========================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="image sizes (pixels)")
+    parser.add_argument("--all-sizes", action="store_true", help="128 to 8192 pixels (several GB of memory)")
+    parser.add_argument("--kernels", type=int, nargs="+", default=DEFAULT_KERNELS, help="smoothing kernel sizes")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="JSON file of the results")
+    parser.add_argument("--baseline", help="JSON file of a previous run to compare with")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "RESULTS"),
+                        help="only compare two results files")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="relative slow-down (or memory increase) counted as a regression (default: 0.2)")
+    parser.add_argument("--min-time", type=float, default=DEFAULT_MIN_TIME,
+                        help="ignore time differences below this many seconds (default: 0.005)")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        baseline, current = (load_results(path) for path in args.compare)
+    else:
+        sizes = ALL_SIZES if args.all_sizes else args.sizes
+        print("%6s %-22s %10s %12s" % ("size", "stage", "time (s)", "peak (MB)"))
+        results = []
+        with tempfile.TemporaryDirectory() as directory:
+            for size in sizes:
+                results += benchmark_size(size, args.kernels, args.repeat, directory)
+        current = {"environment": environment(), "repeat": args.repeat, "results": results}
+        if args.output:
+            with open(args.output, "w") as handle:
+                json.dump(current, handle, indent=2)
+        if not args.baseline:
+            return 0
+        baseline = load_results(args.baseline)
+
+    rows, regressions = compare(baseline, current, args.threshold, args.min_time)
+    print_comparison(rows, regressions)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
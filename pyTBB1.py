@@ -13,8 +13,10 @@ Presteps before use it:
     3) Ensure to have all the python libraries needed. Otherwise you need to install them.
     For example scipy is not available directly in all the versions.
     
-    4) Change the molecular library with your coefficients and molecules (line 295 to 305).
+    4) Change the molecular library with your coefficients and molecules (MOLECULE_LIBRARY in tbb1_engine.py).
     If you are not familiar with trees construction in python, you can enter new coefficients directly in the GUI.
+    The molecules of "calibration library.xlsx" are fitted at start-up (tbb1_calibration.py, needs openpyxl).
+    A molecule can have coefficients for other substrate ions (SiOH+, Si2+, Au+): see "Substrate channels" and tbb1_channels.py.
     
     5) If you are facing problems to load images try to use the more adapted format: .png
     
@@ -25,18 +27,28 @@ If you do a wrong operation a message will pop up and guide you in the GUI. Enjo
 
 
 # Import stuff for computations and plotting
+import os
 import numpy as np
-import PIL.Image  
-from PIL import ImageTk, Image                                                              # Avoid namespace issues
-import matplotlib.pyplot as plt
-from matplotlib import cm
-import scipy.signal
+from PIL import ImageTk                                                         # Avoid namespace issues
+
+import tbb1_engine                                                              # Headless computations (load, smooth, convert, calibrate)
+import tbb1_io                                                                  # Image reading with the true counts
+import tbb1_assets                                                              # Illustration and icon, resized once and cached
+import tbb1_dataset                                                             # Loaded image pair and its processed layers
+import tbb1_smoothing
+import tbb1_binning                                                             # Count-adaptive bins (alternative to the box smoothing)
+import tbb1_calibration                                                         # Calibration library (fits of the workbook) and uncertainty maps
+import tbb1_worker                                                              # Computations in a worker thread (window stays responsive)
+import tbb1_instrument                                                          # Time and memory of each stage (status bar, JSON lines)
+import tbb1_export                                                              # Saved maps, intermediates and masks (memory-mapped reopening)
+import tbb1_roi                                                                 # Statistics of the maps over regions of interest
+import tbb1_channels                                                            # Other substrate ions (SiOH+, Si2+, Au+) combined with the Si image
 
 # Import some tkinter things for GUI stuff
 import tkinter as tk
 from tkinter import Tk
 from tkinter import ttk
-from tkinter import Button, Entry, Label, Checkbutton, Scale, Spinbox, LabelFrame
+from tkinter import Button, Entry, Label, Checkbutton, Scale, Spinbox, LabelFrame, Menu, Menubutton
 from tkinter import Frame, CENTER, END, LEFT, W
 from tkinter import filedialog
 from tkinter import messagebox
@@ -71,32 +83,48 @@ class GUI_PyTBB1:
         self.plotframe1 = LabelFrame(self.containerPlot,text = "", bg="white", fg="black", font='15')
         
         # Place Frames in plot container
-        self.plotframe1.place(relwidth=0.90,relheight=0.55, relx=0.05, rely=0.3)
+        self.plotframe1.place(relwidth=0.90,relheight=0.64, relx=0.05, rely=0.34)
+        
+        # Status bar (progress of the computations running in the background)
+        self.containerStatus = Frame(parent)
+        self.containerStatus.place(relwidth=0.96,relheight=0.04, relx=0.02, rely=0.955)
 
         # Instance variables
-        self.I1                = None                                           # Image 1
-        self.I1Orig            = None                                           # Original Image 1
-        self.I1_ar             = None                                           # Image 1 in array format
-        self.I2_ar_sm          = None                                           # Image 1 in array format and smoothed
-        self.I1_ar_con         = None                                           # Image 1 in array format converted in intensity and µm
-        self.I2                = None                                           # Image 2
-        self.I2Orig            = None                                           # Original Image 2
-        self.I2_ar             = None                                           # Image 2 in array format
-        self.I2_ar_con         = None                                           # Image 2 in array format converted with factor counts/pixel
+        self.data              = tbb1_dataset.ImagePair()                       # Si and total images, processed layers (cached) and axes
+        self.converted         = False                                          # True once the conversion in counts and mm is done
         self.chksmooth         = tk.IntVar()                                    # Checkbox for smoothing
         self.chkcalibration    = tk.IntVar()                                    # Checkbox for calibration
         self.chknormalization  = tk.IntVar()                                    # Checkbox for normalization
         self.chknewcoefficient = tk.IntVar()                                    # Checkbox if the user wants new calibration coefficients
         self.chklibrarycoefficient = tk.IntVar()                                # Checkbox if the user wants to use librery coefficients
-        self.X                 = None                                           # X axis for surface plots (in pixels)
-        self.Y                 = None                                           # Y axis for surface plots (in pixels)
-        self.X_con             = None                                           # X axis for surface plots converted in mm
-        self.Y_con             = None                                           # Y axis for surface plots converted in mm
+        self.chkpreview        = tk.IntVar()                                    # Checkbox for the 2D heatmap preview instead of the 3D surface
+        self.chkfullresolution = tk.IntVar()                                    # Checkbox to draw the 3D surfaces at full resolution
+        self.chkuncertainty    = tk.IntVar()                                    # Checkbox for the uncertainty map of the calibration
+        self.chkregistration   = tk.IntVar()                                    # Checkbox to align the total image on the Si image
+        self.molecule          = None                                           # Molecule selected in the library
+        self.library           = tbb1_engine.MOLECULE_LIBRARY                   # Molecular library (fitted from "calibration library.xlsx" once loaded)
+        self.fits              = {}                                             # Fits of the calibration library
+        self.treeCoefficients  = {}                                             # Molecule and coefficients by ion of the items of the tree (not rounded)
+        self.moleculeChannels  = {}                                             # Coefficients by substrate ion of the molecule selected
+        self.channels          = {}                                             # Other substrate channels loaded: ion -> (file path, image)
+        self.channelShown      = tk.StringVar(value = "combined")               # Map shown with substrate channels: combined or one ion
+        self.channelResult     = None                                           # Last maps of the substrate channels (key, result), for a new channel shown
         self.a                 = None
         self.b                 = None
         self.a_norm            = None
         self.b_norm            = None
         self.TBB1              = None
+        self.worker            = tbb1_worker.BackgroundRunner(parent, on_progress = self.ShowProgress,
+                                                              on_error = self.ShowError)
+        parent.protocol("WM_DELETE_WINDOW", self.Close)                         # Stop the worker with the window
+        self.lastView          = None                                           # Map shown in the plot area ("smoothed", "plot", "results")
+        self.lastResult        = None                                           # Map shown and how it was computed (for "Save results")
+        self.liveUpdate        = tbb1_worker.Debouncer(parent, 200, self.Refresh)  # Recompute the map shown once the slider stops
+        self.chkprofile        = tk.IntVar(value = tbb1_instrument.is_enabled())  # Checkbox for the instrumentation of the stages
+        self.profilePolling    = False                                          # True while the status bar shows the stages
+        self.rois              = []                                             # Regions of interest (tbb1_roi.Roi, coordinates in mm)
+        self.roiMap            = None                                           # Map shown (z, x, y) on which the ROIs are evaluated
+        self.roiTables         = None                                           # Summed-area tables of roiMap (built in the worker)
         
         
         # ---------------------------------------------------------------------
@@ -133,11 +161,24 @@ class GUI_PyTBB1:
         self.textImage2File = Entry(self.frame1)
         self.textImage2File.configure(bg = "White", fg = "Black", width = 65)
         
+        # ===== Menu: other substrate channels (SiOH+, Si2+, Au+) =====
+        self.buttonChannels = Menubutton(self.frame1)
+        self.buttonChannels.configure(text="Substrate channels",
+                                        bg = "Steel Blue",
+                                        fg = "White",
+                                        activeforeground = "White",
+                                        activebackground = "Black",
+                                        relief = tk.RAISED)
+        self.menuChannels = Menu(self.buttonChannels, tearoff = 0)
+        self.buttonChannels.configure(menu = self.menuChannels)
+        self.UpdateChannelMenu()
+        
         # ===== Slider: for image smoothing =====
         self.checksmooth = Checkbutton(self.frame1)
         self.checksmooth.configure(text = "Smooth image",
                                        variable = self.chksmooth)
-        self.slider = Scale(self.frame1, from_=3, to=100,  length=500,tickinterval=15, orient=tk.HORIZONTAL)
+        self.slider = Scale(self.frame1, from_=3, to=100,  length=500,tickinterval=15, orient=tk.HORIZONTAL,
+                            command = self.SliderMoved)
         self.buttonSmoothing= Button(self.frame1)
         self.buttonSmoothing.configure(text="Smooth and plot image",
                                         bg = "Steel Blue",
@@ -145,6 +186,9 @@ class GUI_PyTBB1:
                                         activeforeground = "White",
                                         activebackground = "Black",
                                         command = self.plotsmoothed)
+        # ===== Combobox: edge handling of the smoothing, or adaptive bins (target counts per bin = slider) =====
+        self.popSmoothMode = ttk.Combobox(self.frame1, width = 13,
+                                          values = list(tbb1_smoothing.EDGE_MODES) + [tbb1_binning.MODE])
         
         # ====== Information button for the smoothing ===========
         self.buttonLoadQuestion= Button(self.frame1, width= 3)
@@ -169,6 +213,11 @@ class GUI_PyTBB1:
         # ===== free space =====
         self.labelSpace= Label(self.containerCompute,text="",bg = "white", fg="white")
         
+        # ===== Registration of the total image (drift of the stage, other raster size) =====
+        self.checkregistration = Checkbutton(self.containerCompute)
+        self.checkregistration.configure(text = "Align the total image",
+                                       variable = self.chkregistration)
+        
         self.spinboxXsize = Spinbox(self.containerCompute)
         self.spinboxYsize = Spinbox(self.containerCompute)
         self.spinboxCountsPixelFactor1 = Spinbox(self.containerCompute)
@@ -250,6 +299,9 @@ class GUI_PyTBB1:
                                         activebackground = "Black",)
         self.spinboxbnorm = Spinbox(self.containerCompute)
         self.spinboxbnorm.insert(END, 1)
+        for spinbox in (self.spinboxa, self.spinboxanorm, self.spinboxb, self.spinboxbnorm):
+            spinbox.configure(command = self.CoefficientsChanged)                   # arrows of the spinbox
+            spinbox.bind("<KeyRelease>", self.CoefficientsChanged)                  # value typed
         
         self.labelSpace2= Label(self.containerCompute,text="",bg = "white", fg="white")
         self.Labellibrary= Label(self.containerCompute)
@@ -325,19 +377,13 @@ class GUI_PyTBB1:
         self.tree.heading("b", text= "b", anchor= CENTER)
         self.tree.heading("a (norm.)", text= "a (norm.)", anchor= CENTER)
         self.tree.heading("b (norm.)", text= "b (norm.)", anchor= CENTER)
-        # add data in the tree
-        self.tree.insert(parent='', index='end', iid=0, text="Proteins", values=("", "","", ""))
-        self.tree.insert(parent='', index='end', iid=1, text="Polymers", values=("", "","", ""))
-        self.tree.insert(parent='', index='end', iid=2, text="Lipids", values=( "", "","", ""))
-        #add child
-        self.tree.insert(parent='', index='end', iid=3, text="Lysozyme", values=(2000000.0, -0.998, 0.1373, -0.999))
-        self.tree.move('3', '0', '0')
-        self.tree.insert(parent='', index='end', iid=4, text="Bradykinin", values=(1, 2, 1, 2))
-        self.tree.move('4', '0', '0')
-        self.tree.insert(parent='', index='end', iid=5, text="Irganox", values=(1, 2, 1, 2))
-        self.tree.move('5', '1', '0')
+        # add data in the tree (tbb1_engine.MOLECULE_LIBRARY, then the coefficients fitted from the calibration library)
+        self.FillTree()
         # handle the selection of the item in the tree
         self.tree.bind('<<TreeviewSelect>>', self.item_selected)
+        # fit the calibration library in the worker, once the window is shown (no workbook or no openpyxl: library of tbb1_engine)
+        self.worker.submit("Calibration library", self.LoadLibrary, self.ShowLibrary,
+                           on_error = lambda job, error: None)
         
             
         
@@ -362,21 +408,86 @@ class GUI_PyTBB1:
                                         activebackground = "Black",
                                         command = self.Plot)
         
+        self.checkpreview = Checkbutton(self.containerPlot)
+        self.checkpreview.configure(text = "2D preview (fast)     ",
+                                       variable = self.chkpreview)
+        self.checkfullresolution = Checkbutton(self.containerPlot)
+        self.checkfullresolution.configure(text = "Full resolution 3D   ",
+                                       variable = self.chkfullresolution)
+        self.checkuncertainty = Checkbutton(self.containerPlot)
+        self.checkuncertainty.configure(text = "Uncertainty map (fit)",
+                                       variable = self.chkuncertainty)
+        
+        self.buttonSaveResults = Button(self.containerPlot)
+        self.buttonSaveResults.configure(text="Save results",
+                                        bg = "grey",
+                                        fg = "White",
+                                        activeforeground = "White",
+                                        activebackground = "Black",
+                                        command = self.SaveResults)
+        self.buttonOpenResults = Button(self.containerPlot)
+        self.buttonOpenResults.configure(text="Open results",
+                                        bg = "grey",
+                                        fg = "White",
+                                        activeforeground = "White",
+                                        activebackground = "Black",
+                                        command = self.OpenResults)
+        
+        self.buttonRois = Menubutton(self.containerPlot)
+        self.buttonRois.configure(text="Regions of interest",
+                                        bg = "grey",
+                                        fg = "White",
+                                        activeforeground = "White",
+                                        activebackground = "Black",
+                                        relief = tk.RAISED)
+        self.menuRois = Menu(self.buttonRois, tearoff = 0)
+        self.menuRois.add_command(label = "Draw a rectangle", command = lambda: self.DrawRoi("rectangle"))
+        self.menuRois.add_command(label = "Draw a polygon", command = lambda: self.DrawRoi("polygon"))
+        self.menuRois.add_command(label = "Load ROIs...", command = self.LoadRois)
+        self.menuRois.add_command(label = "Save ROIs...", command = self.SaveRois)
+        self.menuRois.add_command(label = "Save ROI statistics...", command = self.SaveRoiStatistics)
+        self.menuRois.add_command(label = "Clear ROIs", command = self.ClearRois)
+        self.buttonRois.configure(menu = self.menuRois)
+        
         self.popColormap = ttk.Combobox(self.containerPlot,
                                         values = ["plasma",
                                                   "jet",
                                                   "bone",
                                                   "viridis"])
+        self.popColormap.bind("<<ComboboxSelected>>", self.ColormapChanged)
         
         # Load illustrative image
         self.labelImage3= Label(self.plotframe1)
 
-        self.TBB1 = PIL.Image.open("TBB1.png")
+        self.TBB1 = tbb1_assets.photo_image("TBB1.png", (310, 305))             # resized at the first start only
+        self.labelImage3.configure(image=self.TBB1, justify = CENTER)
+        self.labelImage3.image = self.TBB1
+        
+        # Plot area (replaces the illustrative image at the first map, matplotlib is imported then)
+        self.mapCanvas = None
+        self.plotframe1.columnconfigure(0, weight = 1)
+        self.plotframe1.rowconfigure(0, weight = 1)
         
-        TBB1 = self.TBB1.resize((310, 305), Image.ANTIALIAS)
-        TBB1 = ImageTk.PhotoImage(TBB1)
-        self.labelImage3.configure(image=TBB1, justify = CENTER)
-        self.labelImage3.image = TBB1
+        # // == // =================== \\ == \\
+        # // == // ==  S T A T U S  == \\ == \\
+        # // == // =================== \\ == \\
+        
+        self.progressbar = ttk.Progressbar(self.containerStatus, orient = tk.HORIZONTAL, length = 400,
+                                           mode = "determinate", maximum = 1.0)
+        self.labelStatus = Label(self.containerStatus, text = "Ready", anchor = W, width = 60)
+        self.checkprofile = Checkbutton(self.containerStatus)
+        self.checkprofile.configure(text = "Profile",
+                                    variable = self.chkprofile,
+                                    command = self.ToggleProfile)
+        self.labelProfile = Label(self.containerStatus, text = "", anchor = W)
+        self.buttonCancel = Button(self.containerStatus)
+        self.buttonCancel.configure(text="Cancel",
+                                        bg = "grey",
+                                        fg = "White",
+                                        activeforeground = "White",
+                                        activebackground = "Black",
+                                        state = tk.DISABLED,
+                                        command = self.worker.cancel)
 
         # ---------------------------------------------------------------------
         # ---------------------------------------------------------------------
@@ -389,10 +500,13 @@ class GUI_PyTBB1:
         self.textImage1File.grid(column = 1, row = 2)
         self.buttonLoadImage2.grid(column = 0, row = 3, sticky = "EW")
         self.textImage2File.grid(column = 1, row = 3)
+        self.buttonChannels.grid(column = 0, row = 4, sticky = "EW")
         self.slider.grid(column = 1, row = 5,rowspan = 2)
         self.buttonLoadQuestion.grid(column = 3, row=5)
         self.buttonSmoothing.grid(column = 0, row = 6, sticky = "EW")
         self.checksmooth.grid(column = 0, row = 5, sticky = "EW")
+        self.popSmoothMode.grid(column = 0, row = 7, sticky = "EW")
+        self.popSmoothMode.current(0)
         # LOAD (frame2)
         self.labelImage1.grid(column = 0, row = 0, sticky = "NESW")
         # LOAD (frame3)
@@ -416,6 +530,7 @@ class GUI_PyTBB1:
         self.buttonComputeQuestion6.grid(column = 1, row=7,sticky="W")
         self.buttonConversion.grid(column = 3, row=1, rowspan = 5, sticky = "NESW")
         self.labelSpace.grid(column = 0, row = 6, sticky = "EW")
+        self.checkregistration.grid(column = 1, row = 6, sticky = "W")
         self.checknewcoefficient.grid(column = 0, row = 7, sticky = "EW")
         self.Labela.grid(column = 0, row = 8, sticky = "EW")
         self.Labelanorm.grid(column = 0, row = 9, sticky = "EW")
@@ -434,7 +549,21 @@ class GUI_PyTBB1:
         self.buttonPlot.grid(column = 1, row=1, rowspan = 2, sticky = "NESW")
         self.popColormap.grid(column = 1, row=3, sticky = "NESW")
         self.popColormap.current(0)
+        self.checkpreview.grid(column = 0, row = 3, sticky = "EW")
+        self.checkfullresolution.grid(column = 0, row = 4, sticky = "EW")
+        self.checkuncertainty.grid(column = 1, row = 4, sticky = "EW")
+        self.buttonSaveResults.grid(column = 0, row = 5, sticky = "EW")
+        self.buttonOpenResults.grid(column = 1, row = 5, sticky = "EW")
+        self.buttonRois.grid(column = 0, row = 6, columnspan = 2, sticky = "EW")
         self.labelImage3.grid(column = 0, row = 4,columnspan = 2, sticky = "NESW")
+        # STATUS
+        self.progressbar.pack(side = LEFT, padx = 5)
+        self.buttonCancel.pack(side = LEFT, padx = 5)
+        self.labelStatus.pack(side = LEFT, padx = 5)
+        self.checkprofile.pack(side = LEFT, padx = 5)
+        self.labelProfile.pack(side = LEFT, padx = 5, fill = tk.X, expand = True)
+        if tbb1_instrument.is_enabled():                                        # TBB1_PROFILE=<file> in the environment
+            self.ShowProfile()
         
         
         
@@ -445,53 +574,26 @@ class GUI_PyTBB1:
         
         file_path = filedialog.askopenfilename(initialdir = "C:/Users/tomasetti/Documents/measurements/SIMS/3D plot (carpet)",
                                        title = "Select Image 1",
-                                       filetypes = (("All Files", "*.jpg;*.png;*.bmp"),
+                                       filetypes = (("All Files", "*.jpg;*.png;*.tif;*.tiff;*.bmp"),
                                                     ("JPG Files", "*.jpg"),
                                                     ("PNG Files", "*.png"),
+                                                    ("TIF Files", "*.tif;*.tiff"),
                                                     ("BMP Files", "*.bmp")))
-#        file_path = filedialog.askopenfilename(initialdir = "C:/Users/Josh/Documents/YouTube_Files/DIY_BOS/",
-#                                               title = "Select Image 1",
-#                                               filetypes = (("All Files", "*.jpg;*.png;*.tif;*.tiff;*.bmp"),
-#                                                            ("JPG Files", "*.jpg"),
-#                                                            ("PNG Files", "*.png"),
-#                                                            ("TIF Files", "*.tif;*.tiff"),
-#                                                            ("BMP Files", "*.bmp")))
+        if not file_path:                                                       # The dialog was cancelled
+            return
         
-        
-        self.I1 = PIL.Image.open(file_path)                                     # Open the image
         self.textImage1File.delete(0,END)                                       # Delete any strings in text box for file name
         self.textImage1File.insert(0,file_path)                                 # Add file name to the text box
-        self.I1Orig = self.I1                                                   # Save original image for plotting
-        self.I1 = self.I1.convert("L")                                          # Convert image to 8-bit black and white (L)
-        self.I1_ar = np.transpose(np.array(self.I1))                            # Convert image to array
-        
+        self.ShowThumbnail(self.labelImage1, file_path, "Preview of the Si image")
+        self.worker.submit("Loading the Si image", lambda job: self.LoadImage("si", file_path),
+                           self.ShowImage1)
         
-        #show the image in the frame2
-        image1 = self.I1Orig.resize((250, 250), Image.ANTIALIAS)
-        image1 = ImageTk.PhotoImage(image1)
-        self.labelImage1.configure(image=image1, justify = CENTER)
-        self.labelImage1.image = image1
+    def ShowImage1(self, Data):
         
-        
-        # create meshgrid for the surface plot
-        self.X = np.arange(0, np.size(self.I1_ar, 1), 1)
-        self.Y = np.arange(0, np.size(self.I1_ar, 0), 1)
-        self.X, self.Y = np.meshgrid(self.X, self.Y)
-
         # Make a surface plot of the first image
-        fig, ax = plt.subplots(subplot_kw={"projection": "3d"})
-        surf = ax.plot_surface(self.X, self.Y, self.I1_ar, cmap=cm.coolwarm,
-                       linewidth=0, antialiased=False)
-
-        # Add a color bar which maps values to colors.
-        fig.colorbar(surf, shrink=0.5, aspect=5)
-        
-        plt.title('Si image intensity')
-        ax.set_xlabel('pixels')
-        ax.set_ylabel('pixels')
-        ax.set_zlabel('pixel intensity')
-
-        plt.show()
+        X, Y = self.data.axes_pixels()
+        self.ShowMap(X, Y, Data, "coolwarm", 'Si image intensity', 'pixels', 'pixels',
+                     'counts' if tbb1_io.has_true_counts(Data) else 'pixel intensity')
         
     # ===== Method: Load Image 2 =====
     # ================================
@@ -500,58 +602,64 @@ class GUI_PyTBB1:
         
         file_path = filedialog.askopenfilename(initialdir = "C:/Users/tomasetti/Documents/measurements/SIMS/3D plot (carpet)",
                                        title = "Select Image 1",
-                                       filetypes = (("All Files", "*.jpg;*.png;*.bmp"),
+                                       filetypes = (("All Files", "*.jpg;*.png;*.tif;*.tiff;*.bmp"),
                                                     ("JPG Files", "*.jpg"),
                                                     ("PNG Files", "*.png"),
+                                                    ("TIF Files", "*.tif;*.tiff"),
                                                     ("BMP Files", "*.bmp")))
-#        file_path = filedialog.askopenfilename(initialdir = "C:/Users/Josh/Documents/YouTube_Files/DIY_BOS/",
-#                                               title = "Select Image 1",
-#                                               filetypes = (("All Files", "*.jpg;*.png;*.tif;*.tiff;*.bmp"),
-#                                                            ("JPG Files", "*.jpg"),
-#                                                            ("PNG Files", "*.png"),
-#                                                            ("TIF Files", "*.tif;*.tiff"),
-#                                                            ("BMP Files", "*.bmp")))
-        
+        if not file_path:                                                       # The dialog was cancelled
+            return
         
-        self.I2 = PIL.Image.open(file_path)                                     # Open the image
         self.textImage2File.delete(0,END)                                       # Delete any strings in text box for file name
         self.textImage2File.insert(0,file_path)                                 # Add file name to the text box
-        self.I2Orig = self.I2                                                   # Save original image for plotting
-        self.I2 = self.I2.convert("L")                                          # Convert image to 8-bit black and white (L)
-        self.I2_ar = np.transpose(np.array(self.I2))                            # Convert image into array
+        self.ShowThumbnail(self.labelImage2, file_path, "Preview of the total image")
+        self.worker.submit("Loading the total image", lambda job: self.LoadImage("total", file_path))
         
-        #show the image in the frame3
-        image2 = self.I2Orig.resize((250, 250), Image.ANTIALIAS)
-        image2 = ImageTk.PhotoImage(image2)
-        self.labelImage2.configure(image=image2, justify = CENTER)
-        self.labelImage2.image = image2
+    # ===== Method: load an image (worker thread) =====
+    # =================================================
+    
+    def LoadImage(self, channel, file_path):
+        # Runs in the worker: open the image as an array (counts kept, memory-mapped TIFF)
+        return self.data.load(channel, file_path)
+
+    # ===== Method: preview of an image =====
+    # =======================================
+
+    def ShowThumbnail(self, Label, file_path, Name):
+        # A file opened before is shown at once (cache), else its preview is decoded at reduced resolution in the worker
+        Thumbnail = tbb1_assets.cached_thumbnail(file_path)
+        if Thumbnail is not None:
+            self.ShowPreview(Label, Thumbnail)
+        else:
+            self.worker.submit(Name, lambda job: tbb1_assets.thumbnail(file_path),
+                               lambda Thumbnail: self.ShowPreview(Label, Thumbnail),
+                               on_error = lambda job, error: None)              # The loading reports unreadable files
+        
+    def ShowPreview(self, Label, Thumbnail):
+        Thumbnail = ImageTk.PhotoImage(Thumbnail)
+        Label.configure(image=Thumbnail, justify = CENTER)
+        Label.image = Thumbnail
         
     # ===== Method: smoothing =====
     # ================================
             
     def plotsmoothed(self):
         
-        if (self.chksmooth.get()):
+        if self.data.si is None:
+            messagebox.showinfo ("warning","Before, you need to load the Si image")
+        elif (self.chksmooth.get()):
             
-            Kernel_size = self.slider.get()                                                  # accessing the slider value
-            kernel = np.ones((Kernel_size,Kernel_size),np.float32)/(Kernel_size**2)
-            # convolve 2d the kernel with each channel
-            self.I1_ar_sm = scipy.signal.convolve2d(self.I1_ar/255, kernel, mode='same')
-            self.I1_ar_sm = self.I1_ar_sm*255
-            # Make a surface plot of the smooted datas
-            fig, ax = plt.subplots(subplot_kw={"projection": "3d"})
-            surf = ax.plot_surface(self.X, self.Y, self.I1_ar_sm, cmap=cm.coolwarm,
-                       linewidth=0, antialiased=False)
-
-            # Add a color bar which maps values to colors.
-            fig.colorbar(surf, shrink=0.5, aspect=5)
-        
-            plt.title('Si image smoothed intensity')
-            ax.set_xlabel('pixels')
-            ax.set_ylabel('pixels')
-            ax.set_zlabel('pixel intensity')
-
-            plt.show()
+            try:
+                Parameters = self.SmoothingParameters()                                      # accessing the slider value
+            except ValueError:
+                messagebox.showinfo ("warning","Please check if the counts/pixels factor of the Si image is a number")
+                return
+            self.lastView = "smoothed"
+            # average the image in a Kernel_size box (in the worker), then make a surface plot of the smooted datas
+            self.worker.submit("Smoothing", lambda job: self.ComputeLayer("smoothed", Parameters, job),
+                               lambda Smoothed: self.ShowMap(*self.data.axes_pixels(), Smoothed, "coolwarm",
+                                                             'Si image smoothed intensity',
+                                                             'pixels', 'pixels', 'pixel intensity'))
             
         elif self.chksmooth.get()==0:
             
@@ -564,46 +672,182 @@ class GUI_PyTBB1:
         
     def PixelToCount(self):
         
-        if self.I1_ar is None:
+        if self.data.si is None:
             messagebox.showinfo ("warning","Before, you need to load the Si image")
-        elif self.I2_ar is None:
+        elif self.data.total is None:
             messagebox.showinfo ("warning","Before, you need to load the total image")
         else:
-            if (self.chksmooth.get()):
-                Data = self.I1_ar_sm
-            elif self.chksmooth.get()==0:
-                Data = self.I1_ar
-        
-            try:
-                Xsize = float(self.spinboxXsize.get())
-                Ysize = float(self.spinboxYsize.get())
-                CountsPixelFactor1 = float(self.spinboxCountsPixelFactor1.get())
-                CountsPixelFactor2 = float(self.spinboxCountsPixelFactor2.get())
-                PixelsRasterFactor = float(self.EditPixelRasterFactor.get())
-            except:
-                messagebox.showinfo ("warning","Please check if your factors are numbers")
-                
-            self.X_con = np.linspace(0,Xsize,num=np.size(self.I1_ar, 1))            # create x axis in mm (conversion from pixel)
-            self.Y_con = np.linspace(0,Ysize,num=np.size(self.I1_ar, 0))            # create y axis in mm (conversion from pixel)
-            self.X_con, self.Y_con = np.meshgrid(self.X_con, self.Y_con)            # create a grid for the surface plot
-            self.I1_ar_con = Data*CountsPixelFactor1*PixelsRasterFactor             # Apply the conversion factors to first image
-            self.I2_ar_con = self.I2_ar*CountsPixelFactor2*PixelsRasterFactor       # Apply the conversion factors to second image
-            self.I2_ar_con=np.where(self.I2_ar_con==0, 1000, self.I2_ar_con)        # Suppress 0 values that causes problem for the normalization
-            self.I1_ar_con=np.where(self.I1_ar_con==0, 1, self.I1_ar_con)           # Suppress 0 values that causes problems for log
-        
-            fig, ax = plt.subplots(subplot_kw={"projection": "3d"})
-            surf = ax.plot_surface(self.X_con, self.Y_con, self.I1_ar_con/PixelsRasterFactor, cmap=cm.coolwarm,
-                                   linewidth=0, antialiased=False)
-        
-            plt.title('Si intensity')
-            ax.set_xlabel('mm')
-            ax.set_ylabel('mm')
-            ax.set_zlabel('Counts')
+            Parameters = self.ConversionParameters()
+            if Parameters is None:
+                return
+            # Apply the conversion factors (to the smoothed image if smoothing is checked) and suppress 0 values
+            # that cause problems for the log and the normalization. Only the images whose factors changed are recomputed.
+            self.worker.submit("Conversion", lambda job: self.ComputeLayer("si_counts", Parameters, job),
+                               self.ShowConversion)                             # the total image is converted when needed
+            
+    def ShowConversion(self, Counts):
+        self.converted = True
+        X_con, Y_con = self.data.axes_mm()
+        Intensity = Counts/self.data.graph.parameters["pixels_raster_factor"]
+        self.lastResult = dict(name = "si_intensity", map = Intensity, stage = "si_counts", normalization = False,
+                               parameters = dict(self.data.graph.parameters), title = 'Si intensity', zlabel = 'Counts')
+        self.ShowMap(X_con, Y_con, Intensity, "coolwarm", 'Si intensity', 'mm', 'mm', 'Counts')
+
+    # ===== Method: compute a layer (worker thread) =====
+    # ===================================================
+
+    def ComputeLayer(self, stage, Parameters, job):
+        # Runs in the worker (one job at a time): the parameters are given to the processing graph here, not while
+        # another job uses them. job.report stops the computation between two stages when Cancel is pressed.
+        self.data.set_parameters(**Parameters)
+        return self.data.layer(stage, job.report)
+
+    def ComputeMap(self, stage, Parameters, Fit, job):
+        Map = self.ComputeLayer(stage, Parameters, job)
+        if Fit is None:
+            return Map
+        job.report(1.0, "uncertainty")
+        return tbb1_calibration.uncertainty_map(Map, Fit)                       # first-order propagation of the fit covariance
+
+    # ===== Method: calibration library =====
+    # =======================================
+
+    def LoadLibrary(self, job):
+        # Fit the calibration curves of "calibration library.xlsx" (next to the script, as TBB1.png) in the worker
+        return tbb1_calibration.load_library()
+
+    def ShowLibrary(self, Library):
+        # The molecule selected before the fit keeps its row: selecting it again gives item_selected the fitted coefficients
+        Selected = [(self.treeCoefficients[item][0], self.tree.item(item, "text")) for item in self.tree.selection()
+                    if item in self.treeCoefficients]
+        self.library, self.fits = Library
+        self.FillTree()
+        for item_id, (molecule, channels) in self.treeCoefficients.items():
+            if (molecule, self.tree.item(item_id, "text")) in Selected:
+                self.tree.see(item_id)
+                self.tree.selection_set(item_id)                                # <<TreeviewSelect>>: item_selected, then the map shown
+                break
+
+    def FillTree(self):
+        # A molecule shows its Si+ coefficients, the other substrate ions calibrated are rows below it
+        self.tree.delete(*self.tree.get_children())
+        self.treeCoefficients = {}
+        for family, molecules in self.library.items():
+            parent_id = self.tree.insert(parent='', index='end', text=family, values=("", "","", ""))
+            for molecule, entry in molecules.items():
+                channels = tbb1_engine.entry_channels(entry)
+                coefficients = channels.get(tbb1_engine.DEFAULT_ION, (None, None, None, None))
+                item_id = self.tree.insert(parent=parent_id, index='end', text=molecule,
+                                           values=["" if c is None else "%.4g" % c for c in coefficients])
+                self.treeCoefficients[item_id] = (molecule, channels)
+                for ion, coefficients in channels.items():
+                    if ion != tbb1_engine.DEFAULT_ION:
+                        ion_id = self.tree.insert(parent=item_id, index='end', text=ion,
+                                                  values=["" if c is None else "%.4g" % c for c in coefficients])
+                        self.treeCoefficients[ion_id] = (molecule, channels)
+
+    # ===== Method: substrate channels =====
+    # ======================================
 
-            # Add a color bar which maps values to colors.
-            fig.colorbar(surf, shrink=0.5, aspect=5)
+    def LoadChannels(self):
+        # Images of other substrate ions of the same raster, the ion at the end of the name (sample_SiOH.png, sample_Au.png)
+        file_paths = filedialog.askopenfilenames(title = "Select the images of the other substrate ions",
+                                                 filetypes = (("All Files", "*.jpg;*.png;*.tif;*.tiff;*.bmp"),))
+        if not file_paths:                                                      # The dialog was cancelled
+            return
+        Ions = [tbb1_channels.ion_of_file(file_path) for file_path in file_paths]
+        Unknown = [os.path.basename(file_path) for file_path, Ion in zip(file_paths, Ions)
+                   if Ion in (None, tbb1_engine.DEFAULT_ION)]
+        if Unknown:
+            messagebox.showinfo ("warning","The name of these images does not end with the substrate ion (<name>_SiOH, <name>_Si2 or <name>_Au; "
+                                 "the Si image is loaded with \"Load Si image\"):\n%s" % "\n".join(Unknown))
+            return
+        self.worker.submit("Loading the substrate channels",
+                           lambda job: [(Ion, file_path, tbb1_engine.load_image(file_path))
+                                        for Ion, file_path in zip(Ions, file_paths)],
+                           self.AddChannels)
 
-            plt.show()
+    def AddChannels(self, Loaded):
+        for Ion, file_path, Image in Loaded:
+            self.channels[Ion] = (file_path, Image)
+        self.channelResult = None
+        self.UpdateChannelMenu()
+        messagebox.showinfo ("information :","Substrate channels loaded: %s\nWith the calibration checked, \"Plot\" computes the thickness of every channel "
+                             "and their combination weighted by the counts (coefficients of each ion: molecule selected in the library)."
+                             % ", ".join([tbb1_engine.DEFAULT_ION] + list(self.channels)))
+
+    def UpdateChannelMenu(self):
+        # Loading, map shown (combined thickness or one ion) and clearing of the substrate channels
+        Ions = [tbb1_engine.DEFAULT_ION] + list(self.channels) if self.channels else []
+        if self.channelShown.get() not in ["combined"] + Ions:
+            self.channelShown.set("combined")
+        State = tk.NORMAL if Ions else tk.DISABLED
+        self.menuChannels.delete(0, END)
+        self.menuChannels.add_command(label = "Load substrate channels...", command = self.LoadChannels)
+        self.menuChannels.add_separator()
+        self.menuChannels.add_radiobutton(label = "Show the combined thickness", variable = self.channelShown,
+                                          value = "combined", command = self.ChannelShownChanged, state = State)
+        for Ion in Ions:
+            self.menuChannels.add_radiobutton(label = "Show the %s thickness" % Ion, variable = self.channelShown,
+                                              value = Ion, command = self.ChannelShownChanged)
+        self.menuChannels.add_separator()
+        self.menuChannels.add_command(label = "Clear substrate channels", command = self.ClearChannels, state = State)
+        self.buttonChannels.configure(text = "Substrate channels: %d" % len(Ions) if Ions else "Substrate channels")
+
+    def ChannelShownChanged(self):
+        if self.lastView == "plot":                                             # the maps of the channels are kept: nothing is recomputed
+            self.Plot()
+
+    def ClearChannels(self):
+        self.channels = {}
+        self.channelResult = None
+        self.UpdateChannelMenu()
+
+    # ===== Method: conversion parameters =====
+    # =========================================
+
+    def ConversionParameters(self):
+        # Read the smoothing and conversion parameters for the processing graph (None if they are not numbers)
+        try:
+            Xsize = float(self.spinboxXsize.get())
+            Ysize = float(self.spinboxYsize.get())
+            # The counts/pixels factors are optional (1) for images that already contain counts (16/32-bit, float)
+            CountsPixelFactor1 = self.CountsPixelFactor(self.spinboxCountsPixelFactor1, self.data.si)
+            CountsPixelFactor2 = self.CountsPixelFactor(self.spinboxCountsPixelFactor2, self.data.total)
+            PixelsRasterFactor = float(self.EditPixelRasterFactor.get())
+            Smoothing = self.SmoothingParameters()
+        except:
+            messagebox.showinfo ("warning","Please check if your factors are numbers")
+            return None
+            
+        self.data.xsize, self.data.ysize = Xsize, Ysize                         # size of the image for the x and y axis in mm
+        return dict(Smoothing,
+                    counts_pixel_factor1 = CountsPixelFactor1,
+                    counts_pixel_factor2 = CountsPixelFactor2,
+                    pixels_raster_factor = PixelsRasterFactor,
+                    registration = bool(self.chkregistration.get()))
+
+    def SmoothingParameters(self):
+        # Box smoothing (kernel size = slider) or adaptive bins holding at least the slider value in Si counts.
+        # The bins are made on the values of the image: the target is divided by the counts/pixels factor.
+        Mode = self.popSmoothMode.get()
+        if Mode != tbb1_binning.MODE:
+            return dict(kernel_size = self.slider.get() if self.chksmooth.get() else None,
+                        smooth_mode = Mode, binning_target = None)
+        Target = None
+        if self.chksmooth.get():
+            Factor = self.CountsPixelFactor(self.spinboxCountsPixelFactor1, self.data.si)
+            Target = self.slider.get()/(Factor if Factor > 0 else 1.0)          # no factor yet: grey levels
+        return dict(kernel_size = None, smooth_mode = "same", binning_target = Target)
+
+    # ===== Method: read a counts/pixels factor =====
+    # ===============================================
+
+    def CountsPixelFactor(self, spinbox, data):
+        # An empty (or zero) factor means no conversion for images with true counts
+        if tbb1_io.has_true_counts(data) and float(spinbox.get() or 0) == 0:
+            return 1.0
+        return float(spinbox.get())
 
         # ===== Method: molecule selection in the tree =====
         # ==================================================
@@ -611,10 +855,13 @@ class GUI_PyTBB1:
     def item_selected(self,event):
 
         item = self.tree.selection()[0]
-        self.a = float(self.tree.item(item)['values'][0])
-        self.b = float(self.tree.item(item)['values'][1])
-        self.a_norm = float(self.tree.item(item)['values'][2])
-        self.b_norm = float(self.tree.item(item)['values'][3])
+        if item not in self.treeCoefficients:                                   # A family, not a molecule
+            return
+        self.molecule, self.moleculeChannels = self.treeCoefficients[item]      # a substrate ion row selects its molecule
+        self.a, self.b, self.a_norm, self.b_norm = self.moleculeChannels.get(tbb1_engine.DEFAULT_ION,
+                                                                             (None, None, None, None))
+        if self.lastView == "plot" and not self.chknewcoefficient.get():       # Update the map shown with the new molecule
+            self.liveUpdate()
 
         # ==== Method: Plot graph =====
         # =============================
@@ -634,106 +881,371 @@ class GUI_PyTBB1:
 
     
         # check if the datas were correctly selected
-        if self.I1_ar is None:
+        if self.data.si is None:
             messagebox.showinfo ("warning","Before, you need to load the Si image")
-        elif self.I1_ar_con is None:
+        elif not self.converted:
             messagebox.showinfo ("warning","Before, you need to convert pixels in mm and counts")
         elif (self.a is None and self.b is None and self.a_norm is None and self.b_norm is None):
             messagebox.showinfo ("warning","Before, select a molecule in the library or enter new coefficients")
             
         else:
+            Parameters = self.ConversionParameters()
+            if Parameters is None:
+                return
+            # Only the stages after a changed parameter are recomputed (nothing for a new colormap)
+            Parameters.update(a = self.a, b = self.b, a_norm = self.a_norm, b_norm = self.b_norm)
             if (self.chkcalibration.get()):                                         # If the user wants to apply calibration
                 if (self.chknormalization.get()):                                   # Calibration and normalization
-                
                     #self.I2_ar_con[self.I2_ar_con <= 0] = 0.0000001
-                    I1_ar_con_norm = self.I1_ar_con/self.I2_ar_con
-                    I1_ar_con_norm_cal = np.log(I1_ar_con_norm/self.a_norm)/self.b_norm
-                
-                    # Make a surface plot
-                    fig, ax = plt.subplots(subplot_kw={"projection": "3d"})
-                    surf1 = ax.plot_surface(self.X_con, self.Y_con, I1_ar_con_norm_cal, cmap = self.popColormap.get()
-                                        , linewidth=0, antialiased=False)
-
-                    # Add a color bar which maps values to colors.
-                
-                    fig.colorbar(surf1, shrink=0.5, aspect=5)
-        
-                    plt.title('Thickness (normalized)')
-                    ax.set_xlabel('mm')
-                    ax.set_ylabel('mm')
-                    ax.set_zlabel('nm')
-                    plt.show()
-                
+                    Stage, Title, Zlabel = "thickness_norm", 'Thickness (normalized)', 'nm'
                 else:
-                    I1_ar_con_cal = np.log(self.I1_ar_con/self.a)/self.b
-                
-                    # Make a surface plot
-                    fig, ax = plt.subplots(subplot_kw={"projection": "3d"})
-                    surf = ax.plot_surface(self.X_con, self.Y_con, I1_ar_con_cal, cmap=self.popColormap.get(),
-                                           linewidth=0, antialiased=False)
-
-                    # Add a color bar which maps values to colors.
-                    fig.colorbar(surf, shrink=0.5, aspect=5)
-        
-                    plt.title('Thickness')
-                    ax.set_xlabel('mm')
-                    ax.set_ylabel('mm')
-                    ax.set_zlabel('nm')
-                    plt.show()
-                    
-            elif self.chkcalibration.get()==0:
-                if (self.chknormalization.get()):
-                
-                    I1_ar_con_norm = self.I1_ar_con/self.I2_ar_con
-                
-                    # Make a surface plot
-                    fig, ax = plt.subplots(subplot_kw={"projection": "3d"})
-                    surf = ax.plot_surface(self.X_con, self.Y_con, I1_ar_con_norm, cmap=self.popColormap.get(),
-                                           linewidth=0, antialiased=False)
-
-                    # Add a color bar which maps values to colors.
-                    fig.colorbar(surf, shrink=0.5, aspect=5)
-        
-                    plt.title('Si intensity (normalyzed)')
-                    ax.set_xlabel('mm')
-                    ax.set_ylabel('mm')
-                    ax.set_zlabel('counts')
-                    plt.show()
-                
-                else:
-                
-                    # Make a surface plot
-                    fig, ax = plt.subplots(subplot_kw={"projection": "3d"})
-                    surf = ax.plot_surface(self.X_con, self.Y_con, self.I1_ar, cmap=self.popColormap.get(),
-                                           linewidth=0, antialiased=False)
-
-                    # Add a color bar which maps values to colors.
-                    fig.colorbar(surf, shrink=0.5, aspect=5)
-        
-                    plt.title('Si intensity')
-                    ax.set_xlabel('mm')
-                    ax.set_ylabel('mm')
-                    ax.set_zlabel('counts')
-                    plt.show()
+                    Stage, Title, Zlabel = "thickness", 'Thickness', 'nm'
+            elif (self.chknormalization.get()):
+                Stage, Title, Zlabel = "ratio", 'Si intensity (normalyzed)', 'counts'
+            else:
+                Stage, Title, Zlabel = "si", 'Si intensity', 'counts'
+            
+            # Uncertainty of the thickness due to the calibration fit (molecules of the calibration library)
+            Fit = None
+            if self.chkuncertainty.get():
+                Fit = self.fits.get((self.molecule, bool(self.chknormalization.get()), tbb1_engine.DEFAULT_ION))
+                if not self.chkcalibration.get() or self.chknewcoefficient.get() or Fit is None:
+                    messagebox.showinfo ("warning","The uncertainty map needs the calibration and a molecule of the calibration library (calibration library.xlsx)")
+                    return
+                Title, Zlabel = Title + ' uncertainty (1 s.d.)', 'nm'
+            
+            # Other substrate channels loaded: thickness of each ion and their weighted combination (one pass)
+            Pipeline = None
+            if self.channels and self.chkcalibration.get():
+                if Fit is not None:
+                    messagebox.showinfo ("warning","The uncertainty map is computed for the Si image alone: clear the substrate channels")
+                    return
+                Pipeline = self.ChannelPipeline(Parameters)
+                if Pipeline is None:
+                    return
+            
+            # Compute the map in the worker, then make a surface plot
+            self.lastView = "plot"
+            Colormap = self.popColormap.get()
+            Result = dict(name = "uncertainty" if Fit is not None else Stage, stage = Stage,
+                          normalization = bool(self.chknormalization.get()), parameters = Parameters,
+                          molecule = None if self.chknewcoefficient.get() else self.molecule,
+                          title = Title, zlabel = Zlabel)
+            if Pipeline is None:
+                self.worker.submit("Plot", lambda job: dict(Result, map = self.ComputeMap(Stage, Parameters, Fit, job),
+                                                           registration = self.ComputeRegistration(Result, job)),
+                                   lambda Computed: self.ShowResult(Computed, Colormap))
+                return
+            Shown = self.channelShown.get()
+            Result.update(name = "thickness_channels" if Shown == "combined" else "thickness_" + tbb1_channels.CHANNEL_TAGS[Shown],
+                          title = Title + (" (combined: %s)" % ", ".join(Pipeline.ions) if Shown == "combined" else " (%s)" % Shown),
+                          channel_images = dict({tbb1_engine.DEFAULT_ION: self.data.si_path},
+                                                **{Ion: Channel[0] for Ion, Channel in self.channels.items()}))
+            self.worker.submit("Plot", lambda job: dict(Result, registration = self.ComputeRegistration(Result, job),
+                                                       **self.ComputeChannels(Pipeline, Shown, job)),
+                               lambda Computed: self.ShowResult(Computed, Colormap))
+
+    def ChannelPipeline(self, Parameters):
+        # The Si image and the other substrate channels, with the coefficients of each ion (None after a warning)
+        if {np.shape(Image) for _, Image in self.channels.values()} != {np.shape(self.data.si)}:
+            messagebox.showinfo ("warning","The images of the substrate channels do not have the size of the Si image")
+            return None
+        Coefficients = {Ion: C for Ion, C in self.moleculeChannels.items() if Ion != tbb1_engine.DEFAULT_ION}
+        Pipeline = dict(Parameters)                                             # the bins of the GUI are in image values
+        if Pipeline["binning_target"]:
+            Pipeline["binning_target"] *= Pipeline["counts_pixel_factor1"] or 1.0
+        try:
+            return tbb1_channels.ChannelPipeline([tbb1_engine.DEFAULT_ION] + list(self.channels), Coefficients,
+                                                 normalization = bool(self.chknormalization.get()), **Pipeline)
+        except ValueError as error:
+            messagebox.showinfo ("warning","%s: select a molecule of the library calibrated for all the substrate channels loaded" % error)
+            return None
+
+    def ComputeChannels(self, Pipeline, Shown, job):
+        # Runs in the worker: all the channels in one pass, kept for another channel shown with the same parameters
+        Key = repr((sorted(Pipeline.parameters().items()), self.data.si_path, self.data.total_path,
+                    [(Ion, Channel[0]) for Ion, Channel in self.channels.items()]))
+        if self.channelResult is None or self.channelResult[0] != Key:
+            Stack = np.stack([self.data.si] + [Image for _, Image in self.channels.values()])
+            job.report(0.2, "substrate channels")
+            self.channelResult = (Key, Pipeline.process_arrays(Stack, self.data.total if Pipeline.normalization else None))
+        Computed = self.channelResult[1]
+        Layers = {"thickness_channels": Computed["thickness"]}
+        Layers.update(("thickness_" + tbb1_channels.CHANNEL_TAGS[Ion], Map) for Ion, Map in zip(Computed["ions"], Computed["channels"]))
+        Map = Computed["thickness"] if Shown == "combined" else Computed["channels"][Computed["ions"].index(Shown)]
+        return dict(map = Map, layers = Layers)
+
+    def ComputeRegistration(self, Result, job):
+        # Shift of the total image found by the registration (computed with the normalized map, cached)
+        if not (Result["normalization"] and Result["parameters"]["registration"]):
+            return None
+        return self.ComputeLayer("registration", Result["parameters"], job)
+
+    def ShowResult(self, Result, Colormap):
+        self.lastResult = Result                                                # kept for "Save results"
+        Title = Result["title"]
+        if Result.get("registration") is not None:                              # GUI arrays are transposed: first axis is x
+            Title += "\ntotal image shifted by x %+.2f, y %+.2f pixels" % Result["registration"].shift
+        self.ShowMap(*self.data.axes_mm(), Result["map"], Colormap, Title, 'mm', 'mm', Result["zlabel"])
+
+    # ===== Method: save and open results =====
+    # =========================================
+
+    def SaveResults(self):
+        # The map shown, the Si counts, the normalized ratio and the validity masks with all the parameters,
+        # as memory-mapped .npy files (.tbb1 folder), a compressed .npz or float32 TIFF files (+ a .json sidecar)
+        if self.lastResult is None:
+            messagebox.showinfo ("warning","Before, you need to convert the images or to plot a map")
+            return
+        file_path = filedialog.asksaveasfilename(title = "Save the results",
+                                                 defaultextension = ".tbb1",
+                                                 filetypes = (("Folder of .npy files, fast reopening", "*.tbb1"),
+                                                              ("Compressed NumPy file", "*.npz"),
+                                                              ("Float32 TIFF files", "*.tif")))
+        if not file_path:                                                       # The dialog was cancelled
+            return
+        try:
+            tbb1_export.format_of(file_path)
+        except ValueError as error:
+            messagebox.showinfo ("warning", str(error))
+            return
+        Result = self.lastResult
+        self.worker.submit("Save results", lambda job: self.ExportResults(file_path, Result, job),
+                           lambda sidecar: messagebox.showinfo ("information :","Results saved, reopen them with \"Open results\" and:\n%s" % sidecar))
+
+    def ExportResults(self, file_path, Result, job):
+        # Runs in the worker: the intermediates come from the processing graph (cached, or recomputed from the images)
+        Parameters = Result["parameters"]
+        Layers = {Result["name"]: Result["map"]}
+        Layers.update(Result.get("layers", {}))                                 # maps of the substrate channels
+        for Stage in ("si_counts", "ratio" if Result["normalization"] else None, Result["stage"]):
+            if Stage is not None and Stage not in Layers:
+                Layers[Stage] = self.ComputeLayer(Stage, Parameters, job)
+        Layers.update(tbb1_export.validity_masks(Result["map"], self.ComputeLayer("smoothed", Parameters, job),
+                                                 self.ComputeLayer("binned_total", Parameters, job)
+                                                 if Result["normalization"] else None))
+        job.report(1.0, "writing")
+        Metadata = dict(map = Result["name"], title = Result["title"], zlabel = Result["zlabel"],
+                        xsize = self.data.xsize, ysize = self.data.ysize,
+                        si_image = self.data.si_path, total_image = self.data.total_path,
+                        molecule = Result.get("molecule"), normalization = Result["normalization"],
+                        channel_images = Result.get("channel_images"),
+                        registration = Result["registration"]._asdict() if Result.get("registration") else None,
+                        parameters = Parameters)
+        return tbb1_export.export_results(file_path, Layers, Metadata)
+
+    def OpenResults(self):
+        # Results saved by a previous session: the layers are memory-mapped (.tbb1 folder, TIFF), shown at once
+        file_path = filedialog.askopenfilename(title = "Open results",
+                                               filetypes = (("Results (sidecar .json, metadata.json, .npz)", "*.json;*.npz"),))
+        if not file_path:                                                       # The dialog was cancelled
+            return
+        self.worker.submit("Open results", lambda job: tbb1_export.load_results(file_path),
+                           lambda Loaded: self.ShowResults(file_path, *Loaded))
+
+    def ShowResults(self, file_path, Layers, Content):
+        Metadata = Content["metadata"]
+        Map = Layers[Metadata.get("map", next(iter(Layers)))]
+        x, y = tbb1_engine.axes_mm(np.shape(Map), Metadata.get("xsize", 1.0), Metadata.get("ysize", 1.0))
+        self.lastView, self.lastResult = "results", None                        # not recomputed from the loaded images
+        self.ShowMap(x, y, Map, self.popColormap.get(), "%s (%s)" % (Metadata.get("title", ""), os.path.basename(file_path)),
+                     'mm', 'mm', Metadata.get("zlabel", ""))
               
  
 
+    # ===== Method: show a map =====
+    # ===============================
+
+    def ShowMap(self, x, y, z, cmap, title, xlabel, ylabel, zlabel):
+        # The map is shown in the plot area, updating the figure already there (no new window)
+        import tbb1_render                                                      # matplotlib is imported at the first map (fast start)
+        if self.mapCanvas is None:                                              # First map: the plot area replaces the illustrative image
+            import tbb1_canvas
+            self.mapCanvas = tbb1_canvas.MapCanvas(self.plotframe1)
+            self.labelImage3.grid_remove()
+            self.mapCanvas.widget.grid(column = 0, row = 0, sticky = "NESW")
+            self.mapCanvas.toolbar.grid(column = 0, row = 1, sticky = "EW")
+        # 2D heatmap preview (fast) or 3D surface decimated to a polygon budget (or not)
+        budget = np.size(z) if self.chkfullresolution.get() else tbb1_render.DEFAULT_MAX_POLYGONS
+        self.mapCanvas.show(x, y, z, cmap, title, xlabel, ylabel, zlabel,
+                            preview = bool(self.chkpreview.get()), budget = budget)
+        self.roiMap, self.roiTables = (z, x, y), None                           # the ROIs are evaluated on the map shown
+        if self.rois:
+            self.UpdateRois()
+
+    # ===== Method: regions of interest =====
+    # =======================================
+
+    def DrawRoi(self, Kind):
+        # Rectangles and polygons are drawn with the mouse on the 2D preview (coordinates in mm)
+        if self.mapCanvas is None or self.mapCanvas.kind != "heatmap":
+            messagebox.showinfo ("warning","Before, show a map with \"2D preview (fast)\" checked: the ROIs are drawn on the 2D map")
+            return
+        self.mapCanvas.select(Kind, lambda Geometry: self.AddRois([tbb1_roi.Roi("ROI %d" % (len(self.rois) + 1), Kind, Geometry)]))
+
+    def LoadRois(self):
+        # Rectangles (.csv: name, x0, y0, x1, y1 in mm), rectangles, polygons and masks (.json), or a mask / label image
+        file_path = filedialog.askopenfilename(title = "Load ROIs",
+                                               filetypes = (("ROIs (.json, .csv, mask image)", "*.json;*.csv;*.png;*.tif;*.tiff"),))
+        if not file_path:                                                       # The dialog was cancelled
+            return
+        try:
+            Rois = tbb1_roi.load_rois(file_path)
+        except (OSError, ValueError, KeyError) as error:
+            messagebox.showinfo ("warning","The ROIs could not be read: %s" % error)
+            return
+        self.AddRois(Rois)
+
+    def AddRois(self, Rois):
+        self.rois.extend(Rois)
+        if self.roiMap is not None:
+            self.UpdateRois()
+
+    def UpdateRois(self):
+        # Statistics of all the ROIs on the map shown, written next to their outlines (mean and Rq)
+        Map, Rois = self.roiMap, list(self.rois)
+        self.worker.submit("ROI statistics", lambda job: (Rois, self.ComputeRoiStatistics(Map, Rois, job)),
+                           lambda Computed: self.ShowRois(*Computed))
+
+    def ComputeRoiStatistics(self, Map, Rois, job):
+        # Runs in the worker: the summed-area tables are built once per map, then each rectangle costs O(1)
+        if self.roiTables is None or self.roiTables[0] is not Map:
+            self.roiTables = (Map, tbb1_roi.RoiTables(*Map))
+        job.report(0.5, "statistics")
+        return self.roiTables[1].statistics(Rois)
+
+    def ShowRois(self, Rois, Rows):
+        if not self.rois:                                                       # cleared meanwhile
+            return
+        Labels = ["%s" % Roi.name for Roi in Rois]
+        for Row in Rows:
+            Labels[Row["roi"]] = "%s: %.4g, Rq %.2g" % (Row["name"], Row["mean"], Row["rq"])
+        self.mapCanvas.show_rois(Rois, Labels)
+
+    def SaveRois(self):
+        if not self.rois:
+            messagebox.showinfo ("warning","Before, draw or load ROIs")
+            return
+        file_path = filedialog.asksaveasfilename(title = "Save the ROIs", defaultextension = ".json",
+                                                 filetypes = (("ROIs (rectangles and polygons)", "*.json"),))
+        if file_path:
+            tbb1_roi.save_rois(file_path, self.rois)
+
+    def SaveRoiStatistics(self):
+        # Number of pixels, mean, standard deviation, Rq and Ra of each ROI on the map shown, in a CSV file
+        if not self.rois or self.roiMap is None:
+            messagebox.showinfo ("warning","Before, show a map and draw or load ROIs")
+            return
+        file_path = filedialog.asksaveasfilename(title = "Save the ROI statistics", defaultextension = ".csv",
+                                                 filetypes = (("CSV file", "*.csv"),))
+        if not file_path:                                                       # The dialog was cancelled
+            return
+        Map, Rois = self.roiMap, list(self.rois)
+        self.worker.submit("Save ROI statistics",
+                           lambda job: tbb1_roi.save_statistics(file_path, self.ComputeRoiStatistics(Map, Rois, job)),
+                           lambda Saved: messagebox.showinfo ("information :","ROI statistics saved in:\n%s" % file_path))
+
+    def ClearRois(self):
+        self.rois = []
+        if self.mapCanvas is not None:
+            self.mapCanvas.stop_selection()
+            self.mapCanvas.show_rois([], [])
+
+    # ===== Method: live update of the map shown =====
+    # ================================================
+
+    def SliderMoved(self, value):
+        # Dragging the slider recomputes the map shown once it stops (200 ms), not for every value
+        if self.chksmooth.get() and self.lastView is not None:
+            self.liveUpdate()
+
+    def CoefficientsChanged(self, event = None):
+        if self.lastView != "plot" or not self.chknewcoefficient.get():
+            return
+        try:                                                                    # Wait for a complete number
+            for spinbox in (self.spinboxa, self.spinboxanorm, self.spinboxb, self.spinboxbnorm):
+                float(spinbox.get())
+        except ValueError:
+            return
+        self.liveUpdate()
+
+    def ColormapChanged(self, event = None):
+        if self.lastView in ("plot", "results"):                                # Only the colours change, nothing is recomputed
+            self.mapCanvas.set_cmap(self.popColormap.get())
+
+    def Refresh(self):
+        if self.lastView == "smoothed":
+            self.plotsmoothed()
+        elif self.lastView == "plot":
+            self.Plot()
+
+    # ===== Method: progress of the worker =====
+    # ==========================================
+
+    def ShowProgress(self, job):
+        # Called by the worker every 50 ms while a job runs, and with None when it is done
+        if job is None:
+            self.progressbar["value"] = 0
+            self.labelStatus.configure(text = "Ready")
+            self.buttonCancel.configure(state = tk.DISABLED)
+        else:
+            self.progressbar["value"] = job.progress
+            self.labelStatus.configure(text = "%s: %s" % (job.name, job.message))
+            self.buttonCancel.configure(state = tk.NORMAL)
+
+    # ===== Method: instrumentation =====
+    # ===================================
+
+    def ToggleProfile(self):
+        # Time, CPU time, peak memory and arrays of each stage in the status bar
+        # (and in the JSON-lines file given by TBB1_PROFILE, if set)
+        if self.chkprofile.get():
+            tbb1_instrument.enable(os.environ.get(tbb1_instrument.ENVIRONMENT_VARIABLE))
+            if not self.profilePolling:
+                self.ShowProfile()
+        else:
+            tbb1_instrument.disable()
+            self.labelProfile.configure(text = "")
+
+    def ShowProfile(self):
+        # Last stage recorded (worker thread or drawing), every 250 ms while the instrumentation is enabled
+        self.profilePolling = tbb1_instrument.is_enabled()
+        if not self.profilePolling:
+            return
+        if tbb1_instrument.RECENT:
+            self.labelProfile.configure(text = tbb1_instrument.summary(tbb1_instrument.RECENT[-1]))
+        self.myParent.after(250, self.ShowProfile)
+
+    def ShowError(self, job, error):
+        messagebox.showinfo ("warning","%s failed: %s" % (job.name, error))
+
+    def Close(self):
+        self.worker.shutdown()
+        self.myParent.destroy()
+
     # ===== Method: Questions =====
     # ================================
     def LoadQuestion(self):
         messagebox.showinfo ("information :","A 2D convolution is used to smooth the image. For that a Kernel filter is used. A kernel filter is a normalized matrix for which the size is determined by the slider (from 3 to 100). \n"
                              "The operation works like this: the kernel matrix goes above a pixel, all the pixels below this kernel ar added (sum of 9 pixels for a matrix 3x3). \n"
-                             "Then, the average is computed, and the central pixel is replaced with the new average value. Finally, the kernel matrix moves and this operation is continued for all the pixels in the image. \n")
+                             "Then, the average is computed, and the central pixel is replaced with the new average value. Finally, the kernel matrix moves and this operation is continued for all the pixels in the image. \n"
+                             "The average is computed with running sums, so a large kernel is as fast as a small one. \n"
+                             "At the edges of the image, the missing pixels are zeros (same), a mirror of the image (reflect) or copies of the edge pixels (nearest). \n"
+                             "With \"%s\", the image is instead cut in square bins as small as possible holding at least the slider value in Si counts (quadtree, from 64x64 pixels down to single pixels): "
+                             "the dark areas are averaged over large bins and the bright ones keep their resolution, so the film edges stay sharp. "
+                             "The thickness is then computed per bin (also the normalized one, with the total counts of the same bins)." % tbb1_binning.MODE)
     def ComputeQuestion1(self):
         messagebox.showinfo ("information :","X size is the length of the image in mm. \n It's used to convert the initial length of the image (in pixel) to mm.")
     def ComputeQuestion2(self):
         messagebox.showinfo ("information :","Y size is the length of the image in mm. \n It's used to convert the initial length of the image (in pixel) to mm.")
     def ComputeQuestion3(self):
         messagebox.showinfo ("information :","This factor is used to convert the pixel intensity of the Si image in counts. \n"
-                             "For that, you need to divide the maximun intensity in counts (e.g. Max = 33 counts) by the intensity max of the 8-bit image (e.i. 255).")
+                             "For that, you need to divide the maximun intensity in counts (e.g. Max = 33 counts) by the intensity max of the 8-bit image (e.i. 255). \n"
+                             "If the image already contains counts (16-bit, 32-bit or float TIFF), leave 0 and the counts are used as they are.")
     def ComputeQuestion4(self):
         messagebox.showinfo ("information :","This factor is used to convert the pixel intensity of the total image in counts. \n"
-                             "For that, you need to divide the maximun intensity in counts (e.g. Max = 8000 counts) by the intensity max of the 8-bit image (e.i. 255).")
+                             "For that, you need to divide the maximun intensity in counts (e.g. Max = 8000 counts) by the intensity max of the 8-bit image (e.i. 255). \n"
+                             "If the image already contains counts (16-bit, 32-bit or float TIFF), leave 0 and the counts are used as they are.")
     def ComputeQuestion5(self):
         messagebox.showinfo ("information :","This factor is the pixel size of the raster used for the calibration (128x128=16384). \n"
                              "This factor is applied because the calibration was done with raster (therefore with an intensity 16384 times higher. If the calibration is done with pixels intensities this factor should be equal to one.")
@@ -744,10 +1256,11 @@ class GUI_PyTBB1:
 
 
 
-root = Tk()
-root.wm_title("3D mapping of the sample thickness from ToF-SIMS images (pyTBB1)")                                        # Set window title
-root.iconbitmap("icon.ico")                                                     # Set icon bitmap
-root.geometry("1800x700")
-#root.configure(bg="#263D42")
-gui_pyTBB1 = GUI_PyTBB1(root)                                                   # Instantiate the class GUI_BOS
-root.mainloop()
\ No newline at end of file
+if __name__ == "__main__":
+    root = Tk()
+    root.wm_title("3D mapping of the sample thickness from ToF-SIMS images (pyTBB1)")                                    # Set window title
+    tbb1_assets.set_icon(root, "icon.ico")                                      # Set icon (cached PNG copy outside Windows)
+    root.geometry("1800x700")
+    #root.configure(bg="#263D42")
+    gui_pyTBB1 = GUI_PyTBB1(root)                                               # Instantiate the class GUI_BOS
+    root.mainloop()
\ No newline at end of file
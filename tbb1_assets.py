@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Images of the window (illustration and icon), prepared once and cached.
+
+Opening the 626 x 786 TBB1.png and resampling it at each start delays the
+window. The resized copy is written once as a PNG in the cache directory
+(TBB1_CACHE, else %LOCALAPPDATA%/pyTBB1 or ~/.cache/pyTBB1) and the next
+starts give it directly to tk.PhotoImage (Tk reads PNG itself: no decoding
+and no resampling by PIL). The cached file is rebuilt when the source image
+changes (path, size and modification time are in its name). If the cache
+cannot be written, the image is resized in memory as before.
+
+The previews of the loaded images (thumbnails) are made from a reduced
+decoding of the file (tbb1_io.read_reduced: a few hundred thousand pixels
+are read instead of the whole mosaic) and cached by path and modification
+time, in memory and as PNG files in the cache directory: reopening a file
+shows its preview at once. Colour images keep their colours
+(tbb1_io.colour_preview).
+"""
+
+import hashlib
+import os
+import sys
+import threading
+import tkinter as tk
+from collections import OrderedDict
+
+import PIL.Image
+
+import tbb1_io
+
+
+CACHE_VARIABLE = "TBB1_CACHE"                                                   # Cache directory (environment variable)
+THUMBNAIL_SIZE = (250, 250)                                                     # Previews of the loaded images
+MAX_THUMBNAILS = 32                                                             # Thumbnails kept in memory
+THUMBNAIL_VERSION = 2                                                           # in the cache key: previews of older versions are made again
+
+_thumbnails = OrderedDict()                                                     # PNG path in the cache: image
+_lock = threading.Lock()                                                        # Thumbnails are made in the worker thread
+
+
+def cache_directory():
+    """Directory of the cached images (not created)."""
+    if os.environ.get(CACHE_VARIABLE):
+        return os.environ[CACHE_VARIABLE]
+    if sys.platform == "win32" and os.environ.get("LOCALAPPDATA"):
+        return os.path.join(os.environ["LOCALAPPDATA"], "pyTBB1")
+    return os.path.join(os.path.expanduser("~"), ".cache", "pyTBB1")
+
+
+def _cache_path(file_path, *details):
+    """File of the cache for an image and details (size, page), changing with the path, size and mtime of the image."""
+    status = os.stat(file_path)
+    key = hashlib.sha1(("%s|%d|%d|%s" % (os.path.abspath(file_path), status.st_size, status.st_mtime_ns,
+                                          "|".join(str(detail) for detail in details))).encode()).hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    return os.path.join(cache_directory(), "%s_%s.png" % (stem, key))
+
+
+def _save(image, cached):
+    """Write an image in the cache (complete files only: several instances may run). False if it cannot be written."""
+    try:
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        temporary = "%s.%d.tmp" % (cached, os.getpid())
+        image.save(temporary, format="PNG")
+        os.replace(temporary, cached)
+    except OSError:
+        return False
+    return True
+
+
+def _resize(file_path, size=None):
+    image = PIL.Image.open(file_path)
+    if size is not None and image.size != tuple(size):
+        image = image.resize(tuple(size), PIL.Image.LANCZOS)                    # LANCZOS is the former ANTIALIAS filter
+    return image
+
+
+def cached_png(file_path, size=None):
+    """
+    Path of a PNG copy of an image (resized to size = (width, height)), made at
+    the first call and reused afterwards. Returns None if it cannot be written.
+    """
+    cached = _cache_path(file_path, size)
+    if os.path.exists(cached):
+        return cached
+    return cached if _save(_resize(file_path, size), cached) else None
+
+
+def photo_image(file_path, size=None, master=None):
+    """tk.PhotoImage of an image (resized to size), from the cache when possible."""
+    cached = cached_png(file_path, size)
+    if cached is not None:
+        try:
+            return tk.PhotoImage(master=master, file=cached)
+        except tk.TclError:                                                     # Tk without PNG support (older than 8.6)
+            pass
+    from PIL import ImageTk
+    return ImageTk.PhotoImage(_resize(file_path, size), master=master)
+
+
+def set_icon(root, file_path):
+    """Icon of the window: the .ico itself on Windows, a cached PNG copy elsewhere (X11 does not read .ico)."""
+    if sys.platform == "win32":
+        root.iconbitmap(file_path)
+        return
+    root.icon = photo_image(file_path, master=root)                             # Keep a reference (Tk does not)
+    root.iconphoto(True, root.icon)
+
+
+# ===== Thumbnails =====
+# ======================
+
+def _thumbnail_path(file_path, size, page):
+    return os.path.join(cache_directory(), "thumbnails",
+                        os.path.basename(_cache_path(file_path, size, page, THUMBNAIL_VERSION)))
+
+
+def _remember(cached, image):
+    with _lock:
+        _thumbnails[cached] = image
+        _thumbnails.move_to_end(cached)
+        while len(_thumbnails) > MAX_THUMBNAILS:
+            _thumbnails.popitem(last=False)
+
+
+def cached_thumbnail(file_path, size=THUMBNAIL_SIZE, page=0):
+    """Thumbnail of an image already made (this session or a previous one), else None. Fast: for the UI thread."""
+    try:
+        cached = _thumbnail_path(file_path, size, page)
+    except OSError:
+        return None
+    with _lock:
+        image = _thumbnails.get(cached)
+    if image is None and os.path.exists(cached):
+        try:
+            with PIL.Image.open(cached) as stored:
+                image = stored.copy()
+        except OSError:
+            return None
+        _remember(cached, image)
+    return image
+
+
+def thumbnail(file_path, size=THUMBNAIL_SIZE, page=0):
+    """
+    PIL preview of an image page, decoded at a reduced resolution and cached:
+    in colour for colour images (tbb1_io.colour_preview), else 8-bit grey (tbb1_io.preview_image).
+    """
+    image = cached_thumbnail(file_path, size, page)
+    if image is None:
+        image = tbb1_io.colour_preview(file_path, size, page)
+        if image is None:
+            image = tbb1_io.preview_image(tbb1_io.read_reduced(file_path, size, page), size)
+        cached = _thumbnail_path(file_path, size, page)
+        _remember(cached, image)
+        _save(image, cached)
+    return image
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+Batch processing of Si / total ion image pairs without the GUI.
+
+The pairs are given either by a manifest (CSV file with the columns "si",
+"total" and optionally "name") or by a directory in which the images are paired
+by name, e.g. "sample1_Si.png" with "sample1_total.png". Each pair is processed
+by tbb1_engine.ThicknessPipeline in a pool of worker processes (one per core by
+default), and each worker writes its results itself:
+    <output>/<name>_thickness.npy    the thickness map (or intensity map)
+    <output>/<name>.json             the run metadata
+A summary of the whole batch is written in <output>/batch.json. With
+--profile FILE, each stage of each pair (loading, smoothing, transform, tiles)
+is also appended to FILE as a JSON line (see tbb1_instrument).
+
+With --memory-budget, the pairs are processed one after the other, each by
+tiles in parallel (see tbb1_tiled): the maps are streamed to their .npy files
+and the memory used does not depend on the size of the images (mosaics).
+
+With --stack, the images are multi-page stacks (one page per scan) and each
+pair gives a volume of maps, one per window of --frame-window frames (see
+tbb1_stack), saved as <output>/<name>_thickness_frames.npy.
+
+With --library, --molecule takes the coefficients fitted from the calibration
+workbook (tbb1_calibration.load_library), as the GUI does, instead of those of
+tbb1_engine.MOLECULE_LIBRARY.
+
+Example:
+    python tbb1_batch.py --directory images --output results --molecule Lysozyme
+                         --xsize 0.5 --ysize 0.5 --counts-si 0.13 --counts-total 31.4
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+import tbb1_calibration
+import tbb1_engine
+import tbb1_instrument
+import tbb1_smoothing
+import tbb1_stack
+import tbb1_tiled
+
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+
+
+# ===== Input pairs =====
+# =======================
+
+def read_manifest(manifest_path):
+    """Read (name, si, total) pairs from a CSV manifest. Relative paths are relative to the manifest."""
+    manifest_path = Path(manifest_path)
+    pairs = []
+    with open(manifest_path, newline="") as handle:
+        for row in csv.DictReader(handle):
+            si = manifest_path.parent / row["si"].strip()
+            total = (row.get("total") or "").strip()
+            total = manifest_path.parent / total if total else None
+            name = (row.get("name") or "").strip() or si.stem
+            pairs.append((name, si, total))
+    return pairs
+
+
+def _stem_key(stem, tag):
+    """Return the sample name of a file stem ending with tag (case insensitive), else None."""
+    if not stem.lower().endswith(tag.lower()):
+        return None
+    return stem[:len(stem) - len(tag)].rstrip("_- .") or stem
+
+
+def pair_directory(directory, si_tag="Si", total_tag="total"):
+    """Pair the images of a directory by name: <name>_<si_tag>.* with <name>_<total_tag>.*"""
+    si_files, total_files = {}, {}
+    for path in sorted(Path(directory).iterdir()):
+        if path.suffix.lower() not in IMAGE_EXTENSIONS:
+            continue
+        key = _stem_key(path.stem, total_tag)
+        if key is not None:
+            total_files[key] = path
+            continue
+        key = _stem_key(path.stem, si_tag)
+        if key is not None:
+            si_files[key] = path
+    return [(name, si, total_files.get(name)) for name, si in sorted(si_files.items())]
+
+
+# ===== Workers =====
+# ===================
+
+def process_pair(pipeline, name, si_path, total_path, output_dir, memory_budget=None, jobs=1, stack=None):
+    """
+    Process one pair in a worker (or by tiles with jobs processes) and write its results. Returns the metadata.
+
+    stack: (window, step) to process the pair as stacks of frames (tbb1_stack).
+    """
+    start = time.perf_counter()
+    output_dir = Path(output_dir)
+    map_path = output_dir / ("%s_thickness%s.npy" % (name, "_frames" if stack else ""))
+    try:
+        with tbb1_instrument.stage("pair", pair=name):
+            if stack:
+                result = tbb1_stack.process_stack(pipeline, si_path, total_path, map_path, *stack,
+                                                  memory_budget=memory_budget or tbb1_stack.DEFAULT_MEMORY_BUDGET)
+            elif memory_budget:
+                result = tbb1_tiled.process_tiled(pipeline, si_path, total_path, map_path, memory_budget, jobs)
+            else:
+                result = pipeline.run(si_path, total_path)
+    except Exception as error:                                                  # Report the failure, keep the batch going
+        return {"name": name, "si_image": os.fspath(si_path),
+                "total_image": os.fspath(total_path) if total_path else None,
+                "error": "%s: %s" % (type(error).__name__, error)}
+    if not memory_budget and not stack:                                         # tiled maps and volumes are already in their file
+        np.save(map_path, result["thickness"])
+    metadata = dict(result["metadata"], name=name, output=os.fspath(map_path),
+                    wall_time=time.perf_counter() - start)
+    with open(output_dir / ("%s.json" % name), "w") as handle:
+        json.dump(metadata, handle, indent=2)
+    return metadata
+
+
+def run_batch(pipeline, pairs, output_dir, jobs=None, memory_budget=None, stack=None):
+    """Process all the pairs with a pool of jobs processes and return the list of metadata."""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    jobs = jobs or os.cpu_count() or 1
+    if stack:                                                                   # one stack per worker, memory_budget each
+        budget = [memory_budget]*len(pairs)
+        if jobs == 1:
+            return [process_pair(pipeline, *pair, output_dir, memory_budget, stack=stack) for pair in pairs]
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(process_pair, [pipeline]*len(pairs), *zip(*pairs), [output_dir]*len(pairs),
+                                     budget, [1]*len(pairs), [stack]*len(pairs)))
+    if memory_budget:                                                           # one pair at a time, its tiles in parallel
+        return [process_pair(pipeline, *pair, output_dir, memory_budget, jobs) for pair in pairs]
+    names, sis, totals = zip(*pairs) if pairs else ((), (), ())
+    if jobs == 1:
+        return [process_pair(pipeline, *pair, output_dir) for pair in pairs]
+    chunksize = max(1, len(pairs)//(4*jobs))                                    # Few large chunks: low IPC overhead, good balance
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(process_pair, [pipeline]*len(pairs), names, sis, totals,
+                                 [output_dir]*len(pairs), chunksize=chunksize))
+
+
+# ===== Command line =====
+# ========================
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Thickness maps of Si / total ion image pairs (pyTBB1 batch mode)")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--manifest", help="CSV file with the columns si, total and optionally name")
+    source.add_argument("--directory", help="directory of images paired by name (<name>_Si.png, <name>_total.png)")
+    parser.add_argument("--si-tag", default="Si", help="end of the Si image names (default: Si)")
+    parser.add_argument("--total-tag", default="total", help="end of the total image names (default: total)")
+    parser.add_argument("--output", required=True, help="output directory")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: all cores)")
+    add_pipeline_arguments(parser)
+    parser.add_argument("--memory-budget", type=float, default=None, metavar="MB",
+                        help="process each pair by tiles using at most MB megabytes (large mosaics)")
+    parser.add_argument("--stack", action="store_true",
+                        help="the images are stacks of frames (multi-page): one map per window of frames")
+    parser.add_argument("--frame-window", type=int, default=1, metavar="N",
+                        help="with --stack, frames summed in each map (default: 1)")
+    parser.add_argument("--frame-step", type=int, default=None, metavar="N",
+                        help="with --stack, frames between two maps (default: the window)")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="append the time, CPU time, peak memory and arrays of each stage to FILE (JSON lines)")
+    return parser
+
+
+def add_pipeline_arguments(parser):
+    """Options of the processing (ThicknessPipeline), shared with tbb1_watch."""
+    parser.add_argument("--xsize", type=float, default=1.0, help="X size of the images in mm")
+    parser.add_argument("--ysize", type=float, default=1.0, help="Y size of the images in mm")
+    parser.add_argument("--counts-si", type=float, default=1.0, help="counts/pixels factor of the Si image")
+    parser.add_argument("--counts-total", type=float, default=1.0, help="counts/pixels factor of the total image")
+    parser.add_argument("--raster-factor", type=float, default=tbb1_engine.DEFAULT_PIXELS_RASTER_FACTOR,
+                        help="pixel/raster factor")
+    parser.add_argument("--smooth", type=int, default=None, metavar="KERNEL",
+                        help="smooth the Si image with a KERNEL x KERNEL box (3 to 100)")
+    parser.add_argument("--smooth-mode", default="same", choices=tbb1_smoothing.EDGE_MODES,
+                        help="edge handling of the smoothing (default: same, i.e. zero padding)")
+    parser.add_argument("--binning", type=float, default=None, metavar="COUNTS",
+                        help="instead of --smooth, average the images over adaptive bins of at least COUNTS Si counts")
+
+    coefficients = parser.add_mutually_exclusive_group()
+    coefficients.add_argument("--molecule", help="use the library coefficients of this molecule")
+    parser.add_argument("--library", nargs="?", const=tbb1_calibration.CALIBRATION_WORKBOOK, metavar="WORKBOOK",
+                        help="library of --molecule fitted from the calibration workbook, as in the GUI "
+                             "(default workbook: %s)" % tbb1_calibration.CALIBRATION_WORKBOOK)
+    coefficients.add_argument("--coefficients", type=float, nargs=4, metavar=("A", "B", "A_NORM", "B_NORM"),
+                              help="calibration coefficients (Counts = a*exp(-b.Thickness))")
+    parser.add_argument("--no-calibration", action="store_true", help="output the Si intensity instead of the thickness")
+    parser.add_argument("--no-normalization", action="store_true", help="do not normalize by the total image")
+    parser.add_argument("--register", action="store_true",
+                        help="align the total image on the Si image (shift and size) before the normalization")
+    parser.add_argument("--float32", action="store_true", help="compute and save the maps in single precision")
+
+
+def pipeline_from_args(args, **parameters):
+    """ThicknessPipeline of the options of add_pipeline_arguments (or of the given parameters: a preset)."""
+    if not parameters:
+        calibration = not args.no_calibration
+        if calibration and args.molecule is None and args.coefficients is None:
+            sys.exit("error: select a molecule (--molecule) or enter coefficients (--coefficients)")
+        a, b, a_norm, b_norm = args.coefficients or (None,)*4
+        parameters = dict(
+            xsize=args.xsize, ysize=args.ysize,
+            counts_pixel_factor1=args.counts_si, counts_pixel_factor2=args.counts_total,
+            pixels_raster_factor=args.raster_factor, kernel_size=args.smooth, smooth_mode=args.smooth_mode,
+            binning_target=args.binning, registration=args.register,
+            a=a, b=b, a_norm=a_norm, b_norm=b_norm, molecule=args.molecule,
+            calibration=calibration, normalization=not args.no_normalization,
+            dtype="float32" if args.float32 else "float64")
+    try:
+        return tbb1_engine.ThicknessPipeline(library=library_from_args(args), **parameters)
+    except KeyError as error:
+        sys.exit("error: %s" % error.args[0])
+    except (TypeError, ValueError) as error:
+        sys.exit("error: %s" % error)
+
+
+def library_from_args(args):
+    """Molecular library of --library (fitted from the workbook), or None for tbb1_engine.MOLECULE_LIBRARY."""
+    if not args.library:
+        return None
+    try:
+        return tbb1_calibration.load_library(args.library)[0]
+    except (ImportError, OSError, ValueError) as error:
+        sys.exit("error: calibration library %s: %s" % (args.library, error))
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    pipeline = pipeline_from_args(args)
+    normalization = pipeline.normalization
+
+    if args.manifest:
+        pairs = read_manifest(args.manifest)
+    else:
+        pairs = pair_directory(args.directory, args.si_tag, args.total_tag)
+    if normalization:
+        missing = [name for name, _, total in pairs if total is None]
+        if missing:
+            sys.exit("error: no total image for %s (use --no-normalization?)" % ", ".join(missing))
+    if not pairs:
+        sys.exit("error: no image found")
+
+    if args.profile:
+        os.environ[tbb1_instrument.ENVIRONMENT_VARIABLE] = args.profile         # also enabled in spawned workers
+        tbb1_instrument.enable(args.profile)
+    start = time.perf_counter()
+    memory_budget = int(args.memory_budget*1024**2) if args.memory_budget else None
+    stack = (args.frame_window, args.frame_step or args.frame_window) if args.stack else None
+    results = run_batch(pipeline, pairs, args.output, args.jobs, memory_budget, stack)
+    elapsed = time.perf_counter() - start
+    failed = [r for r in results if "error" in r]
+    summary = {"pairs": len(pairs), "failed": len(failed), "jobs": args.jobs or os.cpu_count(),
+               "memory_budget": memory_budget, "stack": stack,
+               "wall_time": elapsed, "pairs_per_second": len(pairs)/elapsed if elapsed else None,
+               "parameters": pipeline.parameters(), "results": results}
+    with open(Path(args.output) / "batch.json", "w") as handle:
+        json.dump(summary, handle, indent=2)
+
+    print("%d pairs processed in %.2f s (%d failed)" % (len(pairs), elapsed, len(failed)))
+    for result in failed:
+        print("  %s: %s" % (result["name"], result["error"]), file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Count-adaptive binning of low-count images (quadtree).
+
+With a few tens of counts per pixel, the Si image is mostly Poisson noise
+(relative error 1/sqrt(N)). The box smoothing averages every pixel over the
+same window, so it blurs the film edges of bright areas as much as the noise
+of dark ones. Here the image is cut into square bins, as large as needed and
+no larger:
+    - the image is tiled with max_size x max_size blocks (a power of 2),
+    - a block is split into its four quarters when each quarter (inside the
+      image) holds at least target counts, down to min_size pixels,
+so each bin holds about target counts or more (relative error below
+1/sqrt(target)) and bright areas keep their resolution, down to single
+pixels. Blocks with less than target counts at max_size stay max_size bins.
+
+The sums of every block of a level come from the integral image (four values
+per block) and the levels are processed as whole arrays, so the cost is
+linear in the number of pixels: about 4/3 of the pixels are visited over all
+levels, whatever the target. The bins are anchored on the max_size grid, so
+a transposed image gives the transposed bins, and tiles whose origins are
+multiples of max_size give the bins of the whole image.
+
+The thickness is computed per bin: bins.mean() replaces each pixel of the Si
+(and total) image by the mean of its bin, and the conversion, normalization
+and calibration then give one value per bin (the normalized ratio is the
+ratio of the counts of the bin).
+
+Example:
+    bins = quadtree_bins(si_counts, target=100)
+    si_binned, total_binned = bins.mean(si_counts), bins.mean(total_counts)
+"""
+
+import numpy as np
+
+import tbb1_instrument
+
+
+MODE = "adaptive bins"                                                          # smoothing mode of the GUI using the binning
+MAX_BIN_SIZE = 64                                                               # largest bins (pixels, power of 2)
+MIN_BIN_SIZE = 1
+
+
+class QuadtreeBins:
+    """Bins of an image: bin index of each pixel (labels) and side of each bin (sizes, pixels)."""
+
+    __slots__ = ("labels", "sizes")
+
+    def __init__(self, labels, sizes):
+        self.labels = labels                                                    # int32, shape of the image
+        self.sizes = sizes
+
+    def __len__(self):
+        return len(self.sizes)
+
+    @property
+    def nbytes(self):
+        return self.labels.nbytes + self.sizes.nbytes
+
+    @property
+    def shape(self):
+        return self.labels.shape
+
+    def pixels(self):
+        """Number of pixels of each bin (less than size**2 at the edges of the image)."""
+        return np.bincount(self.labels.ravel(), minlength=len(self))
+
+    def sums(self, data):
+        """Sum of an image over each bin."""
+        if np.shape(data) != self.shape:
+            raise ValueError("The image does not have the size of the bins")
+        return np.bincount(self.labels.ravel(), weights=np.ravel(data), minlength=len(self))
+
+    def values(self, data):
+        """Mean of an image over each bin."""
+        return self.sums(data)/self.pixels()
+
+    def expand(self, values):
+        """Image of the values of the bins (one value per bin)."""
+        return np.asarray(values)[self.labels]
+
+    def mean(self, data):
+        """Image in which each pixel is the mean of its bin (float64)."""
+        return self.expand(self.values(data))
+
+
+def _block_sums(integral, size):
+    """Sums of the size x size blocks of the image (grid anchored at (0, 0), last blocks clipped)."""
+    rows, columns = integral.shape[0] - 1, integral.shape[1] - 1
+    r = np.minimum(np.arange(0, rows + size, size), rows)
+    c = np.minimum(np.arange(0, columns + size, size), columns)
+    corners = integral[np.ix_(r, c)]
+    return corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] + corners[:-1, :-1]
+
+
+def _grid_shape(shape, size):
+    return -(-shape[0]//size), -(-shape[1]//size)
+
+
+def quadtree_bins(image, target, max_size=MAX_BIN_SIZE, min_size=MIN_BIN_SIZE):
+    """
+    Quadtree bins of an image of counts: a block is split while each of its
+    quarters holds at least target counts (see the module docstring).
+    """
+    if max_size < min_size or max_size & (max_size - 1) or min_size & (min_size - 1):
+        raise ValueError("The bin sizes must be powers of 2 with min_size <= max_size")
+    image = np.asarray(image)
+    if image.ndim != 2:
+        raise ValueError("The binning needs a 2D image")
+    with tbb1_instrument.stage("binning", image, target=target) as s:
+        integral = np.zeros((image.shape[0] + 1, image.shape[1] + 1),
+                            dtype=np.int64 if np.issubdtype(image.dtype, np.integer) else np.float64)
+        np.cumsum(image, axis=0, out=integral[1:, 1:])
+        np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+
+        size = max_size
+        active = np.ones(_grid_shape(image.shape, size), dtype=bool)           # blocks of this level to split or keep
+        labels = np.full(active.shape, -1, dtype=np.int32)
+        sizes = []
+        count = 0
+        while True:
+            if size > min_size:
+                quarters = _block_sums(integral, size//2)
+                rows, columns = quarters.shape
+                padded = np.full((2*active.shape[0], 2*active.shape[1]), np.inf)  # quarters outside the image
+                padded[:rows, :columns] = quarters
+                lowest = padded.reshape(active.shape[0], 2, active.shape[1], 2).min(axis=(1, 3))
+                split = active & (lowest >= target)
+            else:
+                split = np.zeros_like(active)
+            leaves = active & ~split
+            n = int(np.count_nonzero(leaves))
+            labels[leaves] = np.arange(count, count + n, dtype=np.int32)
+            sizes.append(np.full(n, size, dtype=np.int32))
+            count += n
+            if not split.any():
+                break
+            size //= 2                                                          # next level: quarters of the split blocks
+            shape = _grid_shape(image.shape, size)
+            active = split.repeat(2, axis=0).repeat(2, axis=1)[:shape[0], :shape[1]]
+            labels = labels.repeat(2, axis=0).repeat(2, axis=1)[:shape[0], :shape[1]]
+        if size > 1:
+            labels = labels.repeat(size, axis=0).repeat(size, axis=1)
+        labels = np.ascontiguousarray(labels[:image.shape[0], :image.shape[1]])
+        return s.output(QuadtreeBins(labels, np.concatenate(sizes)))
+
+
+def bin_images(si, total=None, target=100, max_size=MAX_BIN_SIZE, min_size=MIN_BIN_SIZE):
+    """Si (and total) images with each pixel replaced by the mean of its bin, the bins being made on the Si counts."""
+    bins = quadtree_bins(si, target, max_size, min_size)
+    return bins.mean(si), None if total is None else bins.mean(total)
@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+"""
+Calibration of quantized images with lookup tables.
+
+8-bit images (convert("L")) have at most 256 grey levels, so the Si map has at
+most 256 different thickness values and the normalized map at most 256 x 256
+(one per (Si, total) pair). Instead of a division and a log per pixel, the
+thickness of every possible value is computed once in a table (with
+tbb1_engine.transform, so the values are exactly the ones of the analytic path)
+and the pixels are mapped by integer indexing:
+    - 1D table for the Si image alone, indexed by the grey levels themselves,
+    - 2D table for the normalized map, indexed by si*n_total + total; this
+      index depends only on the images and is computed once (LookupIndex),
+      so a new set of coefficients costs a table of 65 536 values and a take().
+Images that are not integers (smoothed images, float TIFF) or whose range would
+give a table larger than MAX_TABLE_SIZE use the analytic path.
+
+Calibration curves: read_workbook() reads the calibration data of
+"calibration library.xlsx" (thickness measured by ellipsometry against the Si
+signal, normalized or not), fit_series() fits Signal = a*exp(b.Thickness) to
+every molecule (and substrate ion: Si+, SiOH+, ... named in the signal
+header) at once (Gauss-Newton iterations batched over the molecules,
+started from a log-linear fit), with the covariance of (a, b). As in the
+rest of pyTBB1, Thickness = ln(Signal/a)/b, so b is negative.
+uncertainty_map() propagates this covariance to every pixel of a thickness
+map (first order, or Monte Carlo on parameter samples / bootstrap refits).
+"""
+
+import difflib
+import math
+from collections import namedtuple
+
+import numpy as np
+
+import tbb1_engine
+
+
+MAX_TABLE_SIZE = 1 << 16                                                        # values in a table (65 536: all 8-bit pairs)
+
+
+# ===== Index =====
+# =================
+
+class LookupIndex:
+    """Table index of every pixel of a quantized image (or image pair) and the values of each axis of the table."""
+
+    __slots__ = ("index", "si_values", "total_values")
+
+    def __init__(self, index, si_values, total_values=None):
+        self.index = index                                                      # integer array of the shape of the image
+        self.si_values = si_values                                              # grey levels of the rows of the table
+        self.total_values = total_values                                        # grey levels of the columns (None: 1D table)
+
+    @property
+    def nbytes(self):
+        return 0 if self.index is None else self.index.nbytes
+
+    @property
+    def shape(self):
+        """Shape of the table."""
+        if self.total_values is None:
+            return (len(self.si_values),)
+        return (len(self.si_values), len(self.total_values))
+
+
+def _value_range(data):
+    """Smallest and largest value of an integer image, or None if it is not an integer image."""
+    data = np.asarray(data)
+    if data.dtype.kind not in "ui" or data.size == 0:
+        return None
+    if data.dtype.itemsize == 1 and data.dtype.kind == "u":                     # 8-bit: the whole range, no pass over the image
+        return 0, 255
+    return int(data.min()), int(data.max())
+
+
+def lookup_index(si_image, total_image=None, max_size=MAX_TABLE_SIZE):
+    """
+    LookupIndex of an image (or of an image pair for the normalized map), or
+    None when the images are not quantized or the table would be too large.
+    """
+    si_range = _value_range(si_image)
+    if si_range is None:
+        return None
+    n_si = si_range[1] - si_range[0] + 1                                        # table sizes first: no arange of a huge range
+    if total_image is None:
+        if n_si > max_size:
+            return None
+        si_values = np.arange(si_range[0], si_range[1] + 1)
+        if si_range[0] == 0 and np.asarray(si_image).dtype.kind == "u":
+            return LookupIndex(None, si_values)                                 # the grey levels are the index
+        return LookupIndex(_offset(si_image, si_range[0], _index_dtype(n_si)), si_values)
+
+    total_range = _value_range(total_image)
+    if total_range is None or np.shape(total_image) != np.shape(si_image):
+        return None
+    n_total = total_range[1] - total_range[0] + 1
+    if n_si*n_total > max_size:
+        return None
+    si_values = np.arange(si_range[0], si_range[1] + 1)
+    total_values = np.arange(total_range[0], total_range[1] + 1)
+    index = _offset(si_image, si_range[0], _index_dtype(n_si*n_total))
+    index *= n_total
+    index += _offset(total_image, total_range[0], index.dtype)
+    return LookupIndex(index, si_values, total_values)
+
+
+def _offset(image, start, dtype):
+    """image - start in the index dtype, keeping the memory order of the image."""
+    image = np.asarray(image)
+    if 0 <= start <= np.iinfo(dtype).max:                                       # offset of the index dtype: subtract in it
+        return np.subtract(image, start, dtype=dtype, casting="unsafe", order="K")
+    index = np.subtract(image, start, dtype=np.int64, order="K")               # else in a wide signed dtype, then cast
+    return index.astype(dtype, order="K", copy=False)
+
+
+def _index_dtype(size):
+    return np.uint16 if size <= 1 << 16 else np.uint32
+
+
+# ===== Tables =====
+# ==================
+
+def lookup_table(index, counts_pixel_factor1=1.0, counts_pixel_factor2=1.0,
+                 pixels_raster_factor=tbb1_engine.DEFAULT_PIXELS_RASTER_FACTOR, a=None, b=None, a_norm=None, b_norm=None,
+                 calibration=True, normalization=True, dtype=np.float64):
+    """Map value of every entry of the table of a LookupIndex (flattened), computed by tbb1_engine.transform."""
+    if normalization:
+        if index.total_values is None:
+            raise ValueError("The normalization needs the total image")
+        si, total = np.meshgrid(index.si_values, index.total_values, indexing="ij")
+    else:
+        si, total = index.si_values, None
+    table = tbb1_engine.transform(si, total, counts_pixel_factor1, counts_pixel_factor2, pixels_raster_factor,
+                                  a, b, a_norm, b_norm, calibration, normalization, dtype=dtype)
+    return table.ravel()
+
+
+def apply_table(table, index, si_image=None):
+    """Map every pixel through the table (si_image gives the index of 1D tables of 8-bit images)."""
+    pixels = np.asarray(si_image if index.index is None else index.index)
+    if not pixels.flags.c_contiguous and pixels.T.flags.c_contiguous:           # transposed images: keep their memory order
+        return np.take(table, pixels.T).T
+    return np.take(table, pixels)                                               # (take with out= is slower)
+
+
+# ===== Calibration =====
+# =======================
+
+def transform(si_image, total_image=None, counts_pixel_factor1=1.0, counts_pixel_factor2=1.0,
+              pixels_raster_factor=tbb1_engine.DEFAULT_PIXELS_RASTER_FACTOR, a=None, b=None, a_norm=None, b_norm=None,
+              calibration=True, normalization=True, dtype=np.float64, index=None):
+    """
+    Same map as tbb1_engine.transform, through a lookup table when the images are quantized.
+
+    index is the LookupIndex of the images if it is already known (it does not
+    depend on the coefficients).
+    """
+    if normalization and total_image is None:
+        raise ValueError("The normalization needs the total image")
+    if index is None:
+        index = lookup_index(si_image, total_image if normalization else None)
+    if index is None or (normalization and index.total_values is None):
+        return tbb1_engine.transform(si_image, total_image, counts_pixel_factor1, counts_pixel_factor2,
+                                     pixels_raster_factor, a, b, a_norm, b_norm, calibration, normalization,
+                                     dtype=dtype)
+    table = lookup_table(index, counts_pixel_factor1, counts_pixel_factor2, pixels_raster_factor,
+                         a, b, a_norm, b_norm, calibration, normalization, dtype)
+    return apply_table(table, index, si_image)
+
+
+# ===== Calibration library =====
+# ===============================
+
+CALIBRATION_WORKBOOK = "calibration library.xlsx"
+FITTED_FAMILY = "Calibration library"                                           # Family of the fitted molecules not in MOLECULE_LIBRARY
+
+# Calibration data of a molecule: thickness (nm) and signal (ion counts, or ion/total if normalized) of a substrate ion
+Series = namedtuple("Series", ["molecule", "normalized", "thickness", "signal", "ion"],
+                    defaults=(tbb1_engine.DEFAULT_ION,))
+# Fitted curve Signal = a*exp(b.Thickness) with the covariance of (a, b) and the data it was fitted to
+CalibrationFit = namedtuple("CalibrationFit", ["molecule", "normalized", "a", "b", "covariance",
+                                               "residual", "n", "series", "ion"], defaults=(tbb1_engine.DEFAULT_ION,))
+
+
+def read_workbook(file_path=CALIBRATION_WORKBOOK):
+    """
+    Read the calibration series of a workbook.
+
+    Each series is a block of two columns on any sheet: the name of the molecule,
+    a header row ("Thickness" and the signal, e.g. "Si+/Total" for normalized
+    data, "SiOH+" for another substrate ion, see signal_ion) and the data rows
+    until the first empty row. Blocks can be side by side or one below the other.
+    """
+    try:
+        import openpyxl                                                         # Slow import, only needed here: on first use
+    except ImportError:
+        raise ImportError("openpyxl is needed to read the calibration library (pip install openpyxl)") from None
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    series = []
+    try:
+        for sheet in workbook.worksheets:
+            rows = [list(row) for row in sheet.iter_rows(values_only=True)]
+            for i, row in enumerate(rows):
+                for j, value in enumerate(row):
+                    if isinstance(value, str) and value.strip().lower() == "thickness" and j + 1 < len(row):
+                        series.append(_read_series(rows, i, j))
+    finally:
+        workbook.close()
+    return [item for item in series if item is not None]
+
+
+def _read_series(rows, i, j):
+    """Series whose header ("Thickness", signal) is at row i, column j."""
+    molecule = rows[i - 1][j] if i > 0 and j < len(rows[i - 1]) else None
+    signal_name = str(rows[i][j + 1] or "")
+    thickness, signal = [], []
+    for row in rows[i + 1:]:
+        values = row[j:j + 2] if len(row) > j + 1 else []
+        if len(values) < 2 or not all(isinstance(value, (int, float)) for value in values):
+            break
+        thickness.append(float(values[0]))
+        signal.append(float(values[1]))
+    if molecule is None or len(thickness) < 3:
+        return None
+    normalized = "/" in signal_name or "total" in signal_name.lower()
+    return Series(str(molecule).strip(), normalized, np.array(thickness), np.array(signal), signal_ion(signal_name))
+
+
+def signal_ion(signal_name):
+    """Substrate ion of a signal header ("SiOH+/Total", "Si2+ counts", ...), Si+ if none is named."""
+    name = signal_name.split("/")[0].strip().lower()
+    for ion in sorted(tbb1_engine.SUBSTRATE_IONS, key=len, reverse=True):     # SiOH+ and Si2+ before Si+
+        if name.startswith(ion.lower()) or name.startswith(ion[:-1].lower() + " "):
+            return ion
+    return tbb1_engine.DEFAULT_ION
+
+
+# ===== Fits =====
+# ================
+
+def _stack(thickness, signal):
+    """Pad the series to the same length: (M, N) arrays and the weights (0 for padding)."""
+    n = max(len(t) for t in thickness)
+    x = np.zeros((len(thickness), n))
+    y = np.ones((len(thickness), n))
+    w = np.zeros((len(thickness), n))
+    for k, (t, s) in enumerate(zip(thickness, signal)):
+        x[k, :len(t)], y[k, :len(t)], w[k, :len(t)] = t, s, 1.0
+    return x, y, w
+
+
+def fit_curves(x, y, w, iterations=100, tolerance=1e-12):
+    """
+    Least-squares fits of y = a*exp(b*x) for M series at once.
+
+    x, y, w are (M, N) arrays (w: weights, 0 for missing points). Returns a, b
+    (M,), the covariances of (a, b) (M, 2, 2), the residual standard
+    deviations and the numbers of points (M,).
+    """
+    w = w*(y > 0)
+    n = w.sum(axis=1)
+    logy = np.log(np.where(y > 0, y, 1.0))
+    # log-linear start: ln(y) = ln(a) + b*x
+    sx, sy = (w*x).sum(axis=1), (w*logy).sum(axis=1)
+    sxx, sxy = (w*x*x).sum(axis=1), (w*x*logy).sum(axis=1)
+    b = (n*sxy - sx*sy)/(n*sxx - sx**2)
+    a = np.exp((sy - b*sx)/n)
+    for _ in range(iterations):                                                 # Gauss-Newton, all the series together
+        e = np.exp(b[:, None]*x)
+        r = y - a[:, None]*e
+        J = np.stack((e, a[:, None]*x*e), axis=-1)                              # (M, N, 2)
+        JtJ = np.einsum("mni,mn,mnj->mij", J, w, J)
+        step = np.linalg.solve(JtJ, np.einsum("mni,mn,mn->mi", J, w, r)[..., None])[..., 0]
+        a, b = a + step[:, 0], b + step[:, 1]
+        if np.all(np.abs(step) <= tolerance*(1 + np.abs(np.stack((a, b), axis=-1)))):
+            break
+    e = np.exp(b[:, None]*x)
+    J = np.stack((e, a[:, None]*x*e), axis=-1)
+    ssr = (w*(y - a[:, None]*e)**2).sum(axis=1)
+    variance = ssr/np.maximum(n - 2, 1)
+    covariance = variance[:, None, None]*np.linalg.inv(np.einsum("mni,mn,mnj->mij", J, w, J))
+    return a, b, covariance, np.sqrt(variance), n
+
+
+def fit_series(series, min_thickness=None):
+    """Fit every calibration series (see read_workbook) in one batch. Returns a list of CalibrationFit."""
+    if not series:
+        return []
+    thickness, signal = [], []
+    for item in series:
+        keep = item.thickness >= min_thickness if min_thickness is not None else slice(None)
+        thickness.append(item.thickness[keep])
+        signal.append(item.signal[keep])
+    a, b, covariance, residual, n = fit_curves(*_stack(thickness, signal))
+    return [CalibrationFit(item.molecule, item.normalized, float(a[k]), float(b[k]), covariance[k],
+                           float(residual[k]), int(n[k]), item, item.ion)
+            for k, item in enumerate(series)]
+
+
+def match_molecule(name, library=tbb1_engine.MOLECULE_LIBRARY):
+    """Name of the molecule of the library matching name (case and small spelling differences ignored), else name."""
+    names = [molecule for molecules in library.values() for molecule in molecules]
+    lowered = {molecule.lower(): molecule for molecule in names}
+    match = difflib.get_close_matches(name.lower(), list(lowered), n=1, cutoff=0.8)
+    return lowered[match[0]] if match else name
+
+
+def fitted_library(fits, library=tbb1_engine.MOLECULE_LIBRARY):
+    """
+    Copy of the molecular library with the fitted coefficients: (a, b) for the
+    fits of the signal of a substrate ion, (a (norm.), b (norm.)) for the
+    normalized ones. The fits of other ions than Si+ turn the entry into
+    coefficients by ion (see tbb1_engine.library_channels). The molecules that
+    are not in the library are added to FITTED_FAMILY (with None for the
+    coefficients that were not fitted).
+    """
+    fitted = {family: dict(molecules) for family, molecules in library.items()}
+    for fit in fits:
+        molecule = match_molecule(fit.molecule, library)
+        family = next((family for family, molecules in fitted.items() if molecule in molecules), None)
+        if family is None:
+            family = FITTED_FAMILY
+            fitted.setdefault(family, {})[molecule] = {}
+        channels = tbb1_engine.entry_channels(fitted[family][molecule])
+        a, b, a_norm, b_norm = channels.get(fit.ion, (None, None, None, None))
+        if fit.normalized:
+            a_norm, b_norm = fit.a, fit.b
+        else:
+            a, b = fit.a, fit.b
+        channels[fit.ion] = (a, b, a_norm, b_norm)
+        fitted[family][molecule] = tbb1_engine.channels_entry(channels)
+    return fitted
+
+
+def load_library(file_path=CALIBRATION_WORKBOOK, min_thickness=None):
+    """Fit the calibration workbook. Returns the fitted library and the fits by (molecule of the library, normalized, ion)."""
+    fits = fit_series(read_workbook(file_path), min_thickness)
+    library = fitted_library(fits)
+    return library, {(match_molecule(fit.molecule), fit.normalized, fit.ion): fit for fit in fits}
+
+
+# ===== Uncertainty =====
+# =======================
+
+UNCERTAINTY_METHODS = ("linear", "montecarlo", "bootstrap")
+
+
+def uncertainty_map(thickness, fit, method="linear", samples=200, seed=0, chunk_pixels=1 << 16):
+    """
+    Standard deviation of the thickness of every pixel due to the uncertainty of the calibration fit.
+
+    The signal of a pixel is ln(Signal) = ln(a) + b*Thickness, so the map can
+    be computed from the thickness map alone:
+        "linear"      first-order propagation of the covariance of (a, b)
+                      var = (var_a/a^2 + 2*T*cov_ab/a + T^2*var_b)/b^2
+        "montecarlo"  standard deviation over samples of (a, b) drawn from
+                      the covariance
+        "bootstrap"   standard deviation over refits of the calibration data
+                      resampled with replacement (all the refits in one batch)
+    The sampled methods work by blocks of chunk_pixels pixels, so the memory
+    does not grow with the number of samples.
+    """
+    if method not in UNCERTAINTY_METHODS:
+        raise ValueError("Unknown uncertainty method %r (expected one of %s)" % (method, ", ".join(UNCERTAINTY_METHODS)))
+    thickness = np.asarray(thickness, dtype=np.float64)
+    a, b = fit.a, fit.b
+    if method == "linear":
+        (var_a, cov_ab), (_, var_b) = fit.covariance
+        variance = var_a/a**2 + thickness*(2*cov_ab/a) + thickness**2*var_b
+        variance /= b**2
+        return np.sqrt(np.maximum(variance, 0, out=variance), out=variance)
+
+    rng = np.random.default_rng(seed)
+    if method == "montecarlo":
+        parameters = rng.multivariate_normal((a, b), fit.covariance, size=samples)
+    else:
+        points = fit.series.thickness, fit.series.signal
+        picks = rng.integers(0, len(points[0]), size=(samples, len(points[0])))
+        parameters = np.stack(fit_curves(points[0][picks], points[1][picks], np.ones(picks.shape))[:2], axis=-1)
+    parameters = parameters[(parameters[:, 0] > 0) & (parameters[:, 1] != 0)]
+    log_a, inverse_b = np.log(parameters[:, 0]), 1/parameters[:, 1]
+
+    order = "F" if thickness.flags.f_contiguous and not thickness.flags.c_contiguous else "C"  # memory order of the map
+    flat = thickness.ravel(order=order)
+    out = np.empty_like(flat)
+    for start in range(0, flat.size, chunk_pixels):
+        log_signal = math.log(a) + b*flat[start:start + chunk_pixels]
+        sampled = (log_signal[:, None] - log_a)*inverse_b                       # (pixels, samples)
+        out[start:start + chunk_pixels] = sampled.std(axis=1)
+    return out.reshape(thickness.shape, order=order)
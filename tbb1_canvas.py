@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Plot area embedded in the GUI.
+
+plt.subplots() + plt.show() open a new window (figure, canvas and toolbar) for
+every map, and the figures are never closed. MapCanvas keeps one matplotlib
+Figure in a Tk widget for the whole session and updates its artists:
+    - a new map of the same kind (3D surface or 2D heatmap) reuses the axes,
+      the colorbar and the drawn surface/image (new data, limits and colours),
+    - a new colormap only changes the colours (set_cmap), nothing is computed,
+    - the axes are rebuilt only when switching between surface and heatmap.
+The figure is redrawn with draw_idle(), so several updates in a row are drawn
+once when Tk is idle. On the 2D heatmap, rectangles and polygons can be drawn
+with the mouse (select) and the ROIs are outlined with their statistics
+(show_rois, see tbb1_roi).
+"""
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+
+import tbb1_instrument
+import tbb1_render
+
+
+class _Canvas(FigureCanvasTkAgg):
+    """Tk canvas whose drawing is a "render" stage of the instrumentation (see tbb1_instrument)."""
+
+    def draw(self):
+        with tbb1_instrument.stage("render"):
+            super().draw()
+
+
+class MapCanvas:
+    """Persistent figure showing the maps of pyTBB1 in a Tk container."""
+
+    def __init__(self, master, figsize=(3.4, 3.4), dpi=100):
+        self.figure = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = _Canvas(self.figure, master=master)
+        self.toolbar = NavigationToolbar2Tk(self.canvas, master, pack_toolbar=False)
+        self.widget = self.canvas.get_tk_widget()
+        self.kind = None                                                        # "surface" or "heatmap"
+        self.ax = None
+        self.colorbar = None
+        self.lod = None                                                         # LODSurface of the 3D view
+        self.image = None                                                       # AxesImage of the heatmap
+        self.rebuilds = 0                                                       # Number of times the axes were (re)created
+        self.selector = None                                                    # Rectangle or polygon being drawn
+        self.roiArtists = []                                                    # Outlines and labels of the ROIs
+
+    def show(self, x, y, z, cmap, title, xlabel, ylabel, zlabel, preview=False,
+             budget=tbb1_render.DEFAULT_MAX_POLYGONS, method="minmax"):
+        """Show a map as a 3D surface (or a 2D heatmap if preview), updating the current view in place."""
+        kind = "heatmap" if preview else "surface"
+        if kind != self.kind:
+            self._reset(kind)
+        if kind == "heatmap":
+            self._show_heatmap(x, y, z, cmap, method)
+            self.colorbar.set_label(zlabel)
+        else:
+            self._show_surface(x, y, z, cmap, budget, method)
+            self.ax.set_zlabel(zlabel)
+        self.ax.set_title(title)
+        self.ax.set_xlabel(xlabel)
+        self.ax.set_ylabel(ylabel)
+        self.canvas.draw_idle()
+
+    def set_cmap(self, cmap):
+        """Change the colormap of the map shown (no recomputation)."""
+        if self.image is not None:
+            self.image.set_cmap(cmap)
+        if self.lod is not None:
+            self.lod.set_cmap(cmap)
+        self.canvas.draw_idle()
+
+    def select(self, kind, callback):
+        """Draw a "rectangle" or a "polygon" on the heatmap; callback(geometry) with the coordinates of the axes (mm)."""
+        from matplotlib.widgets import PolygonSelector, RectangleSelector
+        if self.kind != "heatmap":
+            raise ValueError("The ROIs are drawn on the 2D heatmap")
+        self.stop_selection()
+
+        def done(geometry):
+            self.selector.set_active(False)                                     # removed at the next selection
+            self.selector.set_visible(False)
+            callback(geometry)
+
+        if kind == "rectangle":
+            self.selector = RectangleSelector(self.ax, lambda press, release: done(
+                (press.xdata, press.ydata, release.xdata, release.ydata)))
+        else:
+            self.selector = PolygonSelector(self.ax, lambda vertices: done(tuple(vertices)))
+
+    def stop_selection(self):
+        if self.selector is not None:
+            self.selector.disconnect_events()
+            for artist in self.selector.artists:
+                artist.remove()
+            self.selector = None
+            self.canvas.draw_idle()
+
+    def show_rois(self, rois, labels):
+        """Outline the rectangle and polygon ROIs on the heatmap with a label each (ROIs of tbb1_roi)."""
+        from matplotlib.patches import Polygon, Rectangle
+        for artist in self.roiArtists:
+            artist.remove()
+        self.roiArtists = []
+        if self.kind != "heatmap":
+            return
+        for roi, label in zip(rois, labels):
+            if roi.kind == "rectangle":
+                x0, y0, x1, y1 = roi.geometry
+                patch = Rectangle((min(x0, x1), min(y0, y1)), abs(x1 - x0), abs(y1 - y0))
+                corner = (min(x0, x1), max(y0, y1))
+            elif roi.kind == "polygon":
+                patch = Polygon(roi.geometry, closed=True)
+                corner = roi.geometry[0]
+            else:
+                continue
+            patch.set(fill=False, edgecolor="white", linewidth=1.0)
+            self.roiArtists.append(self.ax.add_patch(patch))
+            self.roiArtists.append(self.ax.annotate(label, corner, color="white", fontsize=6,
+                                                    verticalalignment="bottom"))
+        self.canvas.draw_idle()
+
+    def _reset(self, kind):
+        if self.lod is not None:
+            self.lod.disconnect()
+        self.stop_selection()
+        self.figure.clear()
+        self.ax = self.figure.add_subplot(projection="3d" if kind == "surface" else None)
+        self.kind = kind
+        self.colorbar = self.lod = self.image = None
+        self.roiArtists = []
+        self.rebuilds += 1
+
+    def _show_heatmap(self, x, y, z, cmap, method):
+        preview = tbb1_render.block_reduce(z, tbb1_render.block_factor(np.shape(z), tbb1_render.DEFAULT_MAX_PIXELS),
+                                           method)
+        x = np.asarray(x)
+        y = np.asarray(y)
+        extent = (x[0], x[-1], y[0], y[-1])
+        low, high = tbb1_render.data_range(preview)
+        if self.image is None:
+            self.image = self.ax.imshow(preview, cmap=cmap, origin="lower", interpolation="nearest", aspect="auto",
+                                        extent=extent, vmin=low, vmax=high)
+            self.colorbar = self.figure.colorbar(self.image, ax=self.ax)
+        else:
+            self.image.set_data(preview)
+            self.image.set_extent(extent)
+            self.image.set_cmap(cmap)
+            self.image.set_clim(low, high)
+
+    def _show_surface(self, x, y, z, cmap, budget, method):
+        if self.lod is None:
+            self.lod = tbb1_render.LODSurface(self.ax, x, y, z, cmap, budget, method)
+            self.lod.draw()
+            self.colorbar = self.figure.colorbar(self.lod.mappable(), ax=self.ax, shrink=0.5, aspect=5)
+        else:
+            self.lod.budget, self.lod.method = budget, method
+            self.lod.set_cmap(cmap)
+            self.lod.set_data(x, y, z)
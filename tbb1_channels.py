@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+"""
+Several substrate ions: one thickness map per channel and their combination.
+
+On other substrates (or to make the estimate more precise), the film is
+measured on several substrate ions at once: Si+, SiOH+, Si2+, Au+
+(tbb1_engine.SUBSTRATE_IONS). Each ion has its own calibration curve,
+Counts = a*exp(-b.Thickness), so the library entries give coefficients by ion
+(tbb1_engine.library_channels; a tuple is the Si+ signal alone). Here:
+    - the N substrate images are loaded as one channel-stacked array
+      (channels, rows, columns), in the orientation of the GUI; the ion of an
+      image is given, or read from the end of its name (<name>_SiOH.png),
+    - the stack is smoothed (or binned) in one call, then converted,
+      normalized by the total image and calibrated in one pass of blocks of
+      rows over the whole stack (channel_transform): each block of the total
+      image is converted once for all the channels, and the coefficients of
+      the channels are broadcast along the channel axis,
+    - in the same pass, the thicknesses of the channels are averaged with
+      weights, per pixel. By default the weight of a channel is the inverse of
+      the variance of its thickness due to the counting statistics
+      (var = (1/N_ion + 1/N_total)/b^2 for N counts in the pixel, Poisson; the
+      counts of a smoothed channel are the ones of the whole box), so the
+      channel with more counts or a steeper calibration counts more; fixed
+      weights can be given instead.
+
+Example:
+    pipeline = ChannelPipeline(ions=("Si+", "SiOH+"), molecule="Lysozyme", kernel_size=5)
+    result = pipeline.run(["sample_Si.png", "sample_SiOH.png"], "sample_total.png")
+    result["thickness"]   # combined map
+    result["channels"]    # map of each channel (channels, rows, columns)
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+import tbb1_batch
+import tbb1_binning
+import tbb1_engine
+import tbb1_instrument
+import tbb1_io
+import tbb1_register
+
+
+# End of the image names of each substrate ion (<name>_SiOH.png), the total image ends with "total"
+CHANNEL_TAGS = {"Si+": "Si", "SiOH+": "SiOH", "Si2+": "Si2", "Au+": "Au"}
+
+
+# ===== Channels =====
+# ====================
+
+def ion_of_file(file_path):
+    """Substrate ion of an image from the end of its name (<name>_SiOH.png: SiOH+), None if there is none."""
+    stem = Path(file_path).stem.lower()
+    for ion, tag in sorted(CHANNEL_TAGS.items(), key=lambda item: len(item[1]), reverse=True):
+        if re.search(r"(^|[_\-. ])%s\+?$" % re.escape(tag.lower()), stem):
+            return ion
+    return None
+
+
+def load_channels(file_paths, page=0):
+    """
+    Load the images of the substrate channels as one array (channels, rows, columns).
+
+    The images are transposed as in the GUI (tbb1_engine.load_image), so the
+    last two axes of the stack are a view of the images in file order.
+    """
+    images = []
+    for file_path in file_paths:
+        with tbb1_instrument.stage("load", file=os.fspath(file_path), page=page) as s:
+            images.append(s.output(tbb1_io.read_image(file_path, page)))
+    if len({np.shape(image) for image in images}) > 1:
+        raise ValueError("The images of the substrate channels do not have the same size")
+    return np.transpose(np.stack(images), (0, 2, 1))
+
+
+def channel_coefficients(ions, coefficients, normalization=True):
+    """a and b (arrays, one value per channel) of the channels, from the coefficients by ion."""
+    a, b = [], []
+    for ion in ions:
+        a_ion, b_ion, a_norm, b_norm = coefficients.get(ion, (None, None, None, None))
+        if normalization:
+            a_ion, b_ion = a_norm, b_norm
+        if a_ion is None or b_ion is None:
+            raise ValueError("No %scalibration coefficients for the %s signal" % (
+                "normalized " if normalization else "", ion))
+        a.append(float(a_ion))
+        b.append(float(b_ion))
+    return np.array(a), np.array(b)
+
+
+# ===== Vectorized transform =====
+# ================================
+
+def channel_transform(stack, total_image=None, counts_pixel_factors=1.0, counts_pixel_factor2=1.0,
+                      pixels_raster_factor=tbb1_engine.DEFAULT_PIXELS_RASTER_FACTOR, a=None, b=None,
+                      normalization=True, weights=None, smoothing_pixels=1, out=None, combined=None,
+                      dtype=np.float64, chunk_bytes=tbb1_engine.DEFAULT_CHUNK_BYTES):
+    """
+    Thickness of every channel and their weighted mean in one pass over the stack.
+
+    stack is (channels, rows, columns); counts_pixel_factors, a and b are one
+    value per channel (or one for all). Each channel gives the map of
+    tbb1_engine.transform with its own factor and coefficients. weights None
+    weighs each pixel of each channel by the inverse of its counting variance
+    (see the module docstring; smoothing_pixels is the number of pixels averaged
+    in each value of the stack, kernel_size**2 after the box smoothing), else
+    one fixed weight per channel. Returns
+    (out, combined): the maps of the channels (channels, rows, columns) and the
+    combined map (rows, columns); the pixels where no channel is finite are NaN.
+    """
+    stack = np.asarray(stack)
+    if stack.ndim != 3:
+        raise ValueError("The substrate channels must be stacked as (channels, rows, columns)")
+    if normalization:
+        if total_image is None:
+            raise ValueError("The normalization needs the total image")
+        if np.shape(total_image) != np.shape(stack)[1:]:
+            raise ValueError("The substrate and total images do not have the same size")
+    if a is None or b is None:
+        raise ValueError("The calibration needs the a and b coefficients")
+    n = len(stack)
+    factors, a, b = (np.broadcast_to(np.asarray(value, dtype=np.float64), (n,)).reshape(n, 1, 1)
+                     for value in (counts_pixel_factors, a, b))
+    if weights is not None:
+        weights = np.broadcast_to(np.asarray(weights, dtype=np.float64), (n,)).reshape(n, 1, 1)
+    total_image = None if total_image is None else np.asarray(total_image)
+    # Transposed images (GUI convention) are processed in the memory order of the files
+    transposed = (not stack.flags.c_contiguous and np.transpose(stack, (0, 2, 1)).flags.c_contiguous
+                  and (total_image is None or total_image.T.flags.c_contiguous))
+    if out is None:                                                             # same memory order as the images
+        out = np.empty(np.shape(stack), dtype=dtype) if not transposed else \
+            np.transpose(np.empty(np.shape(np.transpose(stack, (0, 2, 1))), dtype=dtype), (0, 2, 1))
+    if combined is None:
+        combined = np.empty(np.shape(stack)[1:], dtype=out.dtype) if not transposed else \
+            np.empty(np.shape(stack)[:0:-1], dtype=out.dtype).T
+    dtype = out.dtype
+
+    if transposed:
+        channel_transform(np.transpose(stack, (0, 2, 1)), None if total_image is None else total_image.T,
+                          factors.ravel(), counts_pixel_factor2, pixels_raster_factor, a.ravel(), b.ravel(),
+                          normalization, None if weights is None else weights.ravel(), smoothing_pixels,
+                          np.transpose(out, (0, 2, 1)), combined.T, dtype, chunk_bytes)
+        return out, combined
+
+    columns = int(np.prod(np.shape(stack)[2:]))
+    rows = max(1, chunk_bytes//max(1, dtype.itemsize*n*columns))
+    total_block = np.empty((rows,) + np.shape(stack)[2:], dtype=dtype) if normalization else None
+    weight_block = np.empty((n, rows) + np.shape(stack)[2:], dtype=dtype)
+    sum_block = np.empty((3, rows) + np.shape(stack)[2:], dtype=dtype)
+    b_squared = b**2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for start in range(0, np.shape(stack)[1], rows):
+            o = out[:, start:start + rows]
+            w = weight_block[:, :o.shape[1]]
+            np.multiply(stack[:, start:start + rows], factors, out=o, dtype=dtype)
+            o *= pixels_raster_factor
+            o[o == 0] = tbb1_engine.SI_ZERO_REPLACEMENT
+            if normalization:
+                t = total_block[:o.shape[1]]                                    # converted once for all the channels
+                np.multiply(total_image[start:start + rows], counts_pixel_factor2, out=t, dtype=dtype)
+                t *= pixels_raster_factor
+                t[t == 0] = tbb1_engine.TOTAL_ZERO_REPLACEMENT
+            # Weights (up to a common factor): inverse counting variance of the thickness, 1/var = b^2/(1/N_ion + 1/N_total)
+            sum_weights, product, inverse_total = sum_block[:, :o.shape[1]]
+            if weights is not None:
+                w[...] = weights
+            elif normalization:
+                np.divide(1.0, t, out=inverse_total)                            # once for all the channels
+                np.multiply(o, smoothing_pixels, out=w)
+                np.reciprocal(w, out=w)
+                w += inverse_total
+                np.divide(b_squared, w, out=w)
+            else:
+                np.multiply(o, b_squared, out=w)
+            if normalization:
+                o /= t
+            o /= a
+            np.log(o, out=o)
+            o /= b
+
+            c = combined[start:start + rows]
+            np.sum(w, axis=0, out=sum_weights)
+            c[...] = 0
+            for k in range(n):                                                  # the weights are kept for the pixels below
+                np.multiply(w[k], o[k], out=product)
+                c += product
+            c /= sum_weights
+            bad = ~np.isfinite(c)
+            if bad.any():                                                       # channels without a finite value left out
+                values, pixel_weights = o[:, bad], w[:, bad]
+                finite = np.isfinite(values) & np.isfinite(pixel_weights)
+                pixel_weights[~finite] = 0
+                c[bad] = (pixel_weights*np.where(finite, values, 0)).sum(axis=0)/pixel_weights.sum(axis=0)
+    return out, combined
+
+
+# ===== Pipeline =====
+# ====================
+
+class ChannelPipeline(tbb1_engine.ThicknessPipeline):
+    """
+    ThicknessPipeline of several substrate channels (ions) and the total ion image.
+
+    ions names the channels in the order of the images; coefficients gives the
+    calibration by ion ({ion: (a, b, a_norm, b_norm)}), completed by the
+    library entry of molecule (in library, default tbb1_engine.MOLECULE_LIBRARY)
+    and, for Si+, by a, b, a_norm, b_norm.
+    counts_pixel_factors are the counts/pixels factors of the channels (one
+    per channel, or counts_pixel_factor1 for all); weights fixed weights of the
+    channels (None: counting statistics, see channel_transform). The other
+    parameters are the ones of ThicknessPipeline; the result is always a
+    thickness (calibration).
+    """
+
+    def __init__(self, ions=(tbb1_engine.DEFAULT_ION,), coefficients=None, counts_pixel_factors=None, weights=None,
+                 molecule=None, calibration=True, library=None, **parameters):
+        if not calibration:
+            raise ValueError("The substrate channels are combined as thicknesses: the calibration is needed")
+        channels = tbb1_engine.library_channels(molecule, library) if molecule is not None else {}
+        super().__init__(calibration=True, **parameters)
+        if any(c is not None for c in (self.a, self.b, self.a_norm, self.b_norm)):
+            channels[tbb1_engine.DEFAULT_ION] = (self.a, self.b, self.a_norm, self.b_norm)
+        channels.update({ion: tuple(c) for ion, c in (coefficients or {}).items()})
+        self.molecule = molecule
+        self.ions = [str(ion) for ion in ions]
+        if not self.ions:
+            raise ValueError("At least one substrate channel is needed")
+        unknown = [ion for ion in self.ions if ion not in tbb1_engine.SUBSTRATE_IONS]
+        if unknown:
+            raise ValueError("Unknown substrate ion %s (expected one of %s)" % (
+                ", ".join(unknown), ", ".join(tbb1_engine.SUBSTRATE_IONS)))
+        self.coefficients = {ion: channels.get(ion) for ion in self.ions}
+        channel_coefficients(self.ions, channels, self.normalization)           # all the channels are calibrated
+        if counts_pixel_factors is None:
+            counts_pixel_factors = [self.counts_pixel_factor1]*len(self.ions)
+        self.counts_pixel_factors = [float(f) for f in counts_pixel_factors]
+        self.weights = None if weights is None else [float(w) for w in weights]
+        for values, name in ((self.counts_pixel_factors, "counts/pixels factor"), (self.weights, "weight")):
+            if values is not None and len(values) != len(self.ions):
+                raise ValueError("One %s per substrate channel is needed" % name)
+
+    def process_arrays(self, stack, total_image=None):
+        """
+        Smoothing (or binning), conversion, normalization and calibration of the stacked channels.
+
+        Returns the result of ThicknessPipeline.process_arrays with the combined
+        map as "thickness", the maps of the channels ("channels": channels,
+        rows, columns) and the ions of the channels ("ions").
+        """
+        stack = np.asarray(stack) if np.ndim(stack) == 3 else np.asarray(stack)[None]
+        if len(stack) != len(self.ions):
+            raise ValueError("%d substrate images for %d channels (%s)" % (len(stack), len(self.ions),
+                                                                          ", ".join(self.ions)))
+        timings = {}
+        registration = None
+        if self.registration and self.normalization and total_image is not None:
+            start = time.perf_counter()
+            total_image, registration = tbb1_register.align_pair(stack[0], total_image)
+            timings["registration"] = time.perf_counter() - start
+        start = time.perf_counter()
+        if self.binning_target:                                                 # bins made on the counts of the first channel
+            bins = tbb1_binning.quadtree_bins(stack[0], self.binning_target/self.counts_pixel_factors[0])
+            stack = np.stack([bins.mean(image) for image in stack])
+            total_image = None if total_image is None else bins.mean(total_image)
+        elif self.kernel_size:
+            with tbb1_instrument.stage("smooth", stack, kernel_size=int(self.kernel_size)) as s:
+                stack = s.output(tbb1_engine.smooth_image(stack, int(self.kernel_size), self.smooth_mode))
+        timings["smooth"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        a, b = channel_coefficients(self.ions, self.coefficients, self.normalization)
+        with tbb1_instrument.stage("channel_transform", stack, total_image, channels=len(self.ions)) as s:
+            channels, thickness = s.output(channel_transform(
+                stack, total_image, self.counts_pixel_factors, self.counts_pixel_factor2, self.pixels_raster_factor,
+                a, b, self.normalization, self.weights, int(self.kernel_size or 1)**2, dtype=self.dtype))
+        x, y = tbb1_engine.axes_mm(np.shape(thickness), self.xsize, self.ysize)
+        timings["transform"] = time.perf_counter() - start                     # all the channels and their combination
+        result = {"thickness": thickness, "channels": channels, "ions": list(self.ions), "x": x, "y": y,
+                  "timings": timings}
+        if registration is not None:
+            result["registration"] = registration._asdict()
+        return result
+
+    def run(self, channel_paths, total_path=None):
+        """Load the images of the channels (in the order of ions) and the total image, and process them."""
+        start = time.perf_counter()
+        stack = load_channels(channel_paths)
+        total_image = tbb1_engine.load_image(total_path) if total_path else None
+        load_time = time.perf_counter() - start
+
+        result = self.process_arrays(stack, total_image)
+        result["timings"] = dict(load=load_time, **result["timings"])
+        result["metadata"] = self.metadata(result, channel_paths, total_path)
+        return result
+
+    def metadata(self, result, channel_paths=None, total_path=None):
+        """ThicknessPipeline.metadata with the images and the statistics of each channel."""
+        metadata = super().metadata(result, channel_paths[0] if channel_paths else None, total_path)
+        metadata["channel_images"] = [os.fspath(path) for path in channel_paths] if channel_paths else None
+        metadata["channels"] = {ion: tbb1_engine.map_statistics(channel)
+                                for ion, channel in zip(result["ions"], result["channels"])}
+        return metadata
+
+
+# ===== Command line =====
+# ========================
+
+def _coefficients_argument(text):
+    """ION=A,B,A_NORM,B_NORM (empty values: not fitted)."""
+    ion, _, values = text.partition("=")
+    values = values.split(",")
+    if not ion or len(values) != 4:
+        raise argparse.ArgumentTypeError("expected ION=A,B,A_NORM,B_NORM, got %r" % text)
+    try:
+        return ion.strip(), tuple(float(value) if value.strip() else None for value in values)
+    except ValueError:
+        raise argparse.ArgumentTypeError("the coefficients of %s are not numbers" % ion) from None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Thickness map of several substrate channels (Si+, SiOH+, Si2+, Au+) "
+                                                 "combined with weights")
+    parser.add_argument("images", nargs="+", help="images of the substrate channels (<name>_Si.png, <name>_SiOH.png...)")
+    parser.add_argument("--total", help="total ion image (normalization)")
+    parser.add_argument("--ions", nargs="+", choices=tbb1_engine.SUBSTRATE_IONS,
+                        help="ions of the images, in order (default: from the end of the image names)")
+    parser.add_argument("--output", required=True,
+                        help="output prefix: <output>_thickness.npy (combined), <output>_channels.npy, <output>.json")
+    parser.add_argument("--channel-coefficients", type=_coefficients_argument, action="append", default=[],
+                        metavar="ION=A,B,A_NORM,B_NORM", help="coefficients of one channel (instead of the library)")
+    parser.add_argument("--counts-channels", type=float, nargs="+", metavar="FACTOR",
+                        help="counts/pixels factor of each channel (default: --counts-si for all)")
+    parser.add_argument("--weights", type=float, nargs="+", metavar="WEIGHT",
+                        help="fixed weight of each channel (default: inverse counting variance, per pixel)")
+    tbb1_batch.add_pipeline_arguments(parser)
+    args = parser.parse_args(argv)
+
+    ions = args.ions or [ion_of_file(path) for path in args.images]
+    if None in ions:
+        sys.exit("error: no substrate ion in the name of %s (use --ions)" % args.images[ions.index(None)])
+    if len(ions) != len(args.images):
+        sys.exit("error: %d images for %d ions" % (len(args.images), len(ions)))
+    if args.no_calibration:
+        sys.exit("error: the substrate channels are combined as thicknesses (no --no-calibration)")
+    if not args.no_normalization and not args.total:
+        sys.exit("error: the normalization needs the total image (--total, or --no-normalization)")
+    a, b, a_norm, b_norm = args.coefficients or (None,)*4
+    try:
+        pipeline = ChannelPipeline(
+            ions, dict(args.channel_coefficients), args.counts_channels, args.weights, molecule=args.molecule,
+            library=tbb1_batch.library_from_args(args),
+            xsize=args.xsize, ysize=args.ysize, counts_pixel_factor1=args.counts_si,
+            counts_pixel_factor2=args.counts_total, pixels_raster_factor=args.raster_factor,
+            kernel_size=args.smooth, smooth_mode=args.smooth_mode, binning_target=args.binning,
+            registration=args.register, a=a, b=b, a_norm=a_norm, b_norm=b_norm,
+            normalization=not args.no_normalization, dtype="float32" if args.float32 else "float64")
+    except KeyError as error:
+        sys.exit("error: %s" % error.args[0])
+    except ValueError as error:
+        sys.exit("error: %s" % error)
+
+    try:
+        result = pipeline.run(args.images, args.total)
+    except (OSError, ValueError) as error:
+        sys.exit("error: %s" % error)
+    output = Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    np.save(output.with_name(output.name + "_thickness.npy"), result["thickness"])
+    np.save(output.with_name(output.name + "_channels.npy"), result["channels"])
+    metadata = dict(result["metadata"], name=output.name)
+    with open(output.with_name(output.name + ".json"), "w") as handle:
+        json.dump(metadata, handle, indent=2)
+    print("%s: mean %.4g (%s)" % (output.name, metadata["mean"] if metadata["mean"] is not None else float("nan"),
+                                  ", ".join("%s %.4g" % (ion, statistics["mean"] or float("nan"))
+                                            for ion, statistics in metadata["channels"].items())))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
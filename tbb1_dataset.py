@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Compact model of a loaded Si / total ion image pair.
+
+The raw images are held once (memory-mapped when possible, see tbb1_io) and
+everything else is derived on demand:
+    - the processed layers (smoothed image, counts, ratio, thickness) come from
+      a tbb1_graph.ProcessingGraph whose cache is limited to a few layers of
+      the size of the image (max_layers), so they are recomputed from the raw
+      counts rather than all kept in memory,
+    - the axes are 1D and described by the number of pixels and the size of
+      the image in mm; they are broadcast only by the plots that need them.
+
+For a pair of 8-bit images, the memory is then about 2 bytes per pixel for the
+images plus max_layers float64 layers, instead of the separate copies of the
+images, of each processing step and of four meshgrids.
+"""
+
+import numpy as np
+
+import tbb1_engine
+import tbb1_graph
+
+
+DEFAULT_MAX_LAYERS = 2                                                          # cached float64 layers of the size of the image
+
+
+class ImagePair:
+    """Raw Si and total ion images, their processing graph and their size in mm."""
+
+    __slots__ = ("si", "total", "si_path", "total_path", "xsize", "ysize", "graph", "max_layers")
+
+    def __init__(self, max_layers=DEFAULT_MAX_LAYERS):
+        self.si = None                                                          # Si image (transposed, counts or 8-bit)
+        self.total = None                                                       # Total ion image (transposed)
+        self.si_path = None
+        self.total_path = None
+        self.xsize = None                                                       # Size of the image in mm (None: not converted yet)
+        self.ysize = None
+        self.max_layers = max_layers
+        self.graph = tbb1_graph.ProcessingGraph(max_bytes=0)
+
+    # ===== Loading =====
+
+    def load(self, channel, file_path, page=0):
+        """Load the "si" or "total" image from a file and return it."""
+        data = tbb1_engine.load_image(file_path, page)
+        self.set_image(channel, data, tbb1_graph.file_key(file_path, page))
+        setattr(self, channel + "_path", file_path)
+        return data
+
+    def set_image(self, channel, data, key=None):
+        """Give an already loaded image ("si" or "total")."""
+        if channel not in tbb1_graph.SOURCES:
+            raise ValueError("Unknown channel %r" % channel)
+        setattr(self, channel, data)
+        self.graph.set_source(channel, data, key)
+        self.graph.cache.max_bytes = self.max_layers*np.size(data)*np.dtype(np.float64).itemsize
+
+    # ===== Derived layers =====
+
+    def layer(self, stage, progress=None):
+        """Processed layer of the pair (see tbb1_graph.STAGES), computed if not cached."""
+        return self.graph.result(stage, progress)
+
+    def set_parameters(self, **parameters):
+        """Processing parameters (see tbb1_graph.DEFAULT_PARAMETERS)."""
+        self.graph.set_parameters(**parameters)
+
+    # ===== Axes =====
+
+    @property
+    def shape(self):
+        return None if self.si is None else np.shape(self.si)
+
+    def axes_pixels(self):
+        """x and y axes (1D) in pixels."""
+        return np.arange(self.shape[1]), np.arange(self.shape[0])
+
+    def axes_mm(self):
+        """x and y axes (1D) in mm."""
+        return tbb1_engine.axes_mm(self.shape, self.xsize, self.ysize)
+
+    def nbytes(self):
+        """Memory held by the pair: images in RAM (not the memory-mapped ones) and cached layers."""
+        images = sum(data.nbytes for data in (self.si, self.total)
+                     if data is not None and not _memory_mapped(data))
+        return images + self.graph.cache.nbytes
+
+
+def _memory_mapped(data):
+    while data is not None:
+        if isinstance(data, np.memmap):
+            return True
+        data = getattr(data, "base", None)
+    return False
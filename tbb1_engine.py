@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+Headless computations of pyTBB1.
+
+This module holds the science of the platform (image loading, smoothing,
+conversion of pixels in counts and mm, normalization and calibration) without
+any tkinter or matplotlib dependency, so that it can be used from the GUI, from
+scripts and from the batch command line (tbb1_batch.py).
+
+The conventions are the ones of the GUI:
+    - images are transposed; 8-bit and colour images are 8-bit grey levels,
+      16/32-bit and float images keep their counts (tbb1_io),
+    - the calibration is Counts = a*exp(-b.Thickness), so Thickness = ln(Counts/a)/b,
+    - zero counts are replaced by 1 (Si image) and 1000 (total image) before
+      the log and the normalization.
+"""
+
+import os
+import time
+
+import numpy as np
+
+import tbb1_binning
+import tbb1_instrument
+import tbb1_io
+import tbb1_register
+from tbb1_smoothing import box_filter
+
+
+# Molecular library: coefficients (a, b, a (norm.), b (norm.)) of the exponential calibration of the Si+
+# signal, or coefficients by substrate ion ({"Si+": (...), "SiOH+": (...)}, see library_channels)
+MOLECULE_LIBRARY = {
+    "Proteins": {
+        "Lysozyme":   (2000000.0, -0.998, 0.1373, -0.999),
+        "Bradykinin": (1, 2, 1, 2),
+    },
+    "Polymers": {
+        "Irganox":    (1, 2, 1, 2),
+    },
+    "Lipids": {},
+}
+
+DEFAULT_PIXELS_RASTER_FACTOR = 16834                                            # Default value of the "Pixel/raster factor" entry
+SI_ZERO_REPLACEMENT = 1                                                         # Replaces 0 counts in the Si image (log)
+TOTAL_ZERO_REPLACEMENT = 1000                                                   # Replaces 0 counts in the total image (normalization)
+SUBSTRATE_IONS = ("Si+", "SiOH+", "Si2+", "Au+")                                # Substrate channels that can be calibrated
+DEFAULT_ION = "Si+"                                                             # Channel of the coefficients given as a tuple
+
+
+def entry_channels(entry):
+    """Coefficients by substrate ion of a library entry: a tuple (Si+) or a dictionary {ion: tuple}."""
+    if isinstance(entry, dict):
+        return {ion: tuple(coefficients) for ion, coefficients in entry.items()}
+    return {DEFAULT_ION: tuple(entry)}
+
+
+def channels_entry(channels):
+    """Library entry of coefficients by substrate ion: the tuple itself for the Si+ signal alone."""
+    if list(channels) == [DEFAULT_ION]:
+        return tuple(channels[DEFAULT_ION])
+    return {ion: tuple(coefficients) for ion, coefficients in channels.items()}
+
+
+def library_channels(molecule, library=None):
+    """Return the coefficients of a molecule of the library by substrate ion ({ion: (a, b, a_norm, b_norm)})."""
+    for molecules in (MOLECULE_LIBRARY if library is None else library).values():
+        if molecule in molecules:
+            return entry_channels(molecules[molecule])
+    raise KeyError("Molecule %r is not in the library" % molecule)
+
+
+def library_coefficients(molecule, ion=DEFAULT_ION, library=None):
+    """
+    Return the (a, b, a_norm, b_norm) coefficients of a molecule of the library
+    (MOLECULE_LIBRARY, or e.g. the one fitted by tbb1_calibration.load_library) for one substrate ion.
+    """
+    channels = library_channels(molecule, library)
+    if ion not in channels:
+        raise KeyError("Molecule %r has no coefficients for the %s signal" % (molecule, ion))
+    return tuple(None if c is None else float(c) for c in channels[ion])        # None: not fitted
+
+
+# ===== Image loading =====
+# =========================
+
+def load_image(file_path, page=0):
+    """
+    Open an image and return it as a transposed array.
+
+    16/32-bit and float images keep their counts and uncompressed TIFF files
+    are memory-mapped; 8-bit and colour images are 8-bit grey levels (see tbb1_io).
+    """
+    with tbb1_instrument.stage("load", file=os.fspath(file_path), page=page) as s:
+        return s.output(np.transpose(tbb1_io.read_image(file_path, page)))
+
+
+# ===== Smoothing =====
+# =====================
+
+def smooth_image(data, kernel_size, mode="same"):
+    """
+    Average each pixel with its neighbours in a kernel_size x kernel_size box.
+
+    mode is the edge handling ("same": zero padding as the former
+    scipy.signal.convolve2d smoothing, "reflect" or "nearest"), see tbb1_smoothing.
+    """
+    return box_filter(data, kernel_size, mode)
+
+
+# ===== Conversion =====
+# ======================
+
+def pixel_to_count(data, counts_pixel_factor, pixels_raster_factor, zero_replacement, dtype=np.float64):
+    """Convert pixel intensities in counts (per raster) and suppress the zero values."""
+    converted = np.multiply(data, counts_pixel_factor, dtype=dtype)
+    converted *= pixels_raster_factor                                           # in place: no temporary copy
+    converted[converted == 0] = zero_replacement
+    return converted
+
+
+def axes_mm(shape, xsize, ysize):
+    """Return the x and y axes (1D, in mm) of an image of the given shape."""
+    x = np.linspace(0, xsize, num=shape[1])
+    y = np.linspace(0, ysize, num=shape[0])
+    return x, y
+
+
+# ===== Normalization and calibration =====
+# =========================================
+
+def calibrate(si_counts, total_counts=None, a=None, b=None, a_norm=None, b_norm=None,
+              calibration=True, normalization=True):
+    """
+    Apply the normalization and/or the calibration to converted images.
+
+    Same four cases as the Plot button of the GUI: thickness (normalized or not)
+    when calibration is True, Si intensity (normalized or not) otherwise.
+    """
+    if normalization:
+        if total_counts is None:
+            raise ValueError("The normalization needs the total image")
+        if np.shape(total_counts) != np.shape(si_counts):
+            raise ValueError("The Si and total images do not have the same size")
+        data = si_counts/total_counts
+    else:
+        data = si_counts
+
+    if not calibration:
+        return data
+    if normalization:
+        a, b = a_norm, b_norm
+    if a is None or b is None:
+        raise ValueError("The calibration needs the a and b coefficients")
+    thickness = np.divide(data, a)
+    np.log(thickness, out=thickness)                                            # in place: no temporary copy
+    thickness /= b
+    return thickness
+
+
+# ===== Fused transform =====
+# ===========================
+
+DEFAULT_CHUNK_BYTES = 1024**2                                                   # rows processed together (cache friendly)
+
+
+def transform(si_image, total_image=None, counts_pixel_factor1=1.0, counts_pixel_factor2=1.0,
+              pixels_raster_factor=DEFAULT_PIXELS_RASTER_FACTOR, a=None, b=None, a_norm=None, b_norm=None,
+              calibration=True, normalization=True, out=None, dtype=np.float64, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    Conversion, normalization and calibration in one pass, without full-size temporaries.
+
+    Gives the same map as pixel_to_count followed by calibrate, but writes it
+    directly in out (allocated with dtype if None) block of rows by block of
+    rows: the only temporaries are one block of the total image and the masks
+    of the zero values. dtype=np.float32 halves the memory of the map.
+    """
+    if normalization:
+        if total_image is None:
+            raise ValueError("The normalization needs the total image")
+        if np.shape(total_image) != np.shape(si_image):
+            raise ValueError("The Si and total images do not have the same size")
+    if calibration:
+        a, b = (a_norm, b_norm) if normalization else (a, b)
+        if a is None or b is None:
+            raise ValueError("The calibration needs the a and b coefficients")
+
+    si_image = np.asarray(si_image)
+    total_image = None if total_image is None else np.asarray(total_image)
+    if out is None:
+        out = np.empty_like(si_image, dtype=dtype)                              # same memory order as the image
+    elif np.shape(out) != np.shape(si_image):
+        raise ValueError("The output buffer does not have the size of the image")
+    dtype = out.dtype
+
+    # Transposed images (GUI convention) are processed in the memory order of the file
+    if out.ndim == 2 and not si_image.flags.c_contiguous and si_image.T.flags.c_contiguous:
+        transform(si_image.T, None if total_image is None else total_image.T, counts_pixel_factor1,
+                  counts_pixel_factor2, pixels_raster_factor, a, b, a, b, calibration, normalization,
+                  out.T, dtype, chunk_bytes)
+        return out
+
+    rows = max(1, chunk_bytes//max(1, dtype.itemsize*int(np.prod(np.shape(si_image)[1:]))))
+    block = np.empty((rows,) + np.shape(si_image)[1:], dtype=dtype) if normalization else None
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for start in range(0, np.shape(si_image)[0], rows):
+            o = out[start:start + rows]
+            np.multiply(si_image[start:start + rows], counts_pixel_factor1, out=o, dtype=dtype)
+            o *= pixels_raster_factor
+            o[o == 0] = SI_ZERO_REPLACEMENT
+            if normalization:
+                t = block[:len(o)]
+                np.multiply(total_image[start:start + rows], counts_pixel_factor2, out=t, dtype=dtype)
+                t *= pixels_raster_factor
+                t[t == 0] = TOTAL_ZERO_REPLACEMENT
+                o /= t
+            if calibration:
+                o /= a
+                np.log(o, out=o)
+                o /= b
+    return out
+
+
+# ===== Pipeline =====
+# ====================
+
+class ThicknessPipeline:
+    """
+    GUI-free processing of a Si image (and optionally a total ion image).
+
+    The parameters are the ones of the GUI: X/Y size in mm, counts/pixels
+    factors, pixel/raster factor, optional smoothing (kernel size and edge
+    mode) or count-adaptive binning (binning_target: counts of the Si image
+    per bin, see tbb1_binning), registration of the total image on the Si
+    image (shift and size, see tbb1_register), calibration coefficients (or a molecule of the library), the
+    calibration and normalization switches and the precision of the maps
+    (dtype). The coefficients not given are those of the molecule in library
+    (default: MOLECULE_LIBRARY), resolved here: the object only holds numbers,
+    so it can be sent to worker processes.
+    """
+
+    def __init__(self, xsize=1.0, ysize=1.0, counts_pixel_factor1=1.0, counts_pixel_factor2=1.0,
+                 pixels_raster_factor=DEFAULT_PIXELS_RASTER_FACTOR, kernel_size=None, smooth_mode="same",
+                 binning_target=None, registration=False, a=None, b=None, a_norm=None, b_norm=None, molecule=None,
+                 calibration=True, normalization=True, dtype="float64", library=None):
+        if molecule is not None:                                                # a preset keeps the coefficients it was made with
+            a, b, a_norm, b_norm = [given if given is not None else fitted for given, fitted in
+                                    zip((a, b, a_norm, b_norm), library_coefficients(molecule, library=library))]
+        self.xsize = float(xsize)
+        self.ysize = float(ysize)
+        self.counts_pixel_factor1 = float(counts_pixel_factor1)
+        self.counts_pixel_factor2 = float(counts_pixel_factor2)
+        self.pixels_raster_factor = float(pixels_raster_factor)
+        self.kernel_size = kernel_size
+        self.smooth_mode = smooth_mode
+        if kernel_size and binning_target:
+            raise ValueError("Choose either the smoothing or the adaptive binning")
+        self.binning_target = binning_target
+        self.registration = bool(registration)
+        self.a = a
+        self.b = b
+        self.a_norm = a_norm
+        self.b_norm = b_norm
+        self.molecule = molecule
+        self.calibration = bool(calibration)
+        self.normalization = bool(normalization)
+        self.dtype = np.dtype(dtype).name                                       # "float32" halves the memory of the maps
+
+    def parameters(self):
+        """Return the parameters as a JSON-serializable dictionary."""
+        return dict(vars(self))
+
+    def process_arrays(self, si_image, total_image=None):
+        """
+        Run smoothing, conversion, normalization and calibration on loaded images.
+
+        Returns a dictionary with the resulting map ("thickness"), the x and y
+        axes in mm and the time spent in each step (in seconds).
+        """
+        timings = {}
+        registration = None
+        if self.registration and self.normalization and total_image is not None:
+            start = time.perf_counter()
+            total_image, registration = tbb1_register.align_pair(si_image, total_image)
+            timings["registration"] = time.perf_counter() - start
+        start = time.perf_counter()
+        if self.binning_target:                                                 # bins made on the counts of the Si image
+            bins = tbb1_binning.quadtree_bins(si_image, self.binning_target/self.counts_pixel_factor1)
+            si_image = bins.mean(si_image)
+            total_image = None if total_image is None else bins.mean(total_image)
+        elif self.kernel_size:
+            with tbb1_instrument.stage("smooth", si_image, kernel_size=int(self.kernel_size)) as s:
+                si_image = s.output(smooth_image(si_image, int(self.kernel_size), self.smooth_mode))
+        timings["smooth"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with tbb1_instrument.stage("transform", si_image, total_image) as s:
+            thickness = s.output(transform(si_image, total_image, self.counts_pixel_factor1, self.counts_pixel_factor2,
+                                           self.pixels_raster_factor, self.a, self.b, self.a_norm, self.b_norm,
+                                           self.calibration, self.normalization, dtype=self.dtype))
+        x, y = axes_mm(np.shape(si_image), self.xsize, self.ysize)
+        timings["transform"] = time.perf_counter() - start                     # conversion, normalization and calibration
+        result = {"thickness": thickness, "x": x, "y": y, "timings": timings}
+        if registration is not None:
+            result["registration"] = registration._asdict()                     # shift of the total image (pixels of the map)
+        return result
+
+    def run(self, si_path, total_path=None):
+        """Load the images from disk and process them (see process_arrays)."""
+        start = time.perf_counter()
+        si_image = load_image(si_path)
+        total_image = load_image(total_path) if total_path else None
+        load_time = time.perf_counter() - start
+
+        result = self.process_arrays(si_image, total_image)
+        result["timings"] = dict(load=load_time, **result["timings"])
+        result["metadata"] = self.metadata(result, si_path, total_path)
+        return result
+
+    def metadata(self, result, si_path=None, total_path=None):
+        """Describe a run: input files, parameters, map statistics and timings."""
+        thickness = result["thickness"]
+        statistics = result.get("statistics") or map_statistics(thickness)     # computed tile by tile for tiled runs
+        return dict({
+            "si_image": os.fspath(si_path) if si_path else None,
+            "total_image": os.fspath(total_path) if total_path else None,
+            "shape": list(np.shape(thickness)),
+            "parameters": self.parameters(),
+        }, **statistics, registration=result.get("registration"), timings=result["timings"], pid=os.getpid())
+
+
+def map_statistics(thickness):
+    """Fraction of finite values and finite minimum, maximum and mean of a map."""
+    finite = np.isfinite(thickness)
+    values = thickness[finite]
+    return {
+        "finite_fraction": float(finite.mean()) if finite.size else 0.0,
+        "min": float(values.min()) if values.size else None,
+        "max": float(values.max()) if values.size else None,
+        "mean": float(values.mean()) if values.size else None,
+    }
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Export of the maps and of their intermediates, and fast reload.
+
+A result is a set of named 2D layers of the same shape (the map shown, the
+Si counts, the normalized ratio, the validity masks) with a JSON-serializable
+metadata dictionary (parameters, size in mm, input files, ...). It is written
+in one of three formats:
+    "npy"   a directory <name>.tbb1 holding one uncompressed .npy file per
+            layer and metadata.json: reopened with memory maps, so opening is
+            instantaneous whatever the size of the map and only the parts of
+            the layers that are used are read from disk,
+    "npz"   one compressed file <name>.npz (zlib, one member of the archive
+            per layer) and its sidecar <name>.npz.json: the smallest files, the
+            layers are decompressed when they are reopened,
+    "tiff"  one float32 TIFF per layer <name>_<layer>.tif (masks as 8-bit
+            0/1) and the sidecar <name>.tif.json: readable by ImageJ / Fiji,
+            Gwyddion, ...; the files are not compressed, so tbb1_io
+            memory-maps them again on reopening.
+The sidecar (metadata.json in the directory, else named after the format, so
+the exports of one name do not share it) lists the layers (file, shape,
+dtype, statistics of the float layers) and holds the metadata; it is written
+last, so an interrupted export is not taken for a result.
+
+The layers of the GUI are transposed images (see tbb1_engine): with
+transposed=True the TIFF files are written in image orientation (as the
+loaded images) and load_results transposes them back.
+
+Example:
+    export_results("sample1.npz", {"thickness_norm": thickness, "valid": valid}, {"xsize": 0.5, "ysize": 0.5})
+    layers, metadata = load_results("sample1.npz.json")
+"""
+
+import datetime
+import json
+import os
+
+import numpy as np
+import PIL.Image
+
+import tbb1_engine
+import tbb1_io
+
+
+FORMATS = ("npy", "npz", "tiff")
+EXTENSIONS = {".tbb1": "npy", ".npz": "npz", ".tif": "tiff", ".tiff": "tiff"}
+METADATA_FILE = "metadata.json"                                                 # sidecar of the "npy" format (in the directory)
+SIDECAR_SUFFIXES = {"npz": ".npz.json", "tiff": ".tif.json"}                     # sidecar of the other formats: <name> + suffix
+FORMAT_VERSION = 1
+CHUNK_BYTES = 64*1024**2                                                        # rows of a memory-mapped layer copied together
+
+
+def format_of(path):
+    """Format ("npy", "npz" or "tiff") given by the extension of an export path."""
+    extension = os.path.splitext(os.fspath(path))[1].lower()
+    if extension not in EXTENSIONS:
+        raise ValueError("Unknown results extension %r (%s)" % (extension, ", ".join(EXTENSIONS)))
+    return EXTENSIONS[extension]
+
+
+def validity_masks(thickness, si=None, total=None):
+    """
+    Masks (bool) of a map: "valid" where the value is finite and computed from
+    non-zero counts, "si_zero" / "total_zero" where the counts of the (smoothed)
+    Si image / of the total image were 0 and replaced (see tbb1_engine).
+    """
+    valid = np.isfinite(thickness)
+    masks = {"valid": valid}
+    for name, counts in (("si_zero", si), ("total_zero", total)):
+        if counts is not None:
+            masks[name] = np.asarray(counts) == 0
+            valid &= ~masks[name]
+    return masks
+
+
+# ===== Export =====
+# ==================
+
+def _save_npy(file_path, layer):
+    """Write a layer as .npy by blocks of rows (memory-mapped layers larger than the memory are not loaded at once)."""
+    layer = np.asanyarray(layer)
+    out = np.lib.format.open_memmap(file_path, mode="w+", dtype=layer.dtype, shape=layer.shape)
+    rows = max(1, CHUNK_BYTES//max(1, layer[:1].nbytes))
+    for start in range(0, len(layer), rows):
+        out[start:start + rows] = layer[start:start + rows]
+    out.flush()
+    del out
+
+
+def _save_tiff(file_path, layer, transposed):
+    layer = np.asarray(layer)
+    data = layer.astype(np.uint8) if layer.dtype == np.bool_ else layer.astype(np.float32)
+    PIL.Image.fromarray(np.ascontiguousarray(data.T if transposed else data)).save(file_path)  # uncompressed
+
+
+def _describe(file_name, layer):
+    description = {"file": file_name, "shape": list(np.shape(layer)), "dtype": np.asarray(layer[:0]).dtype.name}
+    if np.issubdtype(description["dtype"], np.floating):
+        description["statistics"] = tbb1_engine.map_statistics(np.asarray(layer))
+    return description
+
+
+def export_results(path, layers, metadata=None, format=None, transposed=True):
+    """
+    Write the layers (name: 2D array) and the metadata. format: "npy", "npz" or
+    "tiff" (default: given by the extension of path, see EXTENSIONS).
+
+    Returns the path of the sidecar, to give to load_results.
+    """
+    path = os.fspath(path)
+    format = format or format_of(path)
+    if format not in FORMATS:
+        raise ValueError("Unknown results format %r (%s)" % (format, ", ".join(FORMATS)))
+    shapes = {np.shape(layer) for layer in layers.values()}
+    if len(shapes) != 1:
+        raise ValueError("The layers do not have the same shape")
+    stem = os.path.splitext(path)[0]
+    files = {}
+    if format == "npy":
+        os.makedirs(path, exist_ok=True)
+        sidecar = os.path.join(path, METADATA_FILE)
+        for name, layer in layers.items():
+            files[name] = name + ".npy"
+            _save_npy(os.path.join(path, files[name]), layer)
+    elif format == "npz":
+        sidecar = stem + SIDECAR_SUFFIXES[format]
+        np.savez_compressed(stem + ".npz", **layers)
+        files = {name: os.path.basename(stem) + ".npz" for name in layers}
+    else:
+        sidecar = stem + SIDECAR_SUFFIXES[format]
+        for name, layer in layers.items():
+            files[name] = "%s_%s.tif" % (os.path.basename(stem), name)
+            _save_tiff(os.path.join(os.path.dirname(sidecar), files[name]), layer, transposed)
+
+    content = {
+        "format": format,
+        "version": FORMAT_VERSION,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "transposed": bool(transposed),
+        "layers": {name: _describe(files[name], layer) for name, layer in layers.items()},
+        "metadata": metadata or {},
+    }
+    with open(sidecar, "w") as handle:
+        json.dump(content, handle, indent=2, default=str)
+    return sidecar
+
+
+# ===== Reload =====
+# ==================
+
+def _sidecar_path(path):
+    path = os.fspath(path)
+    if os.path.isdir(path):
+        return os.path.join(path, METADATA_FILE)
+    if os.path.splitext(path)[1].lower() == ".json":
+        return path
+    stem, extension = os.path.splitext(path)
+    if EXTENSIONS.get(extension.lower()) in SIDECAR_SUFFIXES:                   # .npz, .tif: their sidecar
+        return stem + SIDECAR_SUFFIXES[EXTENSIONS[extension.lower()]]
+    return stem + ".json"
+
+
+def _format_of_sidecar(sidecar):
+    """Format given by the name of a sidecar (metadata.json: "npy", <name>.npz.json: "npz", ...), None if not known."""
+    if os.path.basename(sidecar) == METADATA_FILE:
+        return "npy"
+    return next((format for format, suffix in SIDECAR_SUFFIXES.items() if sidecar.lower().endswith(suffix)), None)
+
+
+def read_metadata(path):
+    """Content of the sidecar of an export (path: the sidecar, the .tbb1 directory or the .npz file)."""
+    with open(_sidecar_path(path)) as handle:
+        return json.load(handle)
+
+
+def load_results(path, mmap=True):
+    """
+    Reopen an export (path: the sidecar, the .tbb1 directory or the .npz file).
+
+    Returns (layers, content): the layers (name: array, read-only memory maps
+    for "npy" and uncompressed TIFF files if mmap) and the content of the
+    sidecar, whose "metadata" is the dictionary given to export_results.
+    """
+    sidecar = _sidecar_path(path)
+    content = read_metadata(sidecar)
+    expected = _format_of_sidecar(sidecar)
+    if expected is not None and content.get("format") != expected:
+        raise ValueError("%s holds a %r export, not the %r one of its name" % (sidecar, content.get("format"), expected))
+    directory = os.path.dirname(sidecar)
+    descriptions = content["layers"]
+    layers = {}
+    if content["format"] == "npz":
+        files = {description["file"] for description in descriptions.values()}
+        with np.load(os.path.join(directory, files.pop())) as archive:
+            for name in descriptions:
+                layers[name] = archive[name]
+        return layers, content
+    for name, description in descriptions.items():
+        file_path = os.path.join(directory, description["file"])
+        if content["format"] == "npy":
+            layers[name] = np.load(file_path, mmap_mode="r" if mmap else None)
+            continue
+        layer = tbb1_io.read_image(file_path, mmap=mmap)
+        layer = layer.T if content["transposed"] else layer
+        layers[name] = layer.astype(bool) if description["dtype"] == "bool" else layer
+    return layers, content
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental processing graph with cached intermediates.
+
+The processing of pyTBB1 is a chain of stages:
+
+    si ──┬─────────────────────> smoothed ──> si_counts ──┬──────────────> thickness
+         ├──> bins ─────────────┐                         └──> ratio ───> thickness_norm
+         └──> registration ──┐  │
+    total ───────────────────┴──> aligned_total ──> binned_total ──> total_counts ─┘
+
+"bins" are the count-adaptive bins of the Si image (tbb1_binning) when a
+binning_target is given (False otherwise): "smoothed" and "binned_total" are
+then the images averaged over the bins instead of the box smoothing and of
+the total image as it is.
+
+"registration" is the shift (and scale) of the total image relative to the Si
+image (tbb1_register) when the registration parameter is True (False
+otherwise): "aligned_total" is then the total image resampled on the grid of
+the Si image, so images of different sizes or shifted by a drift of the stage
+can be divided.
+
+Each stage result is cached under a key made of the keys of its inputs and of
+the parameters it uses (the sources are keyed by a hash of their content, or by
+file identity). Changing a parameter therefore only recomputes the stages that
+use it and the ones after it: a new colormap recomputes nothing, a new
+calibration coefficient only recomputes the last stage, a new counts/pixels
+factor of the Si image does not touch the total image.
+
+The cache is an LRU bounded by a memory budget (max_bytes): the least recently
+used intermediates are dropped first and are recomputed if needed again.
+
+Quantized images (8-bit, no smoothing) are calibrated with lookup tables (see
+tbb1_calibration): the thickness stages are then computed from the table index
+of the images ("si_index", "pair_index", which do not depend on any parameter)
+instead of the converted images, so a new set of coefficients only costs a new
+table and one take(). The values are the same as with the analytic path.
+
+result(stage, progress) calls progress(fraction, stage) before computing each
+missing stage; the callback may raise to stop the computation between stages
+(see tbb1_worker), the stages already computed staying in the cache.
+"""
+
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+import tbb1_binning
+import tbb1_calibration
+import tbb1_engine
+import tbb1_instrument
+import tbb1_register
+
+
+DEFAULT_MAX_BYTES = 512*1024**2                                                 # 512 MB of cached intermediates
+SOURCES = ("si", "total")
+DEFAULT_PARAMETERS = {
+    "kernel_size": None,
+    "binning_target": None,                                                     # counts of the Si image (image values) per bin
+    "registration": False,                                                      # align the total image on the Si image
+    "smooth_mode": "same",
+    "counts_pixel_factor1": 1.0,
+    "counts_pixel_factor2": 1.0,
+    "pixels_raster_factor": tbb1_engine.DEFAULT_PIXELS_RASTER_FACTOR,
+    "a": None,
+    "b": None,
+    "a_norm": None,
+    "b_norm": None,
+}
+
+
+# ===== Keys =====
+# ================
+
+def _digest(*parts):
+    return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+
+def content_key(data):
+    """Key of an array computed from its content (shape, dtype and bytes)."""
+    data = np.asarray(data)
+    order = "C"
+    if not data.flags.c_contiguous:
+        if data.T.flags.c_contiguous:                                           # transposed images: hash the original buffer
+            data, order = data.T, "F"
+        else:
+            data = np.ascontiguousarray(data)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((data.shape, data.dtype.str, order)).encode())
+    h.update(memoryview(data).cast("B"))
+    return h.hexdigest()
+
+
+def file_key(file_path, page=0):
+    """Key of an image file from its identity (path, size, modification time), without reading it."""
+    stat = os.stat(file_path)
+    return _digest(os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns, page)
+
+
+# ===== Stages =====
+# ==================
+
+def _bins(p, si):
+    if not p["binning_target"]:
+        return False                                                            # no binning (cached as such)
+    return tbb1_binning.quadtree_bins(si, p["binning_target"])
+
+
+def _smoothed(p, si, bins):
+    if bins is not False:
+        return bins.mean(si)
+    if not p["kernel_size"]:
+        return si
+    return tbb1_engine.smooth_image(si, int(p["kernel_size"]), p["smooth_mode"])
+
+
+def _registration(p, si, total):
+    if not p["registration"]:
+        return False
+    return tbb1_register.register(si, total)
+
+
+def _aligned_total(p, si, total, registration):
+    if registration is False:
+        return total
+    return tbb1_register.align(total, np.shape(si), registration)
+
+
+def _binned_total(p, total, bins):
+    return total if bins is False else bins.mean(total)
+
+
+def _si_counts(p, smoothed):
+    return tbb1_engine.pixel_to_count(smoothed, p["counts_pixel_factor1"], p["pixels_raster_factor"],
+                                      tbb1_engine.SI_ZERO_REPLACEMENT)
+
+
+def _total_counts(p, total):
+    return tbb1_engine.pixel_to_count(total, p["counts_pixel_factor2"], p["pixels_raster_factor"],
+                                      tbb1_engine.TOTAL_ZERO_REPLACEMENT)
+
+
+def _ratio(p, si_counts, total_counts):
+    return tbb1_engine.calibrate(si_counts, total_counts, calibration=False)
+
+
+def _thickness(p, si_counts):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return tbb1_engine.calibrate(si_counts, a=p["a"], b=p["b"], normalization=False)
+
+
+def _thickness_norm(p, ratio):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return tbb1_engine.calibrate(ratio, a=p["a_norm"], b=p["b_norm"], normalization=False)
+
+
+def _si_index(p, smoothed):
+    return tbb1_calibration.lookup_index(smoothed) or False                     # False: not quantized (cached as such)
+
+
+def _pair_index(p, smoothed, binned_total):
+    return tbb1_calibration.lookup_index(smoothed, binned_total) or False
+
+
+_CONVERSION = ("counts_pixel_factor1", "counts_pixel_factor2", "pixels_raster_factor")
+
+
+def _thickness_lookup(p, index, smoothed):
+    conversion = [p[name] for name in _CONVERSION]
+    return tbb1_calibration.transform(smoothed, None, *conversion, a=p["a"], b=p["b"],
+                                      normalization=False, index=index)
+
+
+def _thickness_norm_lookup(p, index, smoothed, total):
+    conversion = [p[name] for name in _CONVERSION]
+    return tbb1_calibration.transform(smoothed, total, *conversion, a_norm=p["a_norm"], b_norm=p["b_norm"],
+                                      index=index)
+
+
+# stage: (inputs, parameters used, function)
+STAGES = {
+    "bins":           (("si",), ("binning_target",), _bins),
+    "smoothed":       (("si", "bins"), ("kernel_size", "smooth_mode"), _smoothed),
+    "registration":   (("si", "total"), ("registration",), _registration),
+    "aligned_total":  (("si", "total", "registration"), (), _aligned_total),
+    "binned_total":   (("aligned_total", "bins"), (), _binned_total),
+    "si_counts":      (("smoothed",), ("counts_pixel_factor1", "pixels_raster_factor"), _si_counts),
+    "total_counts":   (("binned_total",), ("counts_pixel_factor2", "pixels_raster_factor"), _total_counts),
+    "ratio":          (("si_counts", "total_counts"), (), _ratio),
+    "thickness":      (("si_counts",), ("a", "b"), _thickness),
+    "thickness_norm": (("ratio",), ("a_norm", "b_norm"), _thickness_norm),
+    "si_index":       (("smoothed",), (), _si_index),
+    "pair_index":     (("smoothed", "binned_total"), (), _pair_index),
+}
+
+# stage: (index stage, other inputs, function) computing the same result with a lookup table
+LOOKUP_STAGES = {
+    "thickness":      ("si_index", ("smoothed",), _thickness_lookup),
+    "thickness_norm": ("pair_index", ("smoothed", "binned_total"), _thickness_norm_lookup),
+}
+
+
+def map_stage(calibration, normalization):
+    """Stage giving the map of the Plot button for the calibration / normalization checkboxes."""
+    if calibration:
+        return "thickness_norm" if normalization else "thickness"
+    return "ratio" if normalization else "si_counts"
+
+
+# ===== Cache =====
+# =================
+
+class LRUCache:
+    """Least recently used cache of arrays bounded by their total size in bytes."""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        if key not in self._items:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._items.move_to_end(key)
+        return self._items[key]
+
+    def put(self, key, value):
+        size = getattr(value, "nbytes", 0)
+        if key in self._items:
+            self.nbytes -= getattr(self._items.pop(key), "nbytes", 0)
+        if size > self.max_bytes:                                               # Too large to be kept
+            return
+        self._items[key] = value
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._items.popitem(last=False)
+            self.nbytes -= getattr(evicted, "nbytes", 0)
+            self.evictions += 1
+
+    def clear(self):
+        self._items.clear()
+        self.nbytes = 0
+
+
+# ===== Graph =====
+# =================
+
+class ProcessingGraph:
+    """
+    Load -> smooth -> convert -> normalize -> calibrate chain with memoized stages.
+
+    graph.set_source("si", array) / graph.set_source("total", array) give the
+    images, graph.set_parameters(...) the parameters (see DEFAULT_PARAMETERS)
+    and graph.result(stage) returns the result of a stage (see STAGES),
+    computing only the stages whose key is not in the cache.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, lookup=True, **parameters):
+        self.cache = LRUCache(max_bytes)
+        self.lookup = lookup                                                    # Lookup tables for quantized images
+        self.parameters = dict(DEFAULT_PARAMETERS)
+        self.sources = {}
+        self.source_keys = {}
+        self.computed = []                                                      # Stages computed by the last result() call
+        self._progress = None
+        self._missing = 0
+        self.set_parameters(**parameters)
+
+    def set_source(self, name, data, key=None):
+        """Set an input image; key defaults to a hash of the content (see file_key for large files)."""
+        if name not in SOURCES:
+            raise ValueError("Unknown source %r (expected one of %s)" % (name, ", ".join(SOURCES)))
+        self.sources[name] = data
+        self.source_keys[name] = key if key is not None else content_key(data)
+
+    def set_parameters(self, **parameters):
+        unknown = set(parameters) - set(DEFAULT_PARAMETERS)
+        if unknown:
+            raise ValueError("Unknown parameters: %s" % ", ".join(sorted(unknown)))
+        self.parameters.update(parameters)
+
+    def key(self, stage):
+        """Cache key of a stage for the current sources and parameters."""
+        if stage in SOURCES:
+            if stage not in self.source_keys:
+                raise ValueError("The %s image is not loaded" % stage)
+            return self.source_keys[stage]
+        inputs, names, _ = STAGES[stage]
+        return _digest(stage, [self.key(name) for name in inputs],
+                       [(name, self.parameters[name]) for name in names])
+
+    def missing(self, stage):
+        """Stages that result(stage) would compute, in the order they would be computed."""
+        if stage in SOURCES or self.key(stage) in self.cache:
+            return []
+        stages = []
+        for name in STAGES[stage][0]:
+            stages += [missing for missing in self.missing(name) if missing not in stages]
+        return stages + [stage]
+
+    def result(self, stage, progress=None):
+        """Return the result of a stage, computing what is missing (progress: see the module docstring)."""
+        self.computed = []
+        self._progress = progress
+        self._missing = len(self.missing(stage)) if progress is not None else 0
+        try:
+            return self._result(stage)
+        finally:
+            self._progress = None
+
+    def _result(self, stage):
+        if stage in SOURCES:
+            self.key(stage)                                                     # Raises if the source is missing
+            return self.sources[stage]
+        key = self.key(stage)
+        value = self.cache.get(key)
+        if value is None:
+            inputs, _, function = STAGES[stage]
+            if self.lookup and stage in LOOKUP_STAGES:
+                index_stage, lookup_inputs, lookup_function = LOOKUP_STAGES[stage]
+                index = self._result(index_stage)
+                if index is not False:                                          # same value as the analytic path: same key
+                    inputs, function = lookup_inputs, lambda p, *images: lookup_function(p, index, *images)
+            arguments = [self._result(name) for name in inputs]
+            if self._progress is not None:
+                self._progress(len(self.computed)/max(1, self._missing), stage)
+            with tbb1_instrument.stage(stage, *arguments) as s:
+                value = s.output(function(self.parameters, *arguments))
+            if not any(value is argument for argument in arguments):            # Pass-through stages (no smoothing) are not stored twice
+                self.cache.put(key, value)
+            self.computed.append(stage)
+        return value
+
+    def clear(self):
+        self.cache.clear()
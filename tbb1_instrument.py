@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage instrumentation of the processing: wall time, CPU time, peak memory
+and shapes / dtypes of the arrays.
+
+The stages of the GUI and of the batch mode (loading, processing graph stages,
+pipeline steps, tiles, rendering) are wrapped in
+
+    with tbb1_instrument.stage("smoothed", si, kernel_size=21) as s:
+        smoothed = s.output(smooth_image(si, 21))
+
+When the instrumentation is disabled (default), stage() returns a shared
+object that does nothing: the cost is one function call per stage. Once
+enabled (enable(), the "Profile" box of the status bar, TBB1_PROFILE=<file>
+in the environment or --profile <file> in tbb1_batch), each stage gives a
+record (dictionary):
+    stage, wall and cpu times (s), peak_bytes (largest memory allocated
+    during the stage, tracemalloc; None if memory=False), inputs and outputs
+    ({"shape", "dtype"} of the arrays), depth (nesting), the keywords given
+    to stage(), pid, thread, time (epoch) and error (exception type or None).
+The records are kept in RECENT (last records), given to the listeners
+(add_listener) and, with a log_path, appended as JSON lines to the file (one
+open/append per record, so the processes of a pool can share the file).
+
+The CPU time is the one of the process and the peak memory is traced for the
+whole process: stages running at the same time in several threads share them.
+"""
+
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+import numpy as np
+
+
+ENVIRONMENT_VARIABLE = "TBB1_PROFILE"                                           # JSON-lines file enabling the instrumentation at import
+RECENT = deque(maxlen=200)                                                      # last records (all threads)
+
+_state = {"enabled": False, "memory": False, "log_path": None, "tracemalloc": False}
+_listeners = []
+_lock = threading.Lock()
+_local = threading.local()
+
+
+# ===== Switch =====
+# ==================
+
+def enable(log_path=None, memory=True):
+    """Start recording the stages (and appending them to log_path if given). memory: trace the peak allocations."""
+    with _lock:
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _state["tracemalloc"] = True                                        # started here: stopped by disable()
+        _state.update(enabled=True, memory=bool(memory), log_path=os.fspath(log_path) if log_path else None)
+
+
+def disable():
+    """Stop recording (the stages in progress are still recorded)."""
+    with _lock:
+        _state.update(enabled=False, memory=False, log_path=None)
+        if _state["tracemalloc"]:
+            tracemalloc.stop()
+            _state["tracemalloc"] = False
+
+
+def is_enabled():
+    return _state["enabled"]
+
+
+def add_listener(function):
+    """function(record) is called for each record, in the thread of the stage."""
+    _listeners.append(function)
+
+
+def remove_listener(function):
+    if function in _listeners:
+        _listeners.remove(function)
+
+
+# ===== Stages =====
+# ==================
+
+def describe(value):
+    """Shape and dtype of an array (or of the arrays of a tuple / list), None for other values."""
+    if isinstance(value, (tuple, list)):
+        return [describe(item) for item in value]
+    if isinstance(value, np.ndarray):
+        return {"shape": list(value.shape), "dtype": value.dtype.name}
+    return None
+
+
+class _NullStage:
+    """Stage of the disabled instrumentation."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def output(self, value):
+        return value
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Stage:
+    """One instrumented stage (context manager), see stage()."""
+
+    __slots__ = ("name", "inputs", "outputs", "info", "parent", "start", "cpu", "base", "child_peak")
+
+    def __init__(self, name, inputs, info):
+        self.name = name
+        self.inputs = inputs
+        self.outputs = None
+        self.info = info
+        self.parent = None
+        self.base = None                                                        # memory allocated at the start (tracemalloc)
+        self.child_peak = 0                                                     # highest peak of the nested stages
+
+    def output(self, value):
+        """Record the shape / dtype of the result of the stage and return it."""
+        self.outputs = value
+        return value
+
+    def __enter__(self):
+        stack = _stack()
+        self.parent = stack[-1] if stack else None
+        stack.append(self)
+        if _state["memory"] and tracemalloc.is_tracing():
+            self.base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self.cpu = time.process_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self.start
+        cpu = time.process_time() - self.cpu
+        stack = _stack()
+        depth = len(stack) - 1
+        if stack and stack[-1] is self:
+            stack.pop()
+        peak = None
+        if self.base is not None and tracemalloc.is_tracing():
+            highest = max(tracemalloc.get_traced_memory()[1], self.child_peak)  # reset_peak of the nested stages
+            peak = max(0, highest - self.base)
+            if self.parent is not None:
+                self.parent.child_peak = max(self.parent.child_peak, highest)
+        record = dict({
+            "stage": self.name,
+            "wall": wall,
+            "cpu": cpu,
+            "peak_bytes": peak,
+            "inputs": [describe(value) for value in self.inputs],
+            "outputs": describe(self.outputs),
+            "depth": depth,
+        }, **self.info, pid=os.getpid(), thread=threading.current_thread().name, time=time.time(),
+            error=exc_type.__name__ if exc_type is not None else None)
+        _emit(record)
+        return False
+
+
+def stage(name, /, *inputs, **info):
+    """
+    Context manager recording a stage when the instrumentation is enabled.
+
+    inputs are the arrays processed (their shapes and dtypes are recorded),
+    info JSON-serializable details (kernel size, file, ...); call .output()
+    on the returned object with the result of the stage.
+    """
+    if not _state["enabled"]:
+        return _NULL_STAGE
+    return Stage(name, inputs, info)
+
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _emit(record):
+    RECENT.append(record)
+    for function in list(_listeners):
+        function(record)
+    log_path = _state["log_path"]
+    if log_path:
+        line = json.dumps(record, default=str) + "\n"
+        with _lock, open(log_path, "a") as handle:
+            handle.write(line)
+
+
+# ===== Display =====
+# ===================
+
+def summary(record):
+    """One line description of a record (status bar of the GUI)."""
+    text = "%s %.3f s (CPU %.3f s" % (record["stage"], record["wall"], record["cpu"])
+    if record["peak_bytes"] is not None:
+        text += ", peak %.1f MB" % (record["peak_bytes"]/1024**2)
+    text += ")"
+    arrays = record["outputs"] if isinstance(record["outputs"], dict) else next(
+        (value for value in record["inputs"] if isinstance(value, dict)), None)
+    if arrays is not None:
+        text += " %s %s" % ("x".join(str(n) for n in arrays["shape"]), arrays["dtype"])
+    return text
+
+
+if os.environ.get(ENVIRONMENT_VARIABLE):
+    enable(os.environ[ENVIRONMENT_VARIABLE])
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+Reading of the Si and total ion images with their true counts.
+
+ToF-SIMS count images are often saved as 16 or 32-bit integer or float TIFF
+files, sometimes with several pages (one per scan). Converting them to 8-bit
+grey levels (convert("L")) loses the counts, which then have to be recovered
+with the "Counts/pixels factor". This module keeps the native data type:
+    - uncompressed TIFF pages (classic TIFF and BigTIFF, any byte order) are
+      memory-mapped with np.memmap: opening is instantaneous whatever the file
+      size, and only the parts of the image that are used are read from disk,
+    - other TIFF pages (compressed, tiled) and other formats are decoded with
+      PIL, keeping 16-bit ("I;16"), 32-bit ("I") and float ("F") images as they
+      are; 8-bit and colour images are converted to 8-bit grey levels as before.
+
+Arrays are returned in image orientation (rows, columns); tbb1_engine
+transposes them for the GUI conventions.
+
+read_reduced reads a page at a reduced resolution for the previews, decoding
+as little of the file as possible (pyramid levels, strides of the memory map,
+JPEG draft mode, PIL reduce()); colour_preview keeps the colours of colour
+exports (colour-mapped ion images) in their preview, as the original image
+was shown.
+"""
+
+import struct
+
+import numpy as np
+import PIL.Image
+
+
+TIFF_EXTENSIONS = (".tif", ".tiff")
+NATIVE_MODES = ("I;16", "I;16L", "I;16B", "I;16N", "I", "F")                   # PIL modes kept with their counts
+GREY_MODES = ("1", "L")                                                         # 8-bit grey levels: previewed from their values
+
+# TIFF tags used to locate the pixels of a page
+_NEW_SUBFILE_TYPE = 254
+_IMAGE_WIDTH = 256
+_IMAGE_LENGTH = 257
+_BITS_PER_SAMPLE = 258
+_COMPRESSION = 259
+_PHOTOMETRIC = 262
+_STRIP_OFFSETS = 273
+_SAMPLES_PER_PIXEL = 277
+_STRIP_BYTE_COUNTS = 279
+_TILE_WIDTH = 322
+_SAMPLE_FORMAT = 339
+
+# TIFF field types: (struct format, size in bytes)
+_FIELD_TYPES = {1: ("B", 1), 2: ("c", 1), 3: ("H", 2), 4: ("I", 4), 5: ("II", 8), 6: ("b", 1),
+                7: ("B", 1), 8: ("h", 2), 9: ("i", 4), 10: ("ii", 8), 11: ("f", 4), 12: ("d", 8),
+                16: ("Q", 8), 17: ("q", 8), 18: ("Q", 8)}
+_SAMPLE_KINDS = {1: "u", 2: "i", 3: "f"}                                        # SampleFormat: unsigned, signed, float
+
+
+# ===== TIFF structure =====
+# ==========================
+
+def _read_ifds(handle):
+    """Return the tags ({tag: tuple of values}) of every page of an open TIFF file, and the byte order."""
+    header = handle.read(16)
+    byte_order = {b"II": "<", b"MM": ">"}.get(header[:2])
+    if byte_order is None:
+        raise ValueError("Not a TIFF file")
+    version, = struct.unpack(byte_order + "H", header[2:4])
+    if version == 42:                                                           # Classic TIFF
+        offset, = struct.unpack(byte_order + "I", header[4:8])
+        count_format, entry_size, pointer_format, inline_size = "H", 12, "I", 4
+    elif version == 43:                                                         # BigTIFF
+        offset, = struct.unpack(byte_order + "Q", header[8:16])
+        count_format, entry_size, pointer_format, inline_size = "Q", 20, "Q", 8
+    else:
+        raise ValueError("Unknown TIFF version %d" % version)
+    count_size = struct.calcsize(count_format)
+    pointer_size = struct.calcsize(pointer_format)
+
+    pages = []
+    visited = set()
+    while offset and offset not in visited:
+        visited.add(offset)
+        handle.seek(offset)
+        n_entries, = struct.unpack(byte_order + count_format, handle.read(count_size))
+        entries = handle.read(n_entries*entry_size)
+        next_offset, = struct.unpack(byte_order + pointer_format, handle.read(pointer_size))
+        tags = {}
+        for i in range(n_entries):
+            entry = entries[i*entry_size:(i + 1)*entry_size]
+            tag, field_type = struct.unpack(byte_order + "HH", entry[:4])
+            count, = struct.unpack(byte_order + pointer_format, entry[4:4 + pointer_size])
+            if field_type not in _FIELD_TYPES:
+                continue
+            value_format, value_size = _FIELD_TYPES[field_type]
+            data = entry[4 + pointer_size:]
+            if count*value_size > inline_size:                                  # Values stored elsewhere in the file
+                value_offset, = struct.unpack(byte_order + pointer_format, data)
+                position = handle.tell()
+                handle.seek(value_offset)
+                data = handle.read(count*value_size)
+                handle.seek(position)
+            if field_type == 2:
+                tags[tag] = (data[:count].rstrip(b"\0").decode("latin-1"),)
+            else:
+                tags[tag] = struct.unpack(byte_order + value_format*count, data[:count*value_size])
+        pages.append(tags)
+        offset = next_offset
+    return pages, byte_order
+
+
+def _page_layout(tags, byte_order):
+    """
+    Return (offset, dtype, shape) when the pixels of a page are stored as one
+    uncompressed contiguous block, else None.
+
+    Only BlackIsZero pages (grey levels are the counts) are mapped; palette
+    and WhiteIsZero pages are decoded by PIL.
+    """
+    if tags.get(_PHOTOMETRIC, (None,))[0] != 1:
+        return None
+    if tags.get(_COMPRESSION, (1,))[0] != 1 or _TILE_WIDTH in tags:
+        return None
+    if tags.get(_SAMPLES_PER_PIXEL, (1,))[0] != 1 or _STRIP_OFFSETS not in tags:
+        return None
+    bits = tags.get(_BITS_PER_SAMPLE, (1,))[0]
+    kind = _SAMPLE_KINDS.get(tags.get(_SAMPLE_FORMAT, (1,))[0])
+    if kind is None or bits not in (8, 16, 32, 64) or (kind == "f" and bits < 32):
+        return None
+    dtype = np.dtype("%s%s%d" % (byte_order, kind, bits//8))
+    shape = (tags[_IMAGE_LENGTH][0], tags[_IMAGE_WIDTH][0])
+    offsets = tags[_STRIP_OFFSETS]
+    byte_counts = tags.get(_STRIP_BYTE_COUNTS)
+    if byte_counts is None or len(byte_counts) != len(offsets):
+        return None
+    for i in range(len(offsets) - 1):
+        if offsets[i] + byte_counts[i] != offsets[i + 1]:                       # Strips are not contiguous
+            return None
+    if sum(byte_counts) < shape[0]*shape[1]*dtype.itemsize:
+        return None
+    return offsets[0], dtype, shape
+
+
+# ===== Pages =====
+# =================
+
+class ImagePages:
+    """
+    Lazy sequence of the pages of an image file.
+
+    pages[i] returns the i-th page as a 2D array (a read-only np.memmap when
+    the page is stored uncompressed, else the decoded page). Nothing is read
+    before a page is accessed.
+    """
+
+    def __init__(self, file_path, mmap=True):
+        self.file_path = file_path
+        self._layouts = None
+        self._reduced = None                                                    # Reduced-resolution pages (TIFF pyramids)
+        self._shapes = None
+        if str(file_path).lower().endswith(TIFF_EXTENSIONS):
+            try:
+                with open(file_path, "rb") as handle:
+                    pages, byte_order = _read_ifds(handle)
+                self._layouts = [_page_layout(tags, byte_order) if mmap else None for tags in pages]
+                self._reduced = [bool(tags.get(_NEW_SUBFILE_TYPE, (0,))[0] & 1) for tags in pages]
+                self._shapes = [(tags.get(_IMAGE_LENGTH, (0,))[0], tags.get(_IMAGE_WIDTH, (0,))[0]) for tags in pages]
+            except (ValueError, struct.error):
+                self._layouts = None                                            # Let PIL try (and report the error)
+        if self._layouts is None:
+            with PIL.Image.open(file_path) as image:
+                self._layouts = [None]*getattr(image, "n_frames", 1)
+
+    def __len__(self):
+        return len(self._layouts)
+
+    def __getitem__(self, page):
+        layout = self._layouts[page]
+        if layout is not None:
+            offset, dtype, shape = layout
+            return np.memmap(self.file_path, dtype=dtype, mode="r", offset=offset, shape=shape)
+        return decode_page(self.file_path, page % len(self))
+
+    def __iter__(self):
+        for page in range(len(self)):
+            yield self[page]
+
+    def is_memory_mapped(self, page=0):
+        return self._layouts[page] is not None
+
+    def levels(self, page=0):
+        """Pages holding reduced-resolution versions of a page (the pages following it in a pyramid TIFF)."""
+        levels = []
+        if self._reduced is not None:
+            for level in range(page + 1, len(self)):
+                if not self._reduced[level]:
+                    break
+                levels.append(level)
+        return levels
+
+    def shape(self, page=0):
+        """Shape of a page (rows, columns) without reading it (TIFF files), else None."""
+        return None if self._shapes is None else self._shapes[page]
+
+
+def decode_page(file_path, page=0):
+    """Decode one page with PIL, keeping 16-bit, 32-bit and float counts."""
+    with PIL.Image.open(file_path) as image:
+        image.seek(page)
+        if image.mode in NATIVE_MODES:
+            data = np.array(image)
+            if data.dtype.byteorder == ">":
+                data = data.astype(data.dtype.newbyteorder("="))
+            return data
+        return np.array(image.convert("L"))                                    # Convert image to 8-bit black and white (L)
+
+
+def read_image(file_path, page=0, mmap=True):
+    """Return one page of an image file as a 2D array of counts (rows, columns)."""
+    return ImagePages(file_path, mmap)[page]
+
+
+def read_reduced(file_path, size=(250, 250), page=0):
+    """
+    Return a page at a reduced resolution of about size = (width, height)
+    pixels (not less, unless the image is smaller), reading as little as
+    possible of the file:
+        - pyramid TIFF files: the smallest stored level at least that large,
+        - uncompressed TIFF pages: every n-th row and column of the memory map,
+        - JPEG files: decoded at 1/2 to 1/8 of their size (draft mode),
+        - other files: decoded, then reduced by averages of n x n blocks.
+    Counts are kept as in read_image (8-bit grey levels for 8-bit and colour images).
+    """
+    pages = ImagePages(file_path)
+    for level in reversed(pages.levels(page)):                                  # smallest level first
+        shape = pages.shape(level)
+        if shape[0] >= size[1] and shape[1] >= size[0]:
+            page = level
+            break
+    if pages.is_memory_mapped(page):
+        data = pages[page]
+        step = max(1, min(data.shape[0]//size[1], data.shape[1]//size[0]))
+        return np.array(data[::step, ::step])                                   # only the rows needed are read
+    with PIL.Image.open(file_path) as image:
+        image.seek(page)
+        if image.format == "JPEG":
+            image.draft("L", size)                                              # DCT scaling in the decoder
+        factor = max(1, min(image.width//size[0], image.height//size[1]))
+        if image.mode not in NATIVE_MODES:
+            image = image.convert("L")
+        elif image.mode.startswith("I;16"):
+            image = image.convert("I")                                          # reduce() works on 32-bit counts
+        if factor > 1:
+            image = image.reduce(factor)
+        return np.array(image)
+
+
+def page_count(file_path):
+    return len(ImagePages(file_path))
+
+
+def has_true_counts(data):
+    """True when the data are not 8-bit grey levels, i.e. the counts/pixels factor is not needed."""
+    return np.asarray(data).dtype != np.uint8
+
+
+# ===== Preview =====
+# ===================
+
+def colour_preview(file_path, size=(250, 250), page=0):
+    """
+    Return a PIL image of size pixels of a colour page (RGB, palette, ...) in
+    its colours, decoded at a reduced resolution, or None for grey and count
+    images (previewed from their values with preview_image).
+    """
+    with PIL.Image.open(file_path) as image:
+        image.seek(page)
+        if image.mode in NATIVE_MODES or image.mode in GREY_MODES:
+            return None
+        if image.format == "JPEG":
+            image.draft("RGB", size)                                            # DCT scaling in the decoder
+        image = image.convert("RGBA" if "A" in image.mode or "transparency" in image.info else "RGB")
+        factor = max(1, min(image.width//size[0], image.height//size[1]))
+        if factor > 1:
+            image = image.reduce(factor)
+        return image.resize(size, PIL.Image.LANCZOS)
+
+
+def preview_image(data, size=(250, 250)):
+    """
+    Return an 8-bit PIL image of at most size pixels to show the data.
+
+    The data are subsampled by striding before being scaled, so only the rows
+    needed are read from memory-mapped files. Counts are stretched between
+    their minimum and maximum.
+    """
+    step = max(1, int(max(data.shape[0]/size[1], data.shape[1]/size[0])))
+    sample = np.asarray(data[::step, ::step], dtype=np.float64)
+    if data.dtype == np.uint8:                                                  # 8-bit images are shown as they are
+        low, high = 0, 255
+    else:                                                                       # counts are stretched to the 8-bit range
+        low, high = np.nanmin(sample), np.nanmax(sample)
+    scale = 255/(high - low) if high > low else 0
+    sample = np.nan_to_num((sample - low)*scale).astype(np.uint8)
+    return PIL.Image.fromarray(sample).resize(size, PIL.Image.LANCZOS)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Registration of the total ion image on the Si image (translation, resolution).
+
+The normalization divides the Si counts by the total counts pixel by pixel:
+it needs both images on the same grid. A drift of the stage between the two
+acquisitions, or a different raster (256 x 256 and 512 x 512 pixels of the
+same field of view), gives a size error or normalization artefacts along the
+edges of the features. Here:
+    - the total image is first interpolated on the grid of the Si image
+      (same field of view) if their sizes differ,
+    - the translation between the images is estimated by phase correlation:
+      the cross-power spectrum of the two images (mean and intensity gradient
+      removed, Hann window against the wrap-around of the edges), divided by
+      the square root of its magnitude (partial whitening: the pure phase
+      amplifies the Poisson noise of low-count images) and weighted by a
+      Gaussian low-pass, has its inverse FFT peaking at the shift;
+      the peak is refined to 1/upsample pixel by a matrix-multiply DFT of a
+      1.5 pixel neighbourhood (Guizar-Sicairos et al., Opt. Lett. 33, 156, 2008),
+      without zero-padding the whole spectrum,
+    - the total image is resampled once (bilinear, separable) on the Si grid,
+      shifted by the estimated translation; the counts are conserved (values
+      scaled by the ratio of the pixel areas) and the pixels beyond the edges
+      of the total image repeat its edge pixels.
+The images are compared through the absolute value of the correlation, so a
+total image whose contrast is inverted (dark where the Si image is bright) is
+aligned too. When the correlation peak is not clearly above the other peaks
+(featureless or noise-only images: peak less than MIN_PEAK times the highest
+peak further than 1/low_pass pixels), the shift is 0.
+
+Shifts are in pixels of the Si image along the axes of the arrays given (the
+GUI arrays are transposed images: the first axis is x).
+
+Example:
+    total_aligned, registration = align_pair(si_image, total_image)
+    registration.shift                                                          # (1.25, -0.4)
+"""
+
+import math
+from collections import namedtuple
+
+import numpy as np
+
+import tbb1_instrument
+
+
+UPSAMPLE = 20                                                                   # precision of the shift: 1/20 pixel
+LOW_PASS = 0.05                                                                 # cycles/pixel, standard deviation of the low-pass
+WHITENING = 0.5                                                                 # cross-power divided by its magnitude**WHITENING (1: phase only)
+MIN_SHIFT = 0.5/UPSAMPLE                                                        # smaller shifts are not resampled
+MIN_PEAK = 1.5                                                                  # correlation peak / next peak (noise: 1 to 1.4)
+
+Registration = namedtuple("Registration", ["shift", "scale", "peak"])          # shift (pixels), scale (total pixels per Si pixel), peak ratio
+
+
+# ===== Shift estimate =====
+# ==========================
+
+def _spectrum(image):
+    data = np.asarray(image, dtype=np.float64)
+    data = data - data.mean()
+    for axis in (0, 1):                                                         # best-fit plane (intensity gradient) removed
+        centred = np.arange(data.shape[axis]) - (data.shape[axis] - 1)/2
+        slope = (centred*data.mean(axis=1 - axis)).sum()/max((centred**2).sum(), 1e-12)
+        data -= np.expand_dims(slope*centred, 1 - axis)
+    data *= np.outer(np.hanning(data.shape[0]), np.hanning(data.shape[1]))
+    return np.fft.rfft2(data)
+
+
+def _upsampled_correlation(cross, rows, columns, start, upsample, size):
+    """Correlation at the positions start + (0 .. size-1)/upsample (pixels) from its half spectrum (rfft2)."""
+    y = start[0] + np.arange(size)/upsample
+    x = start[1] + np.arange(size)/upsample
+    fy = np.fft.fftfreq(rows)
+    fx = np.fft.rfftfreq(columns)
+    weights = np.full(len(fx), 2.0)                                             # Hermitian symmetry: the other half
+    weights[0] = 1.0
+    if columns % 2 == 0:
+        weights[-1] = 1.0
+    ey = np.exp(2j*np.pi*np.outer(y, fy))
+    ex = np.exp(2j*np.pi*np.outer(fx, x))*weights[:, None]
+    return (ey @ cross @ ex).real
+
+
+def estimate_shift(reference, moving, upsample=UPSAMPLE, low_pass=LOW_PASS, whitening=WHITENING):
+    """
+    Translation (rows, columns) of moving relative to reference, images of the
+    same shape: moving[i, j] ~ reference[i - shift[0], j - shift[1]].
+
+    Returns (shift, peak): peak is the height of the correlation peak divided
+    by the highest value further than 1/low_pass pixels (close to 1: no
+    reliable shift, see MIN_PEAK), 0 if an image has no feature (zero
+    correlation).
+    """
+    if np.shape(reference) != np.shape(moving):
+        raise ValueError("The images do not have the same size (resample them first)")
+    rows, columns = np.shape(reference)
+    cross = np.conj(_spectrum(reference))*_spectrum(moving)
+    if whitening:
+        cross /= (np.abs(cross) + 1e-12)**whitening
+    if low_pass:
+        fy = np.fft.fftfreq(rows)[:, None]
+        fx = np.fft.rfftfreq(columns)[None, :]
+        cross *= np.exp(-(fy**2 + fx**2)/(2*low_pass**2))
+    correlation = np.abs(np.fft.irfft2(cross, s=(rows, columns)))
+    index = np.unravel_index(np.argmax(correlation), correlation.shape)
+    radius = max(2.0, 1/low_pass if low_pass else 2.0)
+    distances = [np.minimum(np.abs(np.arange(n) - i), n - np.abs(np.arange(n) - i)) for i, n in zip(index, (rows, columns))]
+    far = distances[0][:, None]**2 + distances[1][None, :]**2 > radius**2   # wrap-around distances to the peak
+    if not correlation[index] > 0:                                              # constant, zero or plane image: nothing to refine
+        return (0.0, 0.0), 0.0
+    far_max = correlation[far].max() if far.any() else None
+    peak = float("inf") if far_max is None else 0.0 if far_max == 0 else float(correlation[index]/far_max)
+    coarse = [i - n if i > n//2 else i for i, n in zip(index, (rows, columns))]
+    if upsample <= 1:
+        return (float(coarse[0]), float(coarse[1])), peak
+    size = int(math.ceil(1.5*upsample))*2 + 1                                   # +-1.5 pixels around the coarse peak
+    start = [c - (size//2)/upsample for c in coarse]
+    local = np.abs(_upsampled_correlation(cross, rows, columns, start, upsample, size))
+    i, j = np.unravel_index(np.argmax(local), local.shape)
+    return (float(start[0] + i/upsample), float(start[1] + j/upsample)), peak
+
+
+# ===== Resampling =====
+# ======================
+
+def _interpolate(data, coordinates, axis):
+    """Linear interpolation of data along one axis at the given coordinates (clamped to the edges)."""
+    n = data.shape[axis]
+    if n == 1:
+        return np.repeat(data, len(coordinates), axis=axis).astype(np.float64)
+    coordinates = np.clip(coordinates, 0, n - 1)
+    lower = np.minimum(coordinates.astype(np.intp), n - 2)
+    weight = coordinates - lower
+    shape = [1]*data.ndim
+    shape[axis] = -1
+    weight = weight.reshape(shape)
+    low = np.take(data, lower, axis=axis).astype(np.float64)
+    low *= 1 - weight
+    low += np.take(data, lower + 1, axis=axis)*weight
+    return low
+
+
+def resample(image, shape, shift=(0.0, 0.0), preserve_counts=True):
+    """
+    Image interpolated on a grid of the given shape covering the same field of
+    view, translated by -shift (pixels of the new grid): the result at (i, j)
+    is the image at (i + shift[0], j + shift[1]) of the new grid.
+    """
+    image = np.asarray(image)
+    scale = [n/m for n, m in zip(image.shape, shape)]
+    rows = (np.arange(shape[0]) + 0.5 + shift[0])*scale[0] - 0.5                # pixel centres in the image
+    columns = (np.arange(shape[1]) + 0.5 + shift[1])*scale[1] - 0.5
+    resampled = _interpolate(_interpolate(image, rows, 0), columns, 1)
+    if preserve_counts and scale != [1.0, 1.0]:
+        resampled *= scale[0]*scale[1]                                          # counts of a pixel of the new grid
+    return resampled
+
+
+# ===== Pair =====
+# ================
+
+def register(reference, moving, upsample=UPSAMPLE, low_pass=LOW_PASS):
+    """Registration of moving (any size, same field of view) on reference: shift in reference pixels."""
+    shape = np.shape(reference)
+    scale = tuple(float(n/m) for n, m in zip(np.shape(moving), shape))
+    on_grid = moving if np.shape(moving) == shape else resample(moving, shape)
+    shift, peak = estimate_shift(reference, on_grid, upsample, low_pass)
+    if not peak >= MIN_PEAK:                                                    # no feature in common (or NaN): not moved
+        shift = (0.0, 0.0)
+    return Registration(shift, scale, peak)
+
+
+def align(moving, shape, registration, preserve_counts=True):
+    """moving resampled on the reference grid (shape) and translated back by the registration shift."""
+    if np.shape(moving) == tuple(shape) and all(abs(s) < MIN_SHIFT for s in registration.shift):
+        return moving
+    return resample(moving, shape, registration.shift, preserve_counts)
+
+
+def align_pair(si, total, upsample=UPSAMPLE, low_pass=LOW_PASS, preserve_counts=True):
+    """Total ion image registered and resampled on the Si image: (aligned total, Registration)."""
+    with tbb1_instrument.stage("registration", si, total) as s:
+        registration = register(si, total, upsample, low_pass)
+        aligned = s.output(align(total, np.shape(si), registration, preserve_counts))
+    return aligned, registration
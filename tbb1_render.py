@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Level-of-detail rendering of the images and thickness maps.
+
+A 3D surface of a 512x512 image has about 260 000 polygons, which makes
+matplotlib slow to draw and to rotate. The surfaces are therefore decimated to
+a polygon budget before being drawn:
+    - "minmax" (default): each block of pixels is replaced by its extreme value
+      farthest from the block mean, so that thin film edges, spikes and
+      pinholes stay visible,
+    - "mean": each block is replaced by its mean (smoother surface).
+The full resolution of a zoomed region is drawn on demand: zoom in the 3D view
+(right mouse button) and press "r" to refine the surface to the visible x/y
+range, "o" to come back to the overview.
+
+The 2D heatmap preview (imshow of the decimated map) draws in a few tens of ms
+whatever the size of the map.
+
+A surface already drawn is updated in place (new vertices and colours of the
+same polygon collection) when a new map of the same level of detail is shown,
+e.g. while the smoothing kernel or the calibration coefficients change.
+
+Axes are 1D: x along the columns and y along the rows of z.
+"""
+
+import math
+import warnings
+
+import numpy as np
+from matplotlib import colors
+from matplotlib import cm
+
+
+DEFAULT_MAX_POLYGONS = 40000                                                    # about 200 x 200 facets
+DEFAULT_MAX_PIXELS = 512*512                                                    # heatmap preview: about 512 x 512 pixels
+DECIMATION_METHODS = ("minmax", "mean")
+
+
+# ===== Decimation =====
+# ======================
+
+def block_factor(shape, budget):
+    """Smallest block size (same along both axes) giving at most budget blocks."""
+    return max(1, math.ceil(math.sqrt(shape[0]*shape[1]/float(budget))))
+
+
+def block_reduce(z, factor, method="minmax"):
+    """Reduce a 2D array by blocks of factor x factor pixels (incomplete edge blocks included)."""
+    if method not in DECIMATION_METHODS:
+        raise ValueError("Unknown decimation method %r" % method)
+    z = np.asarray(z, dtype=np.float64)
+    if factor == 1:
+        return z
+    ny, nx = z.shape
+    pad_y, pad_x = -ny % factor, -nx % factor
+    if pad_y or pad_x:                                                          # repeat the edge: same extrema in edge blocks
+        z = np.pad(z, ((0, pad_y), (0, pad_x)), mode="edge")
+    blocks = z.reshape(z.shape[0]//factor, factor, z.shape[1]//factor, factor)
+    if not np.isnan(z).any():                                                   # fast path: reduce the rows first (contiguous memory)
+        mean = blocks.sum(axis=1).sum(axis=2)/factor**2
+        if method == "mean":
+            return mean
+        low = blocks.min(axis=1).min(axis=2)
+        high = blocks.max(axis=1).max(axis=2)
+    else:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)            # all-NaN blocks stay NaN
+            mean = np.nanmean(blocks, axis=(1, 3))
+            if method == "mean":
+                return mean
+            low = np.nanmin(blocks, axis=(1, 3))
+            high = np.nanmax(blocks, axis=(1, 3))
+    return np.where(high - mean >= mean - low, high, low)
+
+
+def _reduce_axis(axis, factor):
+    """Centre of each block of an axis."""
+    axis = np.asarray(axis, dtype=np.float64)
+    if factor == 1:
+        return axis
+    pad = -len(axis) % factor
+    padded = np.pad(axis, (0, pad), mode="edge")
+    return padded.reshape(-1, factor).mean(axis=1)
+
+
+def decimate(x, y, z, budget=DEFAULT_MAX_POLYGONS, method="minmax"):
+    """Return (x, y, z) decimated to at most budget points (and polygons)."""
+    factor = block_factor(np.shape(z), budget)
+    return _reduce_axis(x, factor), _reduce_axis(y, factor), block_reduce(z, factor, method)
+
+
+def data_range(z):
+    """Finite minimum and maximum of z (for a colour scale shared by all levels of detail)."""
+    z = np.asarray(z)
+    finite = z[np.isfinite(z)] if z.dtype.kind == "f" else z
+    if finite.size == 0:
+        return 0.0, 1.0
+    return float(finite.min()), float(finite.max())
+
+
+# ===== 3D surface =====
+# ======================
+
+class LODSurface:
+    """
+    3D surface drawn at a level of detail bounded by a polygon budget.
+
+    draw() shows the decimated overview; refine(xlim, ylim) redraws the region
+    at full resolution (decimated again only if the region is still over the
+    budget). Keys: "r" refines to the current x/y limits, "o" shows the overview.
+    """
+
+    def __init__(self, ax, x, y, z, cmap, budget=DEFAULT_MAX_POLYGONS, method="minmax", vmin=None, vmax=None):
+        self.ax = ax
+        self.x = np.asarray(x)
+        self.y = np.asarray(y)
+        self.z = z
+        self.cmap = cmap
+        self.budget = budget
+        self.method = method
+        low, high = data_range(z) if vmin is None or vmax is None else (vmin, vmax)
+        self.norm = colors.Normalize(vmin=low, vmax=high)
+        self.surface = None
+        self._cells = None                                                      # shape of the drawn grid (None: not updatable in place)
+        self._mappable = None
+        self._key_callback = ax.figure.canvas.mpl_connect("key_press_event", self._on_key)
+
+    def _draw(self, x, y, z):
+        X, Y = np.meshgrid(x, y)
+        if self.surface is not None and self._cells == np.shape(z) and np.isfinite(z).all():
+            polygons = _surface_polygons(X, Y, z)                               # Same grid: move the vertices of the drawn polygons
+            self.surface.set_verts(polygons)
+            self.surface.set_array(polygons[..., 2].mean(axis=-1))
+            self.ax.auto_scale_xyz(X, Y, z, had_data=False)
+            return self.surface
+        if self.surface is not None:
+            self.surface.remove()
+        self.surface = self.ax.plot_surface(X, Y, z, cmap=self.cmap, norm=self.norm,
+                                            rcount=z.shape[0], ccount=z.shape[1],
+                                            linewidth=0, antialiased=False)
+        self._cells = np.shape(z) if np.isfinite(z).all() else None             # non-finite facets are dropped by plot_surface
+        return self.surface
+
+    def draw(self):
+        """Draw the decimated overview of the whole surface."""
+        surface = self._draw(*decimate(self.x, self.y, self.z, self.budget, self.method))
+        self.ax.set_xlim(self.x.min(), self.x.max())
+        self.ax.set_ylim(self.y.min(), self.y.max())
+        return surface
+
+    def refine(self, xlim, ylim):
+        """Draw the region xlim x ylim at full resolution (within the polygon budget)."""
+        columns = _index_range(self.x, xlim)
+        rows = _index_range(self.y, ylim)
+        region = self.z[rows, columns]
+        surface = self._draw(*decimate(self.x[columns], self.y[rows], region, self.budget, self.method))
+        self.ax.set_xlim(*xlim)
+        self.ax.set_ylim(*ylim)
+        return surface
+
+    def set_data(self, x, y, z, vmin=None, vmax=None):
+        """Show a new map on the same axes (and colour scale objects) and draw its overview."""
+        self.x = np.asarray(x)
+        self.y = np.asarray(y)
+        self.z = z
+        low, high = data_range(z) if vmin is None or vmax is None else (vmin, vmax)
+        self.norm.vmin, self.norm.vmax = low, high                              # the colorbar follows the shared norm
+        return self.draw()
+
+    def set_cmap(self, cmap):
+        """Change the colormap of the drawn surface and of its colorbar."""
+        self.cmap = cmap
+        if self.surface is not None:
+            self.surface.set_cmap(cmap)
+        if self._mappable is not None:
+            self._mappable.set_cmap(cmap)
+
+    def mappable(self):
+        """Scalar mappable for a colorbar that stays valid when the surface is redrawn."""
+        if self._mappable is None:
+            self._mappable = cm.ScalarMappable(norm=self.norm, cmap=self.cmap)
+        return self._mappable
+
+    def disconnect(self):
+        """Stop handling the keys (before the axes are cleared)."""
+        self.ax.figure.canvas.mpl_disconnect(self._key_callback)
+
+    def _on_key(self, event):
+        if event.inaxes is not None and event.inaxes is not self.ax:
+            return
+        if event.key == "r":
+            self.refine(self.ax.get_xlim(), self.ax.get_ylim())
+        elif event.key == "o":
+            self.draw()
+        else:
+            return
+        self.ax.figure.canvas.draw_idle()
+
+
+def _surface_polygons(X, Y, Z):
+    """Facets of a surface with one quadrilateral per grid cell, as plot_surface makes them: (n, 4, 3)."""
+    grid = np.stack((X, Y, Z), axis=-1)
+    corners = (grid[:-1, :-1], grid[:-1, 1:], grid[1:, 1:], grid[1:, :-1])
+    return np.stack(corners, axis=2).reshape(-1, 4, 3)
+
+
+def _index_range(axis, limits):
+    """Slice of the (monotonic) axis values inside limits, at least 2 values long."""
+    low, high = min(limits), max(limits)
+    ascending = axis[0] <= axis[-1]
+    values = axis if ascending else axis[::-1]
+    start = max(0, np.searchsorted(values, low, side="left") - 1)
+    stop = min(len(axis), np.searchsorted(values, high, side="right") + 1)
+    stop = max(stop, min(len(axis), start + 2))
+    if not ascending:
+        start, stop = len(axis) - stop, len(axis) - start
+    return slice(start, stop)
+
+
+def surface_figure(x, y, z, cmap, title, xlabel, ylabel, zlabel,
+                   budget=DEFAULT_MAX_POLYGONS, method="minmax"):
+    """New figure with a level-of-detail 3D surface and its colorbar. Returns (fig, ax, lod)."""
+    import matplotlib.pyplot as plt                                             # Not needed by the plot area of the GUI: on first use
+    fig, ax = plt.subplots(subplot_kw={"projection": "3d"})
+    lod = LODSurface(ax, x, y, z, cmap, budget, method)
+    lod.draw()
+    fig.colorbar(lod.mappable(), ax=ax, shrink=0.5, aspect=5)                  # Add a color bar which maps values to colors.
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.set_zlabel(zlabel)
+    fig.lod = lod                                                               # Keep the key callbacks alive with the figure
+    return fig, ax, lod
+
+
+# ===== 2D heatmap =====
+# ======================
+
+def heatmap_figure(x, y, z, cmap, title, xlabel, ylabel, zlabel,
+                   max_pixels=DEFAULT_MAX_PIXELS, method="minmax"):
+    """New figure with a fast 2D heatmap preview of the map. Returns (fig, ax, image)."""
+    factor = block_factor(np.shape(z), max_pixels)
+    preview = block_reduce(z, factor, method)
+    x = np.asarray(x)
+    y = np.asarray(y)
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots()
+    image = ax.imshow(preview, cmap=cmap, origin="lower", interpolation="nearest", aspect="auto",
+                      extent=(x[0], x[-1], y[0], y[-1]))
+    fig.colorbar(image, ax=ax, label=zlabel)
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    return fig, ax, image
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Reports of many thickness maps: contact sheets rendered without a display.
+
+The maps written by tbb1_batch (or tbb1_watch) are drawn a few per page, one
+row per map: the 3D surface, the 2D heatmap with its colorbar, in the
+colormap of the GUI (popColormap), and the histogram of the values, with the
+name and the statistics of the map above the row. The pages are written as
+PNG files or gathered in one PDF file.
+
+The figures are drawn with the Agg backend (no window, no pyplot) and each
+worker process builds its page template (SheetTemplate: figure, axes,
+colorbars, surfaces, images and histograms) once, then only updates the data
+of its artists for each page, as the plot area of the GUI does (tbb1_canvas):
+    - the surfaces are decimated to REPORT_POLYGONS facets and updated in
+      place (tbb1_render.LODSurface), the heatmaps are reduced to about
+      REPORT_PIXELS pixels (the resolution of the page),
+    - the pages are shared between worker processes (one per core), each
+      one writing its pages as PNG files; a PDF report is assembled from the
+      pages in order, one page in memory at a time.
+A page of four 1024 x 1024 maps takes about 0.5 s on one core.
+
+Example:
+    python tbb1_report.py results --output report.pdf -j 4 --cmap plasma
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+import tbb1_engine
+import tbb1_render
+
+
+PAGE_SIZE = (8.27, 11.69)                                                       # inches, A4 portrait
+DPI = 120
+ROWS_PER_PAGE = 4
+REPORT_POLYGONS = 50*50                                                         # facets of the surfaces of a page
+REPORT_PIXELS = 256*256                                                         # pixels of the heatmaps of a page
+HISTOGRAM_BINS = 64
+COLORMAPS = ("plasma", "jet", "bone", "viridis")                                # those of the GUI
+
+MapEntry = namedtuple("MapEntry", ["name", "path", "xsize", "ysize", "zlabel"])
+
+
+# ===== Maps =====
+# ================
+
+def map_entry(path):
+    """MapEntry of a .npy map and of the .json metadata of tbb1_batch next to it (if any)."""
+    path = Path(path)
+    name = path.stem[:-len("_thickness")] if path.stem.endswith("_thickness") else path.stem
+    metadata_path = path.with_name(name + ".json")
+    parameters = {}
+    if metadata_path.exists():
+        with open(metadata_path) as handle:
+            parameters = json.load(handle).get("parameters", {})
+    zlabel = "Thickness (nm)" if parameters.get("calibration", True) else "Si intensity (counts)"
+    return MapEntry(name, os.fspath(path), parameters.get("xsize", 1.0), parameters.get("ysize", 1.0), zlabel)
+
+
+def find_maps(directory):
+    """Maps of a tbb1_batch output directory (<name>_thickness.npy, not the volumes of stacks), sorted by name."""
+    return [map_entry(path) for path in sorted(Path(directory).glob("*_thickness.npy"))]
+
+
+# ===== Page template =====
+# =========================
+
+class _Row:
+    """Surface, heatmap (with colorbar) and histogram of one map of the page."""
+
+    def __init__(self, figure, cell, cmap, budget, max_pixels):
+        grid = cell.subgridspec(1, 3, wspace=0.5)                                # room for the colorbar label
+        self.surface_ax = figure.add_subplot(grid[0], projection="3d")
+        self.map_ax = figure.add_subplot(grid[1])
+        self.histogram_ax = figure.add_subplot(grid[2])
+        self.image = self.map_ax.imshow(np.zeros((2, 2)), cmap=cmap, origin="lower", interpolation="nearest",
+                                        aspect="auto")
+        self.colorbar = figure.colorbar(self.image, ax=self.map_ax)
+        self.stairs = self.histogram_ax.stairs(np.zeros(HISTOGRAM_BINS), np.arange(HISTOGRAM_BINS + 1.0), fill=True)
+        top = cell.get_position(figure)
+        self.title = figure.text(top.x0, top.y1 + 0.01, "", fontsize=8)             # over the row: the 3D axes are narrow
+        for ax in (self.map_ax, self.histogram_ax):
+            ax.tick_params(labelsize=6)
+        self.colorbar.ax.tick_params(labelsize=6)
+        self.surface_ax.tick_params(labelsize=5)
+        self.histogram_ax.set_ylabel("pixels", fontsize=7)
+        self.map_ax.set_xlabel("mm", fontsize=7)
+        self.map_ax.set_ylabel("mm", fontsize=7)
+        self.cmap = cmap
+        self.budget = budget
+        self.max_pixels = max_pixels
+        self.lod = None
+
+    def set_visible(self, visible):
+        for ax in (self.surface_ax, self.map_ax, self.histogram_ax, self.colorbar.ax):
+            ax.set_visible(visible)
+        self.title.set_visible(visible)
+
+    def show(self, entry, z):
+        x, y = tbb1_engine.axes_mm(np.shape(z), entry.xsize, entry.ysize)
+        low, high = tbb1_render.data_range(z)
+        if self.lod is None:
+            self.lod = tbb1_render.LODSurface(self.surface_ax, x, y, z, self.cmap, self.budget)
+            self.lod.draw()
+        else:
+            self.lod.set_data(x, y, z)
+        self.lod.set_cmap(self.cmap)
+
+        preview = tbb1_render.block_reduce(z, tbb1_render.block_factor(np.shape(z), self.max_pixels))
+        self.image.set_data(preview)
+        self.image.set_extent((x[0], x[-1], y[0], y[-1]))
+        self.image.set_cmap(self.cmap)
+        self.image.set_clim(low, high if high > low else low + 1)
+        self.map_ax.set_xlim(x[0], x[-1])
+        self.map_ax.set_ylim(y[0], y[-1])
+        self.colorbar.set_label(entry.zlabel, fontsize=7)
+
+        values = np.asarray(z)
+        values = values[np.isfinite(values)] if values.dtype.kind == "f" else values.ravel()
+        counts, edges = np.histogram(values, bins=HISTOGRAM_BINS, range=(low, high if high > low else low + 1))
+        self.stairs.set_data(counts, edges)
+        self.histogram_ax.set_xlim(edges[0], edges[-1])
+        self.histogram_ax.set_ylim(0, max(1, counts.max())*1.05)
+        self.histogram_ax.set_xlabel(entry.zlabel, fontsize=7)
+        mean = float(values.mean()) if values.size else float("nan")
+        self.title.set_text("%s   mean %.4g   min %.4g   max %.4g   %.1f %% finite" % (
+            entry.name, mean, low, high, 100.0*values.size/max(1, np.size(z))))
+
+
+class SheetTemplate:
+    """Page of rows maps, built once and redrawn with new data for every page (Agg, no display)."""
+
+    def __init__(self, rows=ROWS_PER_PAGE, cmap="plasma", size=PAGE_SIZE, dpi=DPI,
+                 budget=REPORT_POLYGONS, max_pixels=REPORT_PIXELS):
+        from matplotlib.figure import Figure                                    # no pyplot: no window, no global state
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        self.figure = Figure(figsize=size, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        grid = self.figure.add_gridspec(rows, 1, left=0.04, right=0.97, top=0.95, bottom=0.06, hspace=0.45)
+        self.rows = [_Row(self.figure, grid[row], cmap, budget, max_pixels) for row in range(rows)]
+        self.footer = self.figure.text(0.5, 0.012, "", ha="center", fontsize=7)
+
+    def render(self, entries, file_path, footer=""):
+        """Draw the maps of the entries (at most rows) and write the page (format of the extension of file_path)."""
+        for row, entry in zip(self.rows, entries):
+            row.show(entry, np.load(entry.path, mmap_mode="r"))
+            row.set_visible(True)
+        for row in self.rows[len(entries):]:                                    # last page: rows left empty
+            row.set_visible(False)
+        self.footer.set_text(footer)
+        self.figure.savefig(file_path)
+        return file_path
+
+
+# ===== Report =====
+# ==================
+
+_template = {}                                                                  # SheetTemplate of the worker process, by options
+
+
+def _render_page(entries, file_path, footer, rows, cmap, dpi):
+    key = (rows, cmap, dpi)
+    if key not in _template:
+        _template[key] = SheetTemplate(rows, cmap, dpi=dpi)
+    return _template[key].render(entries, file_path, footer)
+
+
+def _assemble_pdf(pages, output, dpi):
+    """One PDF of the PNG pages (in order), adding one page at a time."""
+    import PIL.Image
+    for number, page in enumerate(pages):
+        with PIL.Image.open(page) as image:
+            image.convert("RGB").save(output, "PDF", resolution=float(dpi), append=number > 0)
+
+
+def render_report(entries, output, jobs=None, rows=ROWS_PER_PAGE, cmap="plasma", dpi=DPI):
+    """
+    Contact sheets of the maps (MapEntry) written to output: a .pdf file, or
+    .png files <output stem>_001.png, ... Returns the files written.
+    """
+    output = Path(output)
+    if output.suffix.lower() not in (".pdf", ".png"):
+        raise ValueError("The report is a .pdf or .png file")
+    if not entries:
+        raise ValueError("No map to report")
+    jobs = jobs or os.cpu_count() or 1
+    pages = [entries[start:start + rows] for start in range(0, len(entries), rows)]
+    with tempfile.TemporaryDirectory(dir=output.parent) as temporary:
+        directory = Path(temporary) if output.suffix.lower() == ".pdf" else output.parent
+        files = [os.fspath(directory / ("%s_%03d.png" % (output.stem, number + 1))) for number in range(len(pages))]
+        footers = ["%s   page %d / %d" % (output.stem, number + 1, len(pages)) for number in range(len(pages))]
+        arguments = (pages, files, footers, [rows]*len(pages), [cmap]*len(pages), [dpi]*len(pages))
+        if jobs == 1 or len(pages) == 1:
+            written = list(map(_render_page, *arguments))
+        else:
+            with ProcessPoolExecutor(max_workers=min(jobs, len(pages))) as executor:
+                written = list(executor.map(_render_page, *arguments))
+        if output.suffix.lower() == ".pdf":
+            _assemble_pdf(written, output, dpi)
+            return [os.fspath(output)]
+    return written
+
+
+# ===== Command line =====
+# ========================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Contact sheets of thickness maps (surface, heatmap, histogram)")
+    parser.add_argument("maps", nargs="+", help="tbb1_batch output directories and/or .npy maps")
+    parser.add_argument("--output", required=True, help="report.pdf, or report.png for report_001.png, ...")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument("--rows", type=int, default=ROWS_PER_PAGE, help="maps per page (default: %d)" % ROWS_PER_PAGE)
+    parser.add_argument("--cmap", default=COLORMAPS[0], help="colormap (default: %s; GUI: %s)" % (
+        COLORMAPS[0], ", ".join(COLORMAPS)))
+    parser.add_argument("--dpi", type=int, default=DPI, help="resolution of the pages (default: %d)" % DPI)
+    args = parser.parse_args(argv)
+
+    entries = []
+    for source in args.maps:
+        entries.extend(find_maps(source) if os.path.isdir(source) else [map_entry(source)])
+    entries = [entry for entry in entries if np.load(entry.path, mmap_mode="r").ndim == 2]  # not the stack volumes
+    start = time.perf_counter()
+    try:
+        written = render_report(entries, args.output, args.jobs, args.rows, args.cmap, args.dpi)
+    except ValueError as error:
+        sys.exit("error: %s" % error)
+    elapsed = time.perf_counter() - start
+    print("%d maps on %d pages in %.2f s (%.1f maps/s): %s" % (
+        len(entries), -(-len(entries)//args.rows), elapsed, len(entries)/elapsed, ", ".join(written[:3]) +
+        (", ..." if len(written) > 3 else "")))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""
+Statistics of thickness maps over regions of interest (ROI).
+
+A sample usually holds many regions to compare (spots, stripes, the wells of
+a plate): for each one, the mean thickness, its standard deviation and the
+roughness Rq (root mean square of the deviations from the mean) and Ra (mean
+absolute deviation). The ROIs are given in the coordinates of the map (mm,
+x along the columns and y along the rows, as shown by the GUI):
+    "rectangle"  (x0, y0, x1, y1): the pixels whose centre is inside,
+    "polygon"    ((x, y), ...): the pixels whose centre is inside (even-odd),
+    "mask"       a bool array of the shape of the map,
+    "labels"     an int array of the shape of the map: one ROI per value > 0.
+
+The map is read once to build summed-area tables (integral images) of the
+number of finite values, of the values and of their squares (RoiTables; the
+values are offset by their mean so the squares keep their precision). Then:
+    - a rectangle costs four values of each table, whatever its size,
+    - a polygon is cut into runs of pixels along the rows (scanline), each
+      run costing four values: the cost grows with the number of rows only,
+    - masks and labels are summed over their pixels (bincount, one pass for
+      all the labels).
+Thousands of rectangles (a well plate) are evaluated in a few milliseconds as
+whole arrays. Ra is not a function of sums of powers: it is computed from the
+pixels of each ROI, once its mean is known (ra=False to skip it). The NaN
+values of the map (no calibration possible) are left out of the statistics.
+
+ROIs are loaded from a JSON file (see load_rois) or a CSV file of rectangles
+(name, x0, y0, x1, y1), or made with well_grid.
+
+Example:
+    tables = RoiTables(thickness, *tbb1_engine.axes_mm(thickness.shape, 0.5, 0.5))
+    rows = tables.statistics(well_grid((0.05, 0.05), 0.1, 0.06, 4, 4))
+"""
+
+import csv
+import json
+import math
+import os
+from collections import namedtuple
+
+import numpy as np
+
+import tbb1_instrument
+import tbb1_io
+
+
+KINDS = ("rectangle", "polygon", "mask", "labels")
+COLUMNS = ("name", "kind", "pixels", "mean", "std", "rq", "ra")                 # columns of the statistics (save_statistics)
+
+Roi = namedtuple("Roi", ["name", "kind", "geometry"])                           # geometry: see the module docstring
+
+
+def _summed_area(data, dtype):
+    table = np.zeros((data.shape[0] + 1, data.shape[1] + 1), dtype=dtype)
+    np.cumsum(data, axis=0, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return table
+
+
+def _corners(table, r0, c0, r1, c1):
+    """Sums of the table over the boxes [r0, r1) x [c0, c1) (arrays of indices)."""
+    return table[r1, c1] - table[r0, c1] - table[r1, c0] + table[r0, c0]
+
+
+def _moments(count, total, squares, offset):
+    """pixels, mean, std (n - 1), rq from the number of values, the sums of values and of squares (offset)."""
+    count = np.asarray(count, dtype=np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = total/count
+        variance = np.maximum(squares/count - mean**2, 0.0)
+        std = np.sqrt(variance*count/(count - 1))
+    std[count < 2] = np.nan
+    return {"pixels": count.astype(np.int64), "mean": mean + offset, "std": std, "rq": np.sqrt(variance)}
+
+
+class RoiTables:
+    """
+    Summed-area tables of a map (number of finite values, values and squares,
+    offset by the mean), and the axes (mm) giving the pixels of the ROIs.
+    """
+
+    def __init__(self, z, x=None, y=None):
+        z = np.asarray(z)
+        if z.ndim != 2:
+            raise ValueError("The ROI statistics need a 2D map")
+        with tbb1_instrument.stage("roi_tables", z) as s:
+            self.z = z
+            self.shape = z.shape
+            finite = np.isfinite(z)
+            self.offset = float(z[finite].mean()) if finite.any() else 0.0
+            values = np.where(finite, z - self.offset, 0.0)
+            self.count = None if finite.all() else _summed_area(finite, np.int64)   # all finite: the areas
+            self.sums = _summed_area(values, np.float64)
+            values *= values
+            self.squares = _summed_area(values, np.float64)
+            s.output(self.sums)
+        self.x = np.arange(self.shape[1], dtype=np.float64) if x is None else np.asarray(x, dtype=np.float64)
+        self.y = np.arange(self.shape[0], dtype=np.float64) if y is None else np.asarray(y, dtype=np.float64)
+
+    @property
+    def nbytes(self):
+        return self.sums.nbytes + self.squares.nbytes + (0 if self.count is None else self.count.nbytes)
+
+    def _index(self, x, y):
+        """Column and row coordinates (pixels, float) of points given in mm."""
+        dx = self.x[1] - self.x[0] if len(self.x) > 1 else 1.0
+        dy = self.y[1] - self.y[0] if len(self.y) > 1 else 1.0
+        return (np.asarray(x, dtype=np.float64) - self.x[0])/dx, (np.asarray(y, dtype=np.float64) - self.y[0])/dy
+
+    def _boxes(self, r0, c0, r1, c1):
+        sums = _corners(self.sums, r0, c0, r1, c1)
+        squares = _corners(self.squares, r0, c0, r1, c1)
+        count = (r1 - r0)*(c1 - c0) if self.count is None else _corners(self.count, r0, c0, r1, c1)
+        return count, sums, squares
+
+    # ===== Rectangles and polygons =====
+    # ===================================
+
+    def rectangle_boxes(self, rectangles):
+        """Pixel boxes (r0, c0, r1, c1), half-open, of rectangles (N x 4: x0, y0, x1, y1 in mm)."""
+        rectangles = np.asarray(rectangles, dtype=np.float64).reshape(-1, 4)
+        u0, v0 = self._index(rectangles[:, 0], rectangles[:, 1])
+        u1, v1 = self._index(rectangles[:, 2], rectangles[:, 3])
+        c0 = np.clip(np.ceil(np.minimum(u0, u1) - 1e-9), 0, self.shape[1]).astype(np.intp)   # pixel centres inside
+        c1 = np.clip(np.floor(np.maximum(u0, u1) + 1e-9) + 1, 0, self.shape[1]).astype(np.intp)
+        r0 = np.clip(np.ceil(np.minimum(v0, v1) - 1e-9), 0, self.shape[0]).astype(np.intp)
+        r1 = np.clip(np.floor(np.maximum(v0, v1) + 1e-9) + 1, 0, self.shape[0]).astype(np.intp)
+        return r0, c0, np.maximum(r1, r0), np.maximum(c1, c0)
+
+    def rectangles(self, rectangles):
+        """Statistics (pixels, mean, std, rq: arrays) of N rectangles, four values of each table per rectangle."""
+        return _moments(*self._boxes(*self.rectangle_boxes(rectangles)), self.offset)
+
+    def polygon_runs(self, vertices):
+        """Runs of pixels (rows, c0, c1), half-open, whose centres are inside a polygon ((x, y) in mm)."""
+        vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+        u, v = self._index(vertices[:, 0], vertices[:, 1])
+        first = max(0, math.ceil(v.min()))
+        last = min(self.shape[0] - 1, math.floor(v.max()))
+        if len(vertices) < 3 or last < first:
+            return np.zeros(0, np.intp), np.zeros(0, np.intp), np.zeros(0, np.intp)
+        rows = np.arange(first, last + 1, dtype=np.float64)[:, None]
+        ua, va, ub, vb = u, v, np.roll(u, -1), np.roll(v, -1)                   # edges a -> b
+        crossing = (va <= rows) != (vb <= rows)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            x = np.where(crossing, ua + (rows - va)*(ub - ua)/(vb - va), np.inf)
+        x.sort(axis=1)                                                          # even number of crossings per row
+        x = x[:, :2*(np.count_nonzero(crossing, axis=1).max()//2)]
+        c0 = np.clip(np.ceil(x[:, 0::2]), 0, self.shape[1])
+        c1 = np.clip(np.ceil(x[:, 1::2]), 0, self.shape[1])
+        keep = c1 > c0
+        rows = np.broadcast_to(rows, c0.shape)[keep].astype(np.intp)
+        return rows, c0[keep].astype(np.intp), c1[keep].astype(np.intp)
+
+    def polygon(self, vertices):
+        """Statistics of a polygon from the runs of pixels of its rows."""
+        rows, c0, c1 = self.polygon_runs(vertices)
+        count, sums, squares = (np.sum(value) for value in self._boxes(rows, c0, rows + 1, c1))
+        return _moments([count], [sums], [squares], self.offset)
+
+    # ===== Masks =====
+    # =================
+
+    def labels(self, labels):
+        """Statistics of the ROIs of a label image (int >= 0, 0: none), one pass: (label values, statistics)."""
+        labels = np.asarray(labels).astype(np.intp, copy=False)
+        if labels.shape != self.shape:
+            raise ValueError("The mask does not have the size of the map")
+        if labels.min(initial=0) < 0:
+            raise ValueError("The labels of a mask must be positive")
+        n = labels.max(initial=0) + 1
+        present = np.flatnonzero(np.bincount(labels.ravel(), minlength=n))
+        present = present[present > 0]
+        finite = np.isfinite(self.z)
+        index = labels[finite]
+        values = self.z[finite] - self.offset
+        count = np.bincount(index, minlength=n)[present]
+        sums = np.bincount(index, weights=values, minlength=n)[present]
+        squares = np.bincount(index, weights=values*values, minlength=n)[present]
+        return present, _moments(count, sums, squares, self.offset)
+
+    # ===== Roughness Ra =====
+    # ========================
+
+    def _ra(self, values, mean):
+        values = values[np.isfinite(values)]
+        return float(np.abs(values - mean).mean()) if values.size else math.nan
+
+    def ra_rectangles(self, rectangles, means):
+        r0, c0, r1, c1 = self.rectangle_boxes(rectangles)
+        return np.array([self._ra(self.z[a:b, c:d], mean) for a, c, b, d, mean in zip(r0, c0, r1, c1, means)])
+
+    def ra_polygon(self, vertices, mean):
+        rows, c0, c1 = self.polygon_runs(vertices)
+        if not len(rows):
+            return math.nan
+        left, right = c0.min(), c1.max()                                        # mask of the bounding box
+        edges = np.zeros((rows.max() - rows.min() + 1, right - left + 1), dtype=np.int32)
+        np.add.at(edges, (rows - rows.min(), c0 - left), 1)
+        np.add.at(edges, (rows - rows.min(), c1 - left), -1)
+        inside = np.cumsum(edges, axis=1)[:, :-1] > 0
+        return self._ra(self.z[rows.min():rows.max() + 1, left:right][inside], mean)
+
+    def ra_labels(self, labels, present, means):
+        labels = np.asarray(labels).astype(np.intp, copy=False)
+        finite = np.isfinite(self.z) & (labels > 0)
+        index = labels[finite]
+        lookup = np.full(labels.max(initial=0) + 1, np.nan)
+        lookup[present] = means
+        deviations = np.bincount(index, weights=np.abs(self.z[finite] - lookup[index]), minlength=len(lookup))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return deviations[present]/np.bincount(index, minlength=len(lookup))[present]
+
+    # ===== All the ROIs =====
+    # ========================
+
+    def statistics(self, rois, ra=True):
+        """
+        Statistics of a list of Roi: one dictionary per ROI (per label of the
+        "labels" ROIs) with the COLUMNS and "roi", the index of the ROI in the
+        list. The rectangles are evaluated together.
+        """
+        rows = [None]*len(rois)
+        rectangles = [i for i, roi in enumerate(rois) if roi.kind == "rectangle"]
+        with tbb1_instrument.stage("roi_statistics", rois=len(rois), ra=ra):
+            if rectangles:
+                geometry = [rois[i].geometry for i in rectangles]
+                moments = self.rectangles(geometry)
+                moments["ra"] = self.ra_rectangles(geometry, moments["mean"]) if ra else np.full(len(geometry), np.nan)
+                for n, i in enumerate(rectangles):
+                    rows[i] = [_row(i, rois[i].name, "rectangle", moments, n)]
+            for i, roi in enumerate(rois):
+                if roi.kind == "polygon":
+                    moments = self.polygon(roi.geometry)
+                    moments["ra"] = [self.ra_polygon(roi.geometry, moments["mean"][0]) if ra else math.nan]
+                    rows[i] = [_row(i, roi.name, roi.kind, moments, 0)]
+                elif roi.kind in ("mask", "labels"):
+                    labels = np.asarray(roi.geometry)
+                    labels = labels.astype(bool).astype(np.uint8) if roi.kind == "mask" else labels
+                    if labels.shape != self.shape:
+                        raise ValueError("The mask of the ROI %r does not have the size of the map" % roi.name)
+                    present, moments = self.labels(labels)
+                    moments["ra"] = self.ra_labels(labels, present, moments["mean"]) if ra else np.full(len(present), np.nan)
+                    names = [roi.name] if roi.kind == "mask" else ["%s %d" % (roi.name, label) for label in present]
+                    rows[i] = [_row(i, name, roi.kind, moments, n) for n, name in enumerate(names)]
+                    if not len(present):
+                        rows[i] = [dict(roi=i, name=roi.name, kind=roi.kind, pixels=0, mean=math.nan, std=math.nan,
+                                        rq=math.nan, ra=math.nan)]
+                elif roi.kind != "rectangle":
+                    raise ValueError("Unknown ROI kind %r (%s)" % (roi.kind, ", ".join(KINDS)))
+        return [row for group in rows for row in group]
+
+
+def _row(i, name, kind, moments, n):
+    return dict(roi=i, name=name, kind=kind, **{key: (int if key == "pixels" else float)(moments[key][n])
+                                         for key in ("pixels", "mean", "std", "rq", "ra")})
+
+
+def roi_statistics(z, rois, x=None, y=None, ra=True):
+    """Statistics of the ROIs of a map (tables built for this call only, see RoiTables to reuse them)."""
+    return RoiTables(z, x, y).statistics(rois, ra)
+
+
+# ===== ROI files =====
+# =====================
+
+def well_grid(origin, pitch, size, rows, columns, prefix=""):
+    """
+    Square rectangles of a well plate: rows x columns wells of side size (mm),
+    centres at origin + (column, row)*pitch, named "A1", "A2", ... "B1", ...
+    """
+    pitch = pitch if np.ndim(pitch) else (pitch, pitch)
+    rois = []
+    for row in range(rows):
+        for column in range(columns):
+            x = origin[0] + column*pitch[0]
+            y = origin[1] + row*pitch[1]
+            name = "%s%s%d" % (prefix, _row_letters(row), column + 1)
+            rois.append(Roi(name, "rectangle", (x - size/2, y - size/2, x + size/2, y + size/2)))
+    return rois
+
+
+def _row_letters(row):
+    letters = ""
+    row += 1
+    while row:
+        row, remainder = divmod(row - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return letters
+
+
+def load_rois(path, transposed=True):
+    """
+    ROIs of a file:
+        .csv    rectangles, columns name, x0, y0, x1, y1 (mm),
+        .json   {"rois": [{"name": ..., "rectangle": [x0, y0, x1, y1]},
+                          {"name": ..., "polygon": [[x, y], ...]},
+                          {"name": ..., "mask": "mask.png"}, ...]}: a mask
+                image (relative to the JSON file) with 0 outside gives one
+                ROI, or one per value with "labels" instead of "mask",
+        image   a mask or label image (.png, .tif, ...): one ROI per value > 0.
+    Mask images are in image orientation; transposed=True gives the transposed
+    masks of the GUI maps (see tbb1_export).
+    """
+    path = os.fspath(path)
+    name, extension = os.path.splitext(os.path.basename(path))
+    extension = extension.lower()
+    if extension == ".csv":
+        with open(path, newline="") as handle:
+            return [Roi(row["name"], "rectangle", tuple(float(row[key]) for key in ("x0", "y0", "x1", "y1")))
+                    for row in csv.DictReader(handle)]
+    if extension != ".json":
+        return [Roi(name, "labels", _read_mask(path, transposed))]
+    with open(path) as handle:
+        content = json.load(handle)
+    rois = []
+    for n, item in enumerate(content.get("rois", content) if isinstance(content, dict) else content):
+        kinds = [kind for kind in KINDS if kind in item]
+        if len(kinds) != 1:
+            raise ValueError("ROI %d of %s: give one of %s" % (n + 1, path, ", ".join(KINDS)))
+        kind, geometry = kinds[0], item[kinds[0]]
+        if kind in ("mask", "labels"):
+            geometry = _read_mask(os.path.join(os.path.dirname(path), geometry), transposed)
+        elif kind == "rectangle":
+            geometry = tuple(float(value) for value in geometry)
+        else:
+            geometry = tuple((float(x), float(y)) for x, y in geometry)
+        rois.append(Roi(item.get("name", "ROI %d" % (n + 1)), kind, geometry))
+    return rois
+
+
+def _read_mask(path, transposed):
+    mask = np.asarray(tbb1_io.read_image(path, mmap=False))
+    return np.ascontiguousarray(mask.T) if transposed else mask
+
+
+def save_rois(path, rois):
+    """Write the rectangle and polygon ROIs to a JSON file (read again by load_rois; masks are not written)."""
+    items = [{"name": roi.name, roi.kind: [list(point) for point in roi.geometry] if roi.kind == "polygon"
+              else list(roi.geometry)} for roi in rois if roi.kind in ("rectangle", "polygon")]
+    with open(path, "w") as handle:
+        json.dump({"rois": items}, handle, indent=2)
+
+
+def save_statistics(path, rows):
+    """Write the statistics of the ROIs (rows of RoiTables.statistics) to a CSV file."""
+    with open(path, "w", newline="") as handle:
+        writer = csv.DictWriter(handle, fieldnames=COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
@@ -0,0 +1,496 @@
+# -*- coding: utf-8 -*-
+"""
+Local HTTP service computing thickness maps (for a LIMS or notebooks).
+
+The computations are those of the GUI (PixelToCount and Plot) and of
+tbb1_batch: tbb1_engine.ThicknessPipeline, run in a pool of worker processes
+started (and warmed up: numpy, PIL and tbb1_engine imported, one small map
+computed) when the service starts, so a request pays neither an interpreter
+start nor an import. The HTTP server answers each request in a thread, so
+several requests are computed at the same time, one per worker; at most
+--max-queue requests wait for a worker, further ones are refused (503).
+
+    POST /thickness     the images and the parameters, as
+                            - multipart/form-data: files "si" and optionally
+                              "total", the parameters as fields,
+                            - or JSON: {"si_path": ..., "total_path": ...,
+                              parameters}, images read from the local disk,
+                        parameters (also in the query string): xsize, ysize
+                        (mm), counts_si, counts_total (counts/pixel factors),
+                        raster_factor, smooth (kernel size), smooth_mode,
+                        binning, register, molecule or a, b, a_norm, b_norm,
+                        calibration (default 1), normalization (default 1 if a
+                        total image is given), float32, and format:
+                            json   (default) {"metadata": ..., "thickness": [[...]]},
+                                   NaN as null,
+                            npy    the map as a .npy file, the metadata (JSON) in
+                                   the header X-TBB1-Metadata,
+                            stats  {"metadata": ...} only.
+                        The metadata holds the map statistics (min, max, mean,
+                        finite fraction), the shape, the parameters and the
+                        timings, as the .json files of tbb1_batch; the map is
+                        oriented as those of tbb1_batch and of the GUI.
+    GET /metrics        number of requests, errors, requests running and
+                        waiting, and the latency (total, waiting for a worker,
+                        computation) of the last METRICS_WINDOW requests:
+                        mean, 50th, 90th and 99th percentiles and maximum (s).
+    GET /health         {"status": "ok", "workers": n}.
+    GET /molecules      the molecule library {group: {molecule: [a, b, a_norm, b_norm]}}:
+                        tbb1_engine.MOLECULE_LIBRARY, or with --library the
+                        coefficients fitted from the calibration workbook (as
+                        the GUI), which then also give those of molecule=.
+
+The service listens on 127.0.0.1 by default (the JSON requests read any file
+the service can read: keep it local). request_thickness() is a client for
+notebooks and tests.
+
+Example:
+    python tbb1_server.py --port 8765 -j 4
+    curl -F si=@sample1_Si.png -F total=@sample1_total.png -F molecule=Lysozyme \
+         -F xsize=0.5 -F ysize=0.5 "http://127.0.0.1:8765/thickness?format=stats"
+"""
+
+import argparse
+import collections
+import email.message
+import email.parser
+import email.policy
+import io
+import json
+import math
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import tbb1_batch
+import tbb1_calibration
+import tbb1_engine
+import tbb1_io
+
+
+HOST = "127.0.0.1"
+PORT = 8765
+METRICS_WINDOW = 1000                                                           # requests kept for the latency percentiles
+MAX_BODY = 1024**3                                                              # bytes of a request (images included)
+FORMATS = ("json", "npy", "stats")
+
+# Request parameter: (ThicknessPipeline parameter, type); the names are those of the tbb1_batch options
+PARAMETERS = {
+    "xsize": ("xsize", float),
+    "ysize": ("ysize", float),
+    "counts_si": ("counts_pixel_factor1", float),
+    "counts_total": ("counts_pixel_factor2", float),
+    "raster_factor": ("pixels_raster_factor", float),
+    "smooth": ("kernel_size", int),
+    "smooth_mode": ("smooth_mode", str),
+    "binning": ("binning_target", float),
+    "register": ("registration", bool),
+    "molecule": ("molecule", str),
+    "a": ("a", float),
+    "b": ("b", float),
+    "a_norm": ("a_norm", float),
+    "b_norm": ("b_norm", float),
+    "calibration": ("calibration", bool),
+    "normalization": ("normalization", bool),
+}
+
+
+class RequestError(ValueError):
+    """Error of the request (HTTP status 400, or the given status)."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+# ===== Workers =====
+# ===================
+
+def _warm_up():
+    """Run in each worker when the pool starts: imports and one small map computed."""
+    tbb1_engine.ThicknessPipeline(a=1.0, b=1.0, a_norm=1.0, b_norm=1.0).process_arrays(
+        np.ones((8, 8)), np.ones((8, 8)))
+    return os.getpid()
+
+
+def _read(source):
+    """Transposed image (as tbb1_engine.load_image) of a local path or of the bytes of a file."""
+    if isinstance(source, bytes):
+        return np.transpose(tbb1_io.read_image(io.BytesIO(source), mmap=False))
+    return tbb1_engine.load_image(source)
+
+
+def compute_map(parameters, si, total=None, si_name=None, total_name=None):
+    """
+    Run in a worker: map and metadata of images (local paths or bytes of the
+    files) with the parameters of a ThicknessPipeline. Returns (map, metadata).
+    """
+    start = time.time()
+    pipeline = tbb1_engine.ThicknessPipeline(**parameters)
+    si_image = _read(si)
+    total_image = None if total is None else _read(total)
+    load_time = time.time() - start
+    result = pipeline.process_arrays(si_image, total_image)
+    result["timings"] = dict(load=load_time, **result["timings"])
+    metadata = pipeline.metadata(result, si_name, total_name)
+    metadata["worker_start"] = start                                            # epoch: the waiting time of the request
+    return result["thickness"], metadata
+
+
+# ===== Request parsing =====
+# ===========================
+
+def _boolean(value):
+    if isinstance(value, bool):
+        return value
+    if str(value).strip().lower() in ("1", "true", "yes", "on"):
+        return True
+    if str(value).strip().lower() in ("0", "false", "no", "off", ""):
+        return False
+    raise ValueError("not a boolean: %r" % value)
+
+
+def pipeline_parameters(fields, total_given, library=None):
+    """
+    ThicknessPipeline parameters of the request fields (names of PARAMETERS);
+    RequestError if invalid. The coefficients of molecule are taken from
+    library (default: tbb1_engine.MOLECULE_LIBRARY) here, not in the workers.
+    """
+    unknown = set(fields) - set(PARAMETERS) - {"format", "float32", "si_path", "total_path"}
+    if unknown:
+        raise RequestError("Unknown parameters: %s" % ", ".join(sorted(unknown)))
+    parameters = {}
+    for name, (parameter, kind) in PARAMETERS.items():
+        if fields.get(name) in (None, ""):
+            continue
+        try:
+            parameters[parameter] = _boolean(fields[name]) if kind is bool else kind(fields[name])
+        except ValueError:
+            raise RequestError("%s: %r is not a %s" % (name, fields[name], kind.__name__)) from None
+    parameters.setdefault("normalization", total_given)
+    parameters.setdefault("calibration", True)
+    parameters["dtype"] = "float32" if _boolean(fields.get("float32", False)) else "float64"
+    if parameters["normalization"] and not total_given:
+        raise RequestError("The normalization needs the total ion image (or normalization=0)")
+    coefficients = [parameters.get(name) for name in ("a", "b", "a_norm", "b_norm")]
+    if parameters["calibration"] and parameters.get("molecule") is None and None in coefficients:
+        raise RequestError("Give a molecule of the library or the coefficients a, b, a_norm, b_norm (or calibration=0)")
+    try:
+        pipeline = tbb1_engine.ThicknessPipeline(library=library, **parameters)  # checked here: 400 before the queue
+    except KeyError as error:
+        raise RequestError(error.args[0]) from None
+    except ValueError as error:
+        raise RequestError(str(error)) from None
+    if "molecule" in parameters:
+        parameters.update(a=pipeline.a, b=pipeline.b, a_norm=pipeline.a_norm, b_norm=pipeline.b_norm)
+    return parameters
+
+
+def parse_multipart(content_type, body):
+    """
+    Fields (name: text) and files (name: (file name, bytes)) of a
+    multipart/form-data body. The body is cut at the boundaries and only the
+    headers of the parts are parsed (email parses the images too, slowly).
+    """
+    header = email.message.Message()
+    header["Content-Type"] = content_type
+    boundary = header.get_param("boundary")
+    if not boundary:
+        raise RequestError("No boundary in the multipart Content-Type")
+    fields, files = {}, {}
+    for part in body.split(b"--" + boundary.encode("latin-1"))[1:]:
+        if part.startswith(b"--"):                                              # closing boundary
+            break
+        headers, separator, payload = part.partition(b"\r\n\r\n")
+        if not separator:
+            raise RequestError("The multipart body could not be read")
+        headers = email.parser.BytesHeaderParser(policy=email.policy.HTTP).parsebytes(headers.lstrip(b"\r\n") + separator)
+        name = headers.get_param("name", header="content-disposition")
+        payload = payload[:-2] if payload.endswith(b"\r\n") else payload
+        if headers.get_filename() is not None:
+            files[name] = (headers.get_filename(), payload)
+        else:
+            fields[name] = payload.decode("utf-8")
+    return fields, files
+
+
+# ===== Metrics =====
+# ===================
+
+class LatencyMetrics:
+    """Counts and latencies (s) of the requests, the last METRICS_WINDOW kept for the percentiles."""
+
+    def __init__(self, window=METRICS_WINDOW):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.running = 0
+        self.samples = {name: collections.deque(maxlen=window) for name in ("total", "wait", "compute")}
+
+    def begin(self):
+        with self.lock:
+            self.running += 1
+
+    def end(self, total, wait=None, compute=None, error=False):
+        with self.lock:
+            self.running -= 1
+            self.requests += 1
+            self.errors += bool(error)
+            for name, value in (("total", total), ("wait", wait), ("compute", compute)):
+                if value is not None:
+                    self.samples[name].append(value)
+
+    def snapshot(self, waiting=0):
+        with self.lock:
+            uptime = time.time() - self.started
+            latency = {}
+            for name, samples in self.samples.items():
+                values = np.array(samples)
+                latency[name] = None if not len(values) else dict(
+                    mean=float(values.mean()), max=float(values.max()),
+                    **{"p%d" % q: float(np.percentile(values, q)) for q in (50, 90, 99)})
+            return {"requests": self.requests, "errors": self.errors, "running": self.running, "waiting": waiting,
+                    "uptime": uptime, "requests_per_second": self.requests/uptime if uptime else None,
+                    "latency": latency}
+
+
+# ===== Server =====
+# ==================
+
+class ThicknessServer(ThreadingHTTPServer):
+    """HTTP server holding the pool of warm workers and the metrics."""
+
+    daemon_threads = True
+
+    def __init__(self, address=(HOST, PORT), jobs=None, max_queue=None, verbose=False, library=None):
+        super().__init__(address, ThicknessHandler)
+        self.library = library                                                  # None: tbb1_engine.MOLECULE_LIBRARY
+        self.jobs = jobs or os.cpu_count() or 1
+        self.executor = self._start_pool()
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(self.jobs + (self.jobs if max_queue is None else max_queue))
+        self.metrics = LatencyMetrics()
+        self.verbose = verbose
+
+    def _start_pool(self):
+        """Pool of jobs workers, all started and warmed up before it is used."""
+        executor = ProcessPoolExecutor(max_workers=self.jobs)
+        for future in [executor.submit(_warm_up) for _ in range(self.jobs)]:     # all the workers started now
+            future.result()
+        return executor
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    def waiting(self):
+        return max(0, self.metrics.running - self.jobs)
+
+    def compute(self, parameters, si, total=None, si_name=None, total_name=None):
+        """Map and metadata computed by a worker; RequestError (503) if too many requests are waiting."""
+        if not self.slots.acquire(blocking=False):
+            raise RequestError("Too many requests waiting for a worker, retry later", 503)
+        executor = self.executor
+        try:
+            return executor.submit(compute_map, parameters, si, total, si_name, total_name).result()
+        except BrokenProcessPool:                                               # a worker died (out of memory, ...): new warm pool
+            with self.lock:
+                if self.executor is executor:
+                    self.executor = self._start_pool()
+            raise
+        finally:
+            self.slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(cancel_futures=True)
+
+
+class ThicknessHandler(BaseHTTPRequestHandler):
+    server_version = "TBB1/1"
+    protocol_version = "HTTP/1.1"                                               # connections kept open by the clients
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send(self, status, body, content_type="application/json", headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body, allow_nan=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if path == "/health":
+            self._send(200, {"status": "ok", "workers": self.server.jobs})
+        elif path == "/metrics":
+            self._send(200, self.server.metrics.snapshot(self.server.waiting()))
+        elif path == "/molecules":
+            self._send(200, tbb1_engine.MOLECULE_LIBRARY if self.server.library is None else self.server.library)
+        else:
+            self._send(404, {"error": "Unknown path %s" % path})
+
+    def do_POST(self):
+        start = time.time()
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/thickness":
+            self.close_connection = True                                        # body not read
+            self._send(404, {"error": "Unknown path %s" % url.path})
+            return
+        self.server.metrics.begin()
+        wait = compute = None
+        try:
+            fields, si, total, names = self._read_request(url.query)
+            format = fields.get("format", "json")
+            if format not in FORMATS:
+                raise RequestError("Unknown format %r (%s)" % (format, ", ".join(FORMATS)))
+            parameters = pipeline_parameters(fields, total is not None, self.server.library)
+            queued = time.time()
+            thickness, metadata = self.server.compute(parameters, si, total, *names)
+            wait = max(0.0, metadata.pop("worker_start") - queued)
+            compute = sum(metadata["timings"].values())
+            metadata["request_time"] = time.time() - start
+            self._send_map(format, thickness, metadata)
+        except RequestError as error:
+            self.close_connection = error.status == 413                         # body not read
+            self._send(error.status, {"error": str(error)})
+            self.server.metrics.end(time.time() - start, error=True)
+        except Exception as error:                                              # image not readable, ...
+            self._send(500 if not isinstance(error, (OSError, ValueError)) else 422,
+                       {"error": "%s: %s" % (type(error).__name__, error)})
+            self.server.metrics.end(time.time() - start, error=True)
+        else:
+            self.server.metrics.end(time.time() - start, wait, compute)
+
+    def _read_request(self, query):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY:
+            raise RequestError("The request is larger than %d bytes" % MAX_BODY, 413)
+        body = self.rfile.read(length)
+        fields = {name: values[-1] for name, values in urllib.parse.parse_qs(query).items()}
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("multipart/form-data"):
+            form, files = parse_multipart(content_type, body)
+            fields.update(form)
+            if "si" not in files:
+                raise RequestError("No Si image (file field \"si\")")
+            total = files.get("total")
+            return fields, files["si"][1], total and total[1], (files["si"][0], total and total[0])
+        try:
+            parameters = json.loads(body or b"{}")
+        except ValueError:
+            raise RequestError("The body is neither multipart/form-data nor JSON") from None
+        if not isinstance(parameters, dict):
+            raise RequestError("The JSON body is not an object")
+        fields.update(parameters)
+        if not fields.get("si_path"):
+            raise RequestError("No Si image (si_path)")
+        for name in ("si_path", "total_path"):
+            if fields.get(name) and not os.path.isfile(fields[name]):
+                raise RequestError("No file %s" % fields[name])
+        return fields, fields["si_path"], fields.get("total_path") or None, (fields["si_path"], fields.get("total_path"))
+
+    def _send_map(self, format, thickness, metadata):
+        metadata = _json_safe(metadata)
+        if format == "npy":
+            buffer = io.BytesIO()
+            np.save(buffer, thickness)
+            self._send(200, buffer.getvalue(), "application/octet-stream",
+                       {"X-TBB1-Metadata": json.dumps(metadata, allow_nan=False)})
+        elif format == "stats":
+            self._send(200, {"metadata": metadata})
+        else:
+            values = thickness.astype(object)
+            values[~np.isfinite(thickness)] = None
+            self._send(200, {"metadata": metadata, "thickness": values.tolist()})
+
+
+def _json_safe(value):
+    """NaN and infinities as None (strict JSON)."""
+    if isinstance(value, dict):
+        return {key: _json_safe(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_json_safe(item) for item in value]
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+# ===== Client =====
+# ==================
+
+def request_thickness(url, si, total=None, timeout=600, **parameters):
+    """
+    Map and metadata from the service at url (e.g. "http://127.0.0.1:8765"):
+    si and total are image files sent to the service; parameters as for
+    POST /thickness (molecule="Lysozyme", xsize=0.5, ...).
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in parameters.items():
+        parts.append(('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n'
+                      % (boundary, name, value)).encode("utf-8"))
+    for name, path in (("si", si), ("total", total)):
+        if path is not None:
+            with open(path, "rb") as handle:
+                parts.append(('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                              'Content-Type: application/octet-stream\r\n\r\n'
+                              % (boundary, name, os.path.basename(path))).encode("utf-8") + handle.read() + b"\r\n")
+    body = b"".join(parts) + ("--%s--\r\n" % boundary).encode("ascii")
+    request = urllib.request.Request(url.rstrip("/") + "/thickness?format=npy", data=body, method="POST",
+                                     headers={"Content-Type": "multipart/form-data; boundary=%s" % boundary})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return np.load(io.BytesIO(response.read())), json.loads(response.headers["X-TBB1-Metadata"])
+    except urllib.error.HTTPError as error:
+        raise RuntimeError("%s (HTTP %d)" % (json.loads(error.read()).get("error"), error.code)) from None
+
+
+# ===== Command line =====
+# ========================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local HTTP service computing thickness maps (see the module docstring)")
+    parser.add_argument("--host", default=HOST, help="address to listen on (default: %s, this computer only)" % HOST)
+    parser.add_argument("--port", type=int, default=PORT, help="port (default: %d, 0: any free port)" % PORT)
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument("--max-queue", type=int, default=None, metavar="N",
+                        help="requests waiting for a worker before new ones are refused (default: the workers)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log every request")
+    parser.add_argument("--library", nargs="?", const=tbb1_calibration.CALIBRATION_WORKBOOK, metavar="WORKBOOK",
+                        help="molecule library fitted from the calibration workbook, as in the GUI "
+                             "(default workbook: %s)" % tbb1_calibration.CALIBRATION_WORKBOOK)
+    args = parser.parse_args(argv)
+
+    library = tbb1_batch.library_from_args(args)
+    server = ThicknessServer((args.host, args.port), args.jobs, args.max_queue, args.verbose, library)
+    print("pyTBB1 service on %s (%d workers), Ctrl+C to stop" % (server.url, server.jobs), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Stacks of frames (scans) of a ToF-SIMS acquisition, processed as one volume.
+
+An acquisition holds one image per scan; following the film along the scans
+(protein adsorption, sputter dose, rinsing steps) needs a thickness map per
+frame, or per range of frames when the counts of one frame are too low. Here:
+    - the frames of both channels are read once, in blocks of frames, from
+      multi-page image files (one page per scan, memory-mapped when the TIFF
+      pages are uncompressed, see tbb1_io) or from lists of image files,
+    - their running sums along the frame axis are written in .npy files
+      (sums[k] = frame 0 + ... + frame k-1), so the counts of any range of
+      frames are sums[stop] - sums[start]: O(1) per pixel whatever the range,
+    - the maps of all the windows of frames are computed block by block along
+      the frame axis (smoothing of the whole block, then tbb1_engine.transform
+      on the 3D block) and streamed to a .npy volume,
+so the memory used depends on memory_budget, not on the number of frames.
+
+Summing before the conversion and the smoothing gives the same counts as
+summing converted and smoothed frames (both are linear); the zero counts are
+replaced in the summed counts, as for one long acquisition.
+
+Volumes are in image orientation (frames, rows, columns): np.transpose(volume[k])
+is the map of window k in the orientation of the GUI and of tbb1_batch.
+
+Example:
+    pipeline = tbb1_engine.ThicknessPipeline(molecule="Lysozyme", kernel_size=5)
+    result = process_stack(pipeline, "scans_Si.tif", "scans_total.tif", "thickness_frames.npy", window=4)
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import tbb1_engine
+import tbb1_instrument
+import tbb1_io
+import tbb1_tiled
+
+
+DEFAULT_MEMORY_BUDGET = tbb1_tiled.DEFAULT_MEMORY_BUDGET                       # for the blocks of frames
+
+
+def _frame_reader(source):
+    """(number of frames, function giving frame i) of a multi-page image file or of a list of image files."""
+    if isinstance(source, (list, tuple)):
+        return len(source), lambda i: tbb1_io.read_image(source[i])
+    pages = tbb1_io.ImagePages(source)
+    return len(pages), pages.__getitem__
+
+
+# ===== Running sums =====
+# ========================
+
+class FrameStack:
+    """
+    Frames of the Si (and total ion) channel and their running sums along the frames.
+
+    si and total are multi-page image files or lists of image files. build()
+    writes the running sums in directory (a temporary directory, removed by
+    close(), if None); sum(start, stop) then gives the counts of frames start
+    to stop - 1. Integer counts are summed exactly (int64).
+    """
+
+    def __init__(self, si, total=None, directory=None, memory_budget=DEFAULT_MEMORY_BUDGET):
+        self.readers = {"si": _frame_reader(si)}
+        if total is not None:
+            self.readers["total"] = _frame_reader(total)
+        counts = {count for count, _ in self.readers.values()}
+        if len(counts) != 1:
+            raise ValueError("The Si and total stacks do not have the same number of frames")
+        self.n_frames = counts.pop()
+        if not self.n_frames:
+            raise ValueError("The stack has no frame")
+        first = self.readers["si"][1](0)
+        self.shape = np.shape(first)
+        self.dtype = np.dtype(np.int64 if np.issubdtype(first.dtype, np.integer) else np.float64)
+        self.memory_budget = memory_budget
+        self.temporary = directory is None
+        self.directory = tempfile.mkdtemp(prefix="tbb1_stack_") if directory is None else os.fspath(directory)
+        self.sums = {}                                                          # channel: running sums (frames + 1, rows, columns)
+
+    def __len__(self):
+        return self.n_frames
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def frames_per_block(self, bytes_per_pixel):
+        """Number of frames processed together within the memory budget."""
+        frame_bytes = max(1, bytes_per_pixel*int(np.prod(self.shape)))
+        return max(1, min(self.n_frames, self.memory_budget//frame_bytes))
+
+    def build(self, progress=None):
+        """Read every frame once and write the running sums of each channel. progress(fraction) as in tbb1_tiled."""
+        block = self.frames_per_block(2*self.dtype.itemsize)                    # block of frames and its running sums
+        steps = len(self.readers)*self.n_frames
+        done = 0
+        for channel, (count, read) in self.readers.items():
+            path = os.path.join(self.directory, "%s_sums.npy" % channel)
+            sums = np.lib.format.open_memmap(path, mode="w+", dtype=self.dtype, shape=(count + 1,) + self.shape)
+            sums[0] = 0
+            frames = np.empty((block,) + self.shape, dtype=self.dtype)
+            for start in range(0, count, block):
+                stop = min(count, start + block)
+                with tbb1_instrument.stage("frames", channel=channel, start=start, stop=stop) as s:
+                    for i in range(start, stop):
+                        frame = read(i)
+                        if np.shape(frame) != self.shape:
+                            raise ValueError("Frame %d of the %s stack does not have the size of the first frame"
+                                             % (i, channel))
+                        frames[i - start] = frame
+                    part = frames[:stop - start]
+                    np.cumsum(part, axis=0, out=part)
+                    part += sums[start]
+                    sums[start + 1:stop + 1] = s.output(part)
+                done += stop - start
+                if progress is not None:
+                    progress(done/steps)
+            sums.flush()
+            del sums
+            self.sums[channel] = np.load(path, mmap_mode="r")
+        return self
+
+    def sum(self, start, stop, channel="si"):
+        """Counts of the frames start to stop - 1 of a channel (rows, columns)."""
+        sums = self.sums[channel]
+        return sums[stop] - sums[start]
+
+    def close(self):
+        self.sums = {}
+        if self.temporary:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+# ===== Thickness volume =====
+# ============================
+
+def window_starts(n_frames, window=1, step=1):
+    """First frame of each window of window frames, every step frames."""
+    if window < 1 or step < 1:
+        raise ValueError("The window and the step must be at least 1 frame")
+    if window > n_frames:
+        raise ValueError("The window (%d frames) is longer than the stack (%d frames)" % (window, n_frames))
+    return range(0, n_frames - window + 1, step)
+
+
+def thickness_series(stack, pipeline, window=1, step=1, output_path=None, progress=None):
+    """
+    Map of each window of frames with the parameters of a tbb1_engine.ThicknessPipeline.
+
+    Map k is computed from the counts of frames k*step to k*step + window - 1
+    of both channels: window=1 gives one map per frame, window=len(stack) the
+    map of the whole acquisition. The volume (windows, rows, columns) is
+    written in output_path (.npy, returned as a memory map) if given, else
+    returned as an array.
+    """
+    if pipeline.normalization and "total" not in stack.sums:
+        raise ValueError("The normalization needs the total stack")
+    if pipeline.binning_target:
+        raise ValueError("The adaptive binning is not available for stacks (sum more frames with the window)")
+    if pipeline.registration:
+        raise ValueError("The registration of the total image is not available for stacks")
+    starts = window_starts(len(stack), window, step)
+    shape = (len(starts),) + stack.shape
+    if output_path is not None:
+        volume = np.lib.format.open_memmap(output_path, mode="w+", dtype=pipeline.dtype, shape=shape)
+    else:
+        volume = np.empty(shape, dtype=pipeline.dtype)
+    per_pixel = tbb1_tiled.SMOOTHING_BYTES_PER_PIXEL if pipeline.kernel_size else 3*tbb1_tiled.BYTES_PER_PIXEL
+    block = stack.frames_per_block(per_pixel)
+    si_sums = stack.sums["si"]
+    total_sums = stack.sums.get("total")
+    for first in range(0, len(starts), block):
+        windows = starts[first:first + block]
+        lower = slice(windows.start, windows.stop, step)
+        upper = slice(windows.start + window, windows.stop + window, step)
+        with tbb1_instrument.stage("windows", start=windows.start, count=len(windows)) as s:
+            si = si_sums[upper] - si_sums[lower]                                # counts of each window, O(1) per pixel
+            if pipeline.kernel_size:
+                si = tbb1_engine.smooth_image(si, int(pipeline.kernel_size), pipeline.smooth_mode)
+            total = total_sums[upper] - total_sums[lower] if pipeline.normalization else None
+            out = s.output(volume[first:first + len(windows)])
+            tbb1_engine.transform(si, total, pipeline.counts_pixel_factor1, pipeline.counts_pixel_factor2,
+                                  pipeline.pixels_raster_factor, pipeline.a, pipeline.b, pipeline.a_norm,
+                                  pipeline.b_norm, pipeline.calibration, pipeline.normalization,
+                                  out=out, dtype=out.dtype)
+        if progress is not None:
+            progress((first + len(windows))/len(starts))
+    if output_path is not None:
+        volume.flush()
+    return volume
+
+
+def frame_statistics(volume):
+    """tbb1_engine.map_statistics of each map of a volume, and of the whole volume (one map in memory at a time)."""
+    frames = [tbb1_engine.map_statistics(np.asarray(volume[k])) for k in range(len(volume))]
+    finite = [frame["finite_fraction"] for frame in frames]
+    lows = [frame["min"] for frame in frames if frame["min"] is not None]
+    highs = [frame["max"] for frame in frames if frame["max"] is not None]
+    total = sum(finite)
+    whole = {
+        "finite_fraction": total/len(frames) if frames else 0.0,
+        "min": min(lows) if lows else None,
+        "max": max(highs) if highs else None,
+        "mean": sum(frame["mean"]*f for frame, f in zip(frames, finite) if f)/total if total else None,
+    }
+    return frames, whole
+
+
+def process_stack(pipeline, si_path, total_path=None, output_path="thickness_frames.npy", window=1, step=1,
+                  memory_budget=DEFAULT_MEMORY_BUDGET, progress=None):
+    """
+    Process the stacks of an acquisition with the parameters of a tbb1_engine.ThicknessPipeline.
+
+    The volume is written in output_path (.npy). Returns the same dictionary as
+    ThicknessPipeline.run, with the volume as a read-only memory map and the
+    statistics of each window in the metadata ("frame_statistics").
+    """
+    if pipeline.normalization and total_path is None:
+        raise ValueError("The normalization needs the total stack")
+    timings = {}
+    start = time.perf_counter()
+    with FrameStack(si_path, total_path if pipeline.normalization else None,
+                    memory_budget=memory_budget) as stack:
+        stack.build(None if progress is None else lambda fraction: progress(fraction/2))
+        timings["sums"] = time.perf_counter() - start
+        start = time.perf_counter()
+        thickness_series(stack, pipeline, window, step, output_path,
+                         None if progress is None else lambda fraction: progress(0.5 + fraction/2))
+        timings["windows"] = time.perf_counter() - start
+        n_frames = len(stack)
+
+    volume = np.load(output_path, mmap_mode="r")
+    frames, statistics = frame_statistics(volume)
+    x, y = tbb1_engine.axes_mm(volume.shape[:0:-1], pipeline.xsize, pipeline.ysize)  # axes of np.transpose(volume[k])
+    result = {"thickness": volume, "x": x, "y": y, "timings": timings, "statistics": statistics}
+    paths = [None if isinstance(path, (list, tuple)) else path for path in (si_path, total_path)]  # lists of frame files
+    result["metadata"] = dict(pipeline.metadata(result, *paths), frames=n_frames, window=window, step=step, frame_statistics=frames)
+    return result
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Tiled, out-of-core and multi-core processing of large images (stitched mosaics).
+
+A 10 000 x 10 000 mosaic is 800 MB per float64 layer; processing it at once
+needs several such layers. Here the images are processed by tiles:
+    - each tile of the Si image is read with a halo of kernel_size//2 pixels
+      (the reach of the box smoothing), smoothed, and only its core is kept,
+      so the tiled result is the one of the whole image (seamless tiles);
+      with the adaptive binning (tbb1_binning), the tiles are multiples of
+      the largest bins, so they hold the bins of the whole image,
+    - the tiles are processed in parallel by a pool of processes, which share
+      the input images (memory-mapped TIFF files, or the decoded images in one
+      multiprocessing.shared_memory block) instead of receiving copies,
+    - the map is written tile by tile in a .npy file opened as a memory map
+      (np.lib.format.open_memmap), so it never has to fit in memory,
+    - the tile size is derived from a memory budget (memory_budget bytes for
+      all the processes together), so the peak memory of the processing does
+      not depend on the size of the image.
+
+The .npy map has the orientation of the GUI and of tbb1_batch (transposed
+image); it can be reopened with np.load(path, mmap_mode="r").
+
+Example:
+    pipeline = tbb1_engine.ThicknessPipeline(molecule="Lysozyme", kernel_size=21)
+    result = process_tiled(pipeline, "mosaic_Si.tif", "mosaic_total.tif", "mosaic_thickness.npy",
+                           memory_budget=512*1024**2)
+"""
+
+import math
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import tbb1_binning
+import tbb1_engine
+import tbb1_instrument
+import tbb1_io
+
+
+DEFAULT_MEMORY_BUDGET = 1024**3                                                 # 1 GB for all the workers
+BYTES_PER_PIXEL = 8                                                             # float64 tile without smoothing (conversion in place)
+SMOOTHING_BYTES_PER_PIXEL = 6*8                                                 # float64 copies made by the box filter (padding, cumulative sums)
+
+Tile = namedtuple("Tile", ["core", "halo"])                                     # (row start, row stop, column start, column stop)
+
+
+# ===== Tiles =====
+# =================
+
+def halo_size(kernel_size):
+    """Pixels needed (before, after) around a tile to smooth it with a kernel_size box."""
+    if not kernel_size:
+        return 0, 0
+    before = int(kernel_size)//2
+    return before, int(kernel_size) - 1 - before
+
+
+def tile_shape(shape, kernel_size=None, memory_budget=DEFAULT_MEMORY_BUDGET, jobs=1, binning=False):
+    """
+    Largest tile (rows, columns) whose processing fits in memory_budget/jobs.
+
+    Bands of full rows are preferred (contiguous reads in the files); square
+    tiles are used when a band of rows would be thinner than its halo. With
+    binning, the tiles are multiples of tbb1_binning.MAX_BIN_SIZE.
+    """
+    before, after = halo_size(kernel_size)
+    extra = before + after
+    per_pixel = SMOOTHING_BYTES_PER_PIXEL if kernel_size or binning else BYTES_PER_PIXEL
+    max_pixels = memory_budget//(max(1, jobs)*per_pixel)
+    rows, columns = shape
+    band = max_pixels//columns - extra
+    if band >= max(extra, 1):
+        tile = min(rows, band), columns
+    else:
+        side = int(math.sqrt(max_pixels)) - extra
+        if side < 1:
+            raise ValueError("The memory budget is too small for a %s pixels kernel" % kernel_size)
+        tile = min(rows, side), min(columns, side)
+    if binning:                                                                 # bins anchored on the grid of the whole image
+        size = tbb1_binning.MAX_BIN_SIZE
+        tile = tuple(n if n == full else max(size, n//size*size) for n, full in zip(tile, shape))
+    return tile
+
+
+def plan_tiles(shape, tile, kernel_size=None):
+    """Tiles covering an image of the given shape: core and core + halo (clipped to the image)."""
+    before, after = halo_size(kernel_size)
+    rows, columns = shape
+    tiles = []
+    for r0 in range(0, rows, tile[0]):
+        r1 = min(rows, r0 + tile[0])
+        for c0 in range(0, columns, tile[1]):
+            c1 = min(columns, c0 + tile[1])
+            tiles.append(Tile((r0, r1, c0, c1),
+                              (max(0, r0 - before), min(rows, r1 + after), max(0, c0 - before), min(columns, c1 + after))))
+    return tiles
+
+
+# ===== Shared inputs =====
+# =========================
+
+def _share(file_path, page, shared_blocks):
+    """
+    Describe an input image so that the workers can open it without a copy:
+    the file itself when it can be memory-mapped, else a shared memory block
+    holding the decoded image.
+    """
+    pages = tbb1_io.ImagePages(file_path)
+    if pages.is_memory_mapped(page):
+        data = pages[page]
+        return ("file", os.fspath(file_path), page), data.shape
+    data = pages[page]
+    block = shared_memory.SharedMemory(create=True, size=max(1, data.nbytes))
+    shared_blocks.append(block)
+    np.ndarray(data.shape, data.dtype, buffer=block.buf)[...] = data
+    return ("shared", block.name, data.dtype.str, data.shape), data.shape
+
+
+def _attach(source):
+    """Open an input image described by _share (in a worker). Returns (array, shared block or None)."""
+    if source is None:
+        return None, None
+    if source[0] == "file":
+        return tbb1_io.read_image(source[1], source[2]), None
+    _, name, dtype, shape = source
+    block = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, np.dtype(dtype), buffer=block.buf), block
+
+
+# ===== Workers =====
+# ===================
+
+_WORKER = {}                                                                    # images and output opened once per worker process
+
+
+def _init_worker(pipeline, si_source, total_source, output_path):
+    _WORKER.clear()
+    _WORKER["pipeline"] = pipeline
+    _WORKER["si"], _WORKER["si_block"] = _attach(si_source)
+    _WORKER["total"], _WORKER["total_block"] = _attach(total_source)
+    _WORKER["out"] = np.load(output_path, mmap_mode="r+").T                     # file orientation (rows, columns)
+
+
+def _process_tile(tile):
+    """Smooth (with the halo), convert, normalize and calibrate one tile, write it and return its statistics."""
+    with tbb1_instrument.stage("tile", core=list(tile.core)) as s:
+        pipeline = _WORKER["pipeline"]
+        r0, r1, c0, c1 = tile.core
+        h0, h1, k0, k1 = tile.halo
+        si = _WORKER["si"][h0:h1, k0:k1]
+        if pipeline.kernel_size:
+            si = tbb1_engine.smooth_image(si, int(pipeline.kernel_size), pipeline.smooth_mode)
+        si = si[r0 - h0:r1 - h0, c0 - k0:c1 - k0]                                # core of the tile
+        total = _WORKER["total"]
+        total = None if total is None else total[r0:r1, c0:c1]
+        if pipeline.binning_target:                                             # no halo: the bins do not cross the tiles
+            bins = tbb1_binning.quadtree_bins(si, pipeline.binning_target/pipeline.counts_pixel_factor1)
+            si = bins.mean(si)
+            total = None if total is None else bins.mean(total)
+        out = s.output(_WORKER["out"][r0:r1, c0:c1])
+        tbb1_engine.transform(si, total, pipeline.counts_pixel_factor1, pipeline.counts_pixel_factor2,
+                              pipeline.pixels_raster_factor, pipeline.a, pipeline.b, pipeline.a_norm, pipeline.b_norm,
+                              pipeline.calibration, pipeline.normalization, out=out, dtype=out.dtype)
+        finite = out[np.isfinite(out)]
+        return (out.size, finite.size, float(finite.sum(dtype=np.float64)),
+                float(finite.min()) if finite.size else None, float(finite.max()) if finite.size else None)
+
+
+def _combine_statistics(parts):
+    """Statistics of the whole map (see tbb1_engine.map_statistics) from the ones of its tiles."""
+    size = sum(part[0] for part in parts)
+    count = sum(part[1] for part in parts)
+    lows = [part[3] for part in parts if part[3] is not None]
+    highs = [part[4] for part in parts if part[4] is not None]
+    return {
+        "finite_fraction": count/size if size else 0.0,
+        "min": min(lows) if lows else None,
+        "max": max(highs) if highs else None,
+        "mean": sum(part[2] for part in parts)/count if count else None,
+    }
+
+
+# ===== Tiled processing =====
+# ============================
+
+def process_tiled(pipeline, si_path, total_path=None, output_path="thickness.npy", memory_budget=DEFAULT_MEMORY_BUDGET,
+                  jobs=None, page=0, progress=None):
+    """
+    Process an image pair tile by tile with the parameters of a tbb1_engine.ThicknessPipeline.
+
+    The map is written in output_path (.npy). Returns the same dictionary as
+    ThicknessPipeline.run, with the map as a read-only memory map, plus the
+    "tiles" used. progress(fraction) is called after each tile and may raise
+    to stop the processing.
+    """
+    if pipeline.normalization and total_path is None:
+        raise ValueError("The normalization needs the total image")
+    if pipeline.registration:
+        raise ValueError("The registration of the total image is not available by tiles")
+    jobs = jobs or os.cpu_count() or 1
+    timings = {}
+    shared_blocks = []
+    start = time.perf_counter()
+    try:
+        si_source, shape = _share(si_path, page, shared_blocks)
+        total_source = None
+        if pipeline.normalization:
+            total_source, total_shape = _share(total_path, page, shared_blocks)
+            if total_shape != shape:
+                raise ValueError("The Si and total images do not have the same size")
+        out = np.lib.format.open_memmap(output_path, mode="w+", dtype=pipeline.dtype,
+                                        shape=(shape[1], shape[0]), fortran_order=True)  # transposed map, rows of the image contiguous
+        del out
+        timings["load"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        tile = tile_shape(shape, pipeline.kernel_size, memory_budget, jobs, bool(pipeline.binning_target))
+        tiles = plan_tiles(shape, tile, pipeline.kernel_size)
+        workers = min(jobs, len(tiles))
+        arguments = (pipeline, si_source, total_source, os.fspath(output_path))
+        parts = []
+        if workers == 1:
+            _init_worker(*arguments)
+            try:
+                for core in tiles:
+                    parts.append(_process_tile(core))
+                    if progress is not None:
+                        progress(len(parts)/len(tiles))
+            finally:
+                _WORKER.clear()
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=arguments) as executor:
+                futures = [executor.submit(_process_tile, core) for core in tiles]
+                try:
+                    for future in as_completed(futures):
+                        parts.append(future.result())
+                        if progress is not None:
+                            progress(len(parts)/len(tiles))
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+        timings["tiles"] = time.perf_counter() - start
+    finally:
+        for block in shared_blocks:
+            block.close()
+            block.unlink()
+
+    thickness = np.load(output_path, mmap_mode="r")
+    x, y = tbb1_engine.axes_mm(thickness.shape, pipeline.xsize, pipeline.ysize)
+    result = {"thickness": thickness, "x": x, "y": y, "timings": timings,
+              "statistics": _combine_statistics(parts), "tiles": len(tiles)}
+    result["metadata"] = dict(pipeline.metadata(result, si_path, total_path), tiles=len(tiles),
+                              tile_shape=list(tile),
+                              memory_budget=memory_budget, jobs=workers)
+    return result
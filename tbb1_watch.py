@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+Watch mode: process the Si / total ion image pairs as the instrument writes them.
+
+During a long unattended acquisition, the images are exported one after the
+other into a folder. The watcher:
+    - is woken up by the events of the file system (watchdog, if installed)
+      or looks at the folder every --interval seconds (polling), and at least
+      every REFRESH seconds with the events, in case one is missed,
+    - pairs the images by name as tbb1_batch does (<name>_Si.png with
+      <name>_total.png): a pair is complete when both images are there
+      (the Si image alone without normalization) and settled, i.e. their
+      size and modification time have not changed for --settle seconds
+      (the instrument has finished writing them),
+    - processes the complete pairs with a stored preset of the parameters
+      (JSON: the "parameters" of a batch.json or of a <name>.json written by
+      tbb1_batch, or saved with --save-preset) in a pool of worker
+      processes; each worker writes the results of its pair as soon as it is
+      done (<output>/<name>_thickness.npy and <name>.json, see tbb1_batch),
+    - keeps at most --max-pending pairs in the pool (backpressure): the
+      complete pairs wait on disk, not in memory, while the workers are
+      busy, and the oldest ones are processed first.
+
+Each pair is processed at most once, also across restarts: its name is
+written to the journal <output>/watch.jsonl ("claimed", synced to disk) before
+it is given to a worker, then "done" or "failed" with its metadata. On
+restart, the names of the journal are skipped; a pair claimed but neither done
+nor failed (the watcher was killed while processing it) is reported as
+"interrupted" and not processed again: delete its lines from the journal to
+process it again.
+
+Example:
+    python tbb1_watch.py --directory D:/acquisition --output D:/maps --preset lysozyme.json -j 4
+"""
+
+import argparse
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import tbb1_batch
+import tbb1_instrument
+
+
+JOURNAL_FILE = "watch.jsonl"                                                    # in the output directory
+SETTLE = 2.0                                                                    # s without change before a file is complete
+INTERVAL = 1.0                                                                  # s between two looks at the folder (polling)
+REFRESH = 30.0                                                                  # s, look at the folder even without events
+
+
+# ===== Journal =====
+# ===================
+
+class Journal:
+    """Append-only record (JSON lines) of the pairs claimed, done and failed."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.states = {}                                                        # name: last event
+        if self.path.exists():
+            with open(self.path) as handle:
+                for line in handle:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:                                          # last line cut by a crash
+                        continue
+                    self.states[record["name"]] = record["event"]
+        self.handle = open(self.path, "a")
+
+    def interrupted(self):
+        """Names claimed by a previous run which did not finish them."""
+        return sorted(name for name, event in self.states.items() if event == "claimed")
+
+    def __contains__(self, name):
+        return name in self.states
+
+    def write(self, event, name, **details):
+        self.states[name] = event
+        self.handle.write(json.dumps(dict(event=event, name=name, time=time.time(), **details)) + "\n")
+        self.handle.flush()
+        os.fsync(self.handle.fileno())                                          # claimed on disk before the processing starts
+
+    def close(self):
+        self.handle.close()
+
+
+# ===== Folder =====
+# =================
+
+def _signature(paths):
+    """Size and modification time of the files (None if one is missing)."""
+    try:
+        return tuple((stat.st_size, stat.st_mtime_ns) for stat in (os.stat(path) for path in paths))
+    except OSError:
+        return None
+
+
+def _start_observer(directory, wake):
+    """Wake up on the file system events of the directory (watchdog), or None if watchdog is not installed."""
+    try:
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+    except ImportError:
+        return None
+
+    class Handler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            wake.set()
+
+    observer = Observer()
+    observer.schedule(Handler(), os.fspath(directory), recursive=False)
+    observer.daemon = True
+    observer.start()
+    return observer
+
+
+class FolderWatcher:
+    """
+    Processes the complete pairs of a folder as they appear (see the module
+    docstring). run() returns when stop() is called (or, with once=True, when
+    the pairs already there are processed).
+    """
+
+    def __init__(self, pipeline, directory, output_dir, si_tag="Si", total_tag="total", jobs=None,
+                 max_pending=None, settle=SETTLE, interval=INTERVAL, events=True, log=print):
+        self.pipeline = pipeline
+        self.directory = Path(directory)
+        self.output_dir = Path(output_dir)
+        self.si_tag, self.total_tag = si_tag, total_tag
+        self.jobs = jobs or os.cpu_count() or 1
+        self.max_pending = max_pending or 2*self.jobs                           # pairs in the pool (backpressure)
+        self.settle = settle
+        self.interval = interval
+        self.events = events
+        self.log = log
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.seen = {}                                                          # name: (signature, time it was first seen)
+        self.running = {}                                                       # future: (name, start time)
+        self.counts = {"done": 0, "failed": 0}
+
+    def stop(self):
+        self.stopping.set()
+        self.wake.set()
+
+    def complete_pairs(self, now):
+        """Pairs not in the journal whose images are complete and settled, oldest first; time until the next settles."""
+        ready, wait = [], None
+        for name, si, total in tbb1_batch.pair_directory(self.directory, self.si_tag, self.total_tag):
+            if name in self.journal or any(name == running[0] for running in self.running.values()):
+                continue
+            if total is None and self.pipeline.normalization:                  # the total image is not there yet
+                continue
+            signature = _signature([si] if total is None else [si, total])
+            if signature is None:
+                continue
+            if name not in self.seen or self.seen[name][0] != signature:        # new, or still being written
+                self.seen[name] = (signature, now)
+            remaining = self.seen[name][1] + self.settle - now
+            if remaining <= 0:
+                ready.append((max(mtime for _, mtime in signature), name, si, total))
+            else:
+                wait = remaining if wait is None else min(wait, remaining)
+        return [pair[1:] for pair in sorted(ready)], wait
+
+    def _submit(self, executor, name, si, total):
+        self.journal.write("claimed", name, si_image=os.fspath(si), total_image=os.fspath(total) if total else None)
+        self.seen.pop(name, None)
+        future = executor.submit(tbb1_batch.process_pair, self.pipeline, name, si, total, self.output_dir)
+        self.running[future] = (name, time.perf_counter())
+        future.add_done_callback(lambda future: self.wake.set())
+
+    def _collect(self):
+        """Record the pairs finished by the workers. Returns False if the pool is broken."""
+        broken = False
+        for future in [future for future in self.running if future.done()]:
+            name, start = self.running.pop(future)
+            try:
+                metadata = future.result()
+            except BrokenProcessPool as error:                                  # a worker died (out of memory, ...)
+                metadata, broken = {"name": name, "error": "%s: %s" % (type(error).__name__, error)}, True
+            event = "failed" if "error" in metadata else "done"
+            self.counts[event] += 1
+            self.journal.write(event, name, **{key: value for key, value in metadata.items() if key != "name"})
+            self.log("%s %s in %.2f s%s (%d running)" % (
+                name, event, time.perf_counter() - start,
+                ": %s" % metadata["error"] if event == "failed" else "", len(self.running)))
+        return not broken
+
+    def run(self, once=False):
+        """Watch the folder until stop() (or, once, until the pairs already there are processed). Returns the counts."""
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.journal = Journal(self.output_dir / JOURNAL_FILE)
+        for name in self.journal.interrupted():
+            self.log("%s was interrupted by the previous run: not processed again (see %s)" % (name, JOURNAL_FILE))
+        observer = _start_observer(self.directory, self.wake) if self.events else None
+        self.log("watching %s (%s), %d workers, at most %d pairs pending" % (
+            self.directory, "file system events" if observer else "polling every %g s" % self.interval,
+            self.jobs, self.max_pending))
+        executor = ProcessPoolExecutor(max_workers=self.jobs)
+        try:
+            while not self.stopping.is_set():
+                if not self._collect():
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    executor = ProcessPoolExecutor(max_workers=self.jobs)
+                ready, wait = self.complete_pairs(time.monotonic())
+                for pair in ready[:max(0, self.max_pending - len(self.running))]:
+                    self._submit(executor, *pair)
+                if once and not self.running and not ready and wait is None:
+                    break
+                timeout = self.interval if observer is None else REFRESH
+                self.wake.wait(timeout if wait is None else min(timeout, wait))
+                self.wake.clear()
+        finally:
+            if observer is not None:
+                observer.stop()
+            for future in list(self.running):                                   # the pairs claimed are finished
+                future.exception()
+            self._collect()
+            executor.shutdown()
+            self.journal.close()
+        return dict(self.counts)
+
+
+# ===== Command line =====
+# ========================
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Process the Si / total ion image pairs as they are written in a folder")
+    parser.add_argument("--directory", required=True, help="folder in which the instrument writes the images")
+    parser.add_argument("--output", required=True, help="output directory (results and journal %s)" % JOURNAL_FILE)
+    parser.add_argument("--si-tag", default="Si", help="end of the Si image names (default: Si)")
+    parser.add_argument("--total-tag", default="total", help="end of the total image names (default: total)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument("--max-pending", type=int, default=None, metavar="N",
+                        help="pairs given to the workers at a time (default: twice the number of workers)")
+    parser.add_argument("--settle", type=float, default=SETTLE, metavar="SECONDS",
+                        help="time without change before an image is complete (default: %g)" % SETTLE)
+    parser.add_argument("--interval", type=float, default=INTERVAL, metavar="SECONDS",
+                        help="time between two looks at the folder when polling (default: %g)" % INTERVAL)
+    parser.add_argument("--polling", action="store_true", help="poll the folder even if watchdog is installed")
+    parser.add_argument("--once", action="store_true", help="process the pairs already there, then stop")
+    parser.add_argument("--preset", metavar="FILE",
+                        help="JSON file of the parameters (replaces the processing options below)")
+    parser.add_argument("--save-preset", metavar="FILE", help="write the parameters to FILE (JSON) and stop")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="append the time, CPU time, peak memory and arrays of each stage to FILE (JSON lines)")
+    tbb1_batch.add_pipeline_arguments(parser)
+    return parser
+
+
+def read_preset(path):
+    """Parameters of a preset: a JSON dictionary of the parameters, or a run / batch JSON holding them."""
+    with open(path) as handle:
+        preset = json.load(handle)
+    return preset.get("parameters", preset)
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.preset:
+        try:
+            pipeline = tbb1_batch.pipeline_from_args(args, **read_preset(args.preset))
+        except (OSError, ValueError) as error:
+            sys.exit("error: preset %s: %s" % (args.preset, error))
+    else:
+        pipeline = tbb1_batch.pipeline_from_args(args)
+    if args.save_preset:
+        with open(args.save_preset, "w") as handle:
+            json.dump(pipeline.parameters(), handle, indent=2)
+        return 0
+    if not os.path.isdir(args.directory):
+        sys.exit("error: no folder %s" % args.directory)
+    if args.profile:
+        os.environ[tbb1_instrument.ENVIRONMENT_VARIABLE] = args.profile         # also enabled in spawned workers
+        tbb1_instrument.enable(args.profile)
+
+    watcher = FolderWatcher(pipeline, args.directory, args.output, args.si_tag, args.total_tag, args.jobs,
+                            args.max_pending, args.settle, args.interval, events=not args.polling,
+                            log=lambda message: print(time.strftime("%H:%M:%S"), message, flush=True))
+    signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop())       # end of the acquisition: finish and stop
+    try:
+        counts = watcher.run(once=args.once)
+    except KeyboardInterrupt:                                                   # Ctrl+C: the pairs running are finished
+        watcher.stop()
+        counts = watcher.counts
+    print("%d pairs done, %d failed" % (counts["done"], counts["failed"]))
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Background execution of the long computations of the GUI.
+
+Tkinter is not thread safe: the computations (loading, smoothing, conversion,
+calibration) run in a worker thread (numpy releases the GIL during array
+operations) and their results are given back to the Tk main loop with
+root.after(), where the widgets and the plots are updated.
+
+    runner = BackgroundRunner(root, on_progress=..., on_error=...)
+    runner.submit("smooth", compute, on_done=show)
+
+compute(job) runs in the worker and can call job.report(fraction, message),
+which also stops it (raises Cancelled) when the job has been cancelled.
+on_done(result) runs in the main loop.
+
+Repeated requests are coalesced: submitting a job while a job of the same name
+is running cancels the running one, and only the latest waiting job of each
+name is kept. Debouncer delays a call until a burst of events (a slider being
+dragged) is over.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Cancelled(Exception):
+    """Raised inside a job that has been cancelled."""
+
+
+class Job:
+    """A computation submitted to the BackgroundRunner, with its progress and cancel flag."""
+
+    def __init__(self, name, function, on_done=None, on_error=None):
+        self.name = name
+        self.function = function
+        self.on_done = on_done
+        self.on_error = on_error
+        self.progress = 0.0                                                     # fraction done (0 to 1)
+        self.message = name
+        self.started = None
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def check(self):
+        """Raise Cancelled if the job has been cancelled."""
+        if self._cancel.is_set():
+            raise Cancelled(self.name)
+
+    def report(self, fraction, message=None):
+        """Report the progress from the worker (and stop there if cancelled)."""
+        self.check()
+        self.progress = min(max(float(fraction), 0.0), 1.0)
+        if message is not None:
+            self.message = message
+
+    def run(self):
+        self.started = time.perf_counter()
+        self.check()
+        return self.function(self)
+
+
+class BackgroundRunner:
+    """
+    Runs jobs one at a time in a worker thread and reports to the Tk main loop.
+
+    on_progress(job) is called in the main loop every poll_ms while a job runs
+    and with None when nothing runs anymore; on_error(job, error) is called for
+    the jobs that failed and have no on_error of their own.
+    """
+
+    def __init__(self, root, on_progress=None, on_error=None, poll_ms=50):
+        self.root = root
+        self.on_progress = on_progress
+        self.on_error = on_error
+        self.poll_ms = poll_ms
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tbb1-worker")
+        self.current = None                                                     # (job, future) running
+        self.pending = OrderedDict()                                            # name: latest job waiting
+
+    @property
+    def busy(self):
+        return self.current is not None
+
+    def submit(self, name, function, on_done=None, on_error=None):
+        """Run function(job) in the worker, then on_done(result) in the main loop. Returns the job."""
+        job = Job(name, function, on_done, on_error)
+        if self.current is None:
+            self._start(job)
+            return job
+        if self.current[0].name == name:                                        # A newer request replaces the running one
+            self.current[0].cancel()
+        self.pending.pop(name, None)
+        self.pending[name] = job
+        return job
+
+    def cancel(self):
+        """Cancel the running job and forget the waiting ones."""
+        for job in self.pending.values():
+            job.cancel()
+        self.pending.clear()
+        if self.current is not None:
+            self.current[0].cancel()
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False)
+
+    def _start(self, job):
+        self.current = (job, self.executor.submit(job.run))
+        self.root.after(self.poll_ms, self._poll)
+
+    def _poll(self):
+        job, future = self.current
+        if not future.done():
+            if self.on_progress is not None:
+                self.on_progress(job)
+            self.root.after(self.poll_ms, self._poll)
+            return
+
+        self.current = None
+        try:
+            result = future.result()
+        except Cancelled:
+            pass
+        except Exception as error:
+            on_error = job.on_error or self.on_error
+            if on_error is None:
+                raise
+            on_error(job, error)
+        else:
+            if job.on_done is not None and not job.cancelled:
+                job.on_done(result)
+
+        if self.pending:
+            _, job = self.pending.popitem(last=False)
+            self._start(job)
+        elif self.on_progress is not None:
+            self.on_progress(None)
+
+
+class Debouncer:
+    """
+    Calls function(*args) once, delay_ms after the last of a burst of calls.
+
+    Used for the widgets that send many events in a row (a slider being
+    dragged, a value being typed): only the last value is computed.
+    """
+
+    def __init__(self, root, delay_ms, function):
+        self.root = root
+        self.delay_ms = delay_ms
+        self.function = function
+        self._after = None
+
+    def __call__(self, *args):
+        self.cancel()
+        self._after = self.root.after(self.delay_ms, self._fire, *args)
+
+    def cancel(self):
+        if self._after is not None:
+            self.root.after_cancel(self._after)
+            self._after = None
+
+    def _fire(self, *args):
+        self._after = None
+        self.function(*args)